@@ -1,6 +1,6 @@
 import os
 
-from pydantic import model_validator
+from pydantic import field_validator, model_validator
 from pydantic_settings import BaseSettings
 
 
@@ -20,6 +20,140 @@ class Settings(BaseSettings):
     REDIS_DB: int
     REDIS_PREFIX: str 
     REDIS_TTL: int
+    REDIS_MAX_CONNECTIONS: int = 64
+    REDIS_POOL_TIMEOUT: int = 10
+    REDIS_SOCKET_TIMEOUT: float = 10
+    REDIS_CONNECT_TIMEOUT: float = 5
+    REDIS_SOCKET_KEEPALIVE: bool = True
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+    REDIS_RETRY_ON_TIMEOUT: bool = True
+    REDIS_RETRY_ATTEMPTS: int = 3
+
+    # Progress events
+    EVENTS_QUEUE_SIZE: int = 32
+    SSE_HEARTBEAT_SECONDS: int = 15
+    WS_MAX_SUBSCRIPTIONS: int = 50
+
+    # Cache serialization
+    CACHE_CODEC: str = "orjson"
+    CACHE_COMPRESS_THRESHOLD: int = 4096
+
+    # Task lifecycle (seconds, 0 = no expiry)
+    TASK_TTL_PENDING: int = 60 * 60 * 24
+    TASK_TTL_COMPLETED: int = 60 * 60 * 6
+    TASK_TTL_DONE: int = 60 * 60 * 24 * 7
+    TASK_TTL_ERROR: int = 60 * 60 * 24 * 3
+    TASK_TTL_CANCELED: int = 60 * 60 * 24 * 3
+
+    # Worker scheduling
+    WORKER_MAX_JOBS: int = 10
+    # Waits for slots/disk/upstream are counted apart from runs that crashed or timed out
+    WORKER_MAX_DEFERRALS: int = 500
+    WORKER_MAX_TRIES: int = 5
+    SERVICE_CONCURRENCY: dict[str, int] = {}
+    SERVICE_WEIGHTS: dict[str, int] = {}
+
+    # Graceful shutdown: finish short jobs, checkpoint the rest
+    WORKER_DRAIN_SECONDS: int = 20
+    WORKER_CHECKPOINT_GRACE_SECONDS: int = 10
+
+    # Job queues: which queues this worker reads and their share of WORKER_MAX_JOBS
+    WORKER_QUEUES: dict[str, int] = {"express": 3, "standard": 2, "bulk": 1}
+    QUEUE_EXPRESS_MAX_BYTES: int = 50 * 1024 * 1024
+    QUEUE_EXPRESS_MAX_SECONDS: int = 5 * 60
+    QUEUE_BULK_MIN_BYTES: int = 1024 * 1024 * 1024
+    QUEUE_BULK_MIN_SECONDS: int = 60 * 60
+
+    # Identical in-flight downloads share one worker job
+    INFLIGHT_DEDUP: bool = True
+    INFLIGHT_HEARTBEAT_SECONDS: int = 30
+    INFLIGHT_REFS_TTL: int = 60 * 60
+
+    # Speculative prefetch of the most picked format after get-formats (needs INFLIGHT_DEDUP)
+    SPECULATIVE_PREFETCH: bool = False
+    SPECULATIVE_MIN_SAMPLES: int = 20
+    SPECULATIVE_MIN_SHARE: float = 0.5
+    SPECULATIVE_MAX_BYTES: int = 200 * 1024 * 1024
+    SPECULATIVE_MAX_ACTIVE: int = 4
+    SPECULATIVE_TTL_SECONDS: int = 10 * 60
+
+    # Upstream circuit breaker
+    CIRCUIT_WINDOW_SECONDS: int = 60
+    CIRCUIT_MIN_REQUESTS: int = 10
+    CIRCUIT_ERROR_RATE: float = 0.5
+    CIRCUIT_BACKOFF_SECONDS: int = 15
+    CIRCUIT_MAX_BACKOFF_SECONDS: int = 60 * 10
+    CIRCUIT_PROBE_TIMEOUT_SECONDS: int = 30
+
+    # Upstream connection budget (per host, across all workers)
+    UPSTREAM_CONNECTIONS_PER_HOST: int = 32
+    UPSTREAM_HOST_CONNECTIONS: dict[str, int] = {}
+    # Hosts that share one budget: domain suffix -> group name (default: one budget per hostname)
+    UPSTREAM_HOST_GROUPS: dict[str, str] = {}
+    UPSTREAM_LEASE_TTL_SECONDS: int = 30
+    UPSTREAM_LEASE_POLL_SECONDS: float = 0.5
+    UPSTREAM_LEASE_WAIT_SECONDS: int = 120
+
+    # Sliding-window quotas (per window, 0 = unlimited)
+    QUOTA_WINDOW_SECONDS: int = 60 * 60
+    QUOTA_USER_DOWNLOADS: int = 30
+    QUOTA_IP_DOWNLOADS: int = 60
+    QUOTA_USER_BYTES: int = 10 * 1024 * 1024 * 1024
+    QUOTA_IP_BYTES: int = 20 * 1024 * 1024 * 1024
+    QUOTA_USER_FORMATS: int = 300
+    QUOTA_IP_FORMATS: int = 600
+
+    # Load shedding on start-download (0 = off)
+    LOAD_SHED_QUEUE_DEPTH: int = 500
+    LOAD_SHED_BACKLOG_SECONDS: int = 30 * 60
+    LOAD_SHED_AVG_JOB_SECONDS: int = 60
+    LOAD_SHED_MAX_RETRY_AFTER: int = 10 * 60
+
+    # Download bandwidth (bytes/sec, 0 = unlimited)
+    BANDWIDTH_GLOBAL_BPS: int = 0
+    BANDWIDTH_USER_BPS: int = 0
+    BANDWIDTH_WORKER_BPS: int = 0
+    BANDWIDTH_BURST_SECONDS: float = 1.0
+    BANDWIDTH_LEASE_BYTES: int = 1024 * 1024
+    BANDWIDTH_ACTIVE_WINDOW_SECONDS: int = 10
+
+    # CPU-bound ffmpeg work (0 = number of CPUs - 1)
+    TRANSCODE_CONCURRENCY: int = 0
+    FFMPEG_TIMEOUT_SECONDS: int = 3 * 60 * 60
+    FFMPEG_STALL_SECONDS: int = 120
+    # Probe cache: ffprobe results (streams, duration, keyframe index) per video and format,
+    # plus file size for downloaded artifacts; remote streams are probed before downloading
+    PROBE_CACHE_TTL_SECONDS: int = 7 * 24 * 60 * 60
+    # Partial clip fetch: clips up to this share of the video are read from the source by range
+    # (ffmpeg reads remote inputs unthrottled, so this is skipped while any BANDWIDTH_* limit is set)
+    CLIP_PARTIAL_FETCH: bool = True
+    CLIP_PARTIAL_FETCH_MAX_RATIO: float = 0.5
+    # How far before a smart clip start the remote stream is scanned for the preceding keyframe
+    CLIP_KEYFRAME_LOOKBACK_SECONDS: float = 10.0
+    # Smart cut: clip edges are re-encoded by libx264 with these settings, the middle is copied
+    CLIP_SMART_PRESET: str = "veryfast"
+    CLIP_SMART_CRF: int = 18
+
+    # Thumbnails: WebP variants by max width, made from one decode of the upstream preview
+    THUMBNAIL_VARIANTS: dict[str, int] = {"card": 320, "player": 640}
+    THUMBNAIL_QUALITY: int = 70
+    THUMBNAIL_CACHE_SECONDS: int = 365 * 24 * 60 * 60
+    THUMBNAIL_CONCURRENCY: int = 2
+
+    # Scratch space: disk admission control and optional tmpfs for small intermediates.
+    # Reservations are kept in the worker process, so one worker process must own DOWNLOAD_FOLDER
+    SCRATCH_RESERVE_FACTOR: float = 2.0
+    SCRATCH_MIN_FREE_BYTES: int = 1024 * 1024 * 1024
+    SCRATCH_RETRY_SECONDS: int = 15
+    SCRATCH_SCAN_TTL_SECONDS: float = 5.0
+    SCRATCH_TMPFS_DIR: str = ""
+    SCRATCH_TMPFS_MAX_BYTES: int = 512 * 1024 * 1024
+    SCRATCH_TMPFS_MAX_FILE_BYTES: int = 64 * 1024 * 1024
+
+    # Storage janitor
+    JANITOR_INTERVAL_MINUTES: int = 15
+    JANITOR_ORPHAN_GRACE_SECONDS: int = 60 * 10
+    JANITOR_STALE_PENDING_SECONDS: int = 60 * 60 * 2
 
     # Database / Admin / Security
     DATABASE_URL: str
@@ -29,6 +163,14 @@ class Settings(BaseSettings):
     ADMIN_PASSWORD: str
 
 
+    @field_validator("JANITOR_INTERVAL_MINUTES")
+    @classmethod
+    def check_janitor_interval(cls, value: int) -> int:
+        # arq cron is a set of hours x minutes: the interval has to divide an hour or a day evenly
+        if not (0 < value <= 60 and 60 % value == 0) and not (value % 60 == 0 and 24 * 60 % value == 0):
+            raise ValueError("JANITOR_INTERVAL_MINUTES must divide 60 (1-60) or be whole hours dividing 24h")
+        return value
+
     @model_validator(mode="before")
     def set_more_field(cls, values):
         os.makedirs(values['DOWNLOAD_FOLDER'], exist_ok=True)
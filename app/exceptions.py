@@ -1,3 +1,58 @@
+import math
+
 
 class DownloadUserCanceledException(Exception):
     """Задача отменена пользователм"""
+
+
+class DownloadCheckpointed(Exception):
+    """Загрузка приостановлена на время перезапуска воркера и продолжится с места остановки"""
+
+
+class UpstreamUnavailableException(Exception):
+    """Сервис-источник временно недоступен, повторите попытку позже"""
+
+    def __init__(self, host: str, retry_after: float):
+        super().__init__(f"{host} is temporarily unavailable, retry in {int(retry_after) or 1}s")
+        self.host = host
+        self.retry_after = retry_after
+
+
+class QuotaExceededException(Exception):
+    """Превышен лимит запросов, повторите попытку позже"""
+
+    def __init__(self, quota: str, retry_after: float):
+        super().__init__(f"Quota exceeded ({quota}), retry in {math.ceil(retry_after) or 1}s")
+        self.quota = quota
+        self.retry_after = retry_after
+
+
+class QuotaTooLargeException(Exception):
+    """Запрос больше лимита окна и не пройдёт никогда"""
+
+    def __init__(self, quota: str, amount: int, limit: int):
+        super().__init__(f"Request exceeds quota ({quota}): {amount} > {limit} per window")
+        self.quota = quota
+        self.amount = amount
+        self.limit = limit
+
+
+class ServiceOverloadedException(Exception):
+    """Сервис перегружен, повторите попытку позже"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Service is overloaded, retry in {math.ceil(retry_after) or 1}s")
+        self.retry_after = retry_after
+
+
+class FFmpegError(Exception):
+    """Ошибка обработки видео"""
+
+    def __init__(self, message: str, returncode: int = None, stderr: str = ""):
+        super().__init__(f"{message}: {stderr}" if stderr else message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class FFmpegTimeoutError(FFmpegError):
+    """Обработка видео заняла слишком много времени"""
@@ -51,6 +51,7 @@ const clearInputBtn = document.getElementById('clearInput');
 const startTimeInput = document.getElementById('startTime');
 const endTimeInput = document.getElementById('endTime');
 const clipForm = document.getElementById('clipForm');
+const accurateClipInput = document.getElementById('accurateClip');
 const clearStartTimeBtn = document.getElementById('clearStartTime');
 const clearEndTimeBtn = document.getElementById('clearEndTime');
 
@@ -613,7 +614,7 @@ function createFormatElement(format) {
     formatDiv.innerHTML = `
         <div class="format-quality">${qualityDisplay}</div>
         ${format.filesize && format.filesize > 0 ? `<div class="format-size">${formatFileSize(format.filesize)}</div>` : ''}
-        <button class="download-format-btn" onclick="startDownload('${format.video_format_id}', '${format.audio_format_id}')">
+        <button class="download-format-btn" onclick="startDownload('${format.video_format_id}', '${format.audio_format_id}', '${format.container || ''}')">
             ${isAudioOnly ? 'Скачать аудио' : 'Скачать видео'}
         </button>
     `;
@@ -624,13 +625,13 @@ function createFormatElement(format) {
         if (e.target.classList.contains('download-format-btn')) return;
         
         // Вызываем ту же логику что и кнопка
-        startDownload(format.video_format_id, format.audio_format_id);
+        startDownload(format.video_format_id, format.audio_format_id, format.container);
     });
     
     return formatDiv;
 }
 
-async function startDownload(videoFormatId, audioFormatId) {
+async function startDownload(videoFormatId, audioFormatId, container) {
     if (!currentVideoData) {
         showError('Данные о видео не найдены. Попробуйте заново получить форматы.');
         return;
@@ -673,10 +674,14 @@ async function startDownload(videoFormatId, audioFormatId) {
         video_format_id: videoFormatId,
         audio_format_id: audioFormatId,
         start_seconds: start_seconds,
-        end_seconds: end_seconds
+        end_seconds: end_seconds,
+        container: container || null,
+        clip_mode: clipEnabled && accurateClipInput && accurateClipInput.checked ? 'smart' : null
     };
     if (downloadData.start_seconds == null) delete downloadData.start_seconds;
     if (downloadData.end_seconds == null) delete downloadData.end_seconds;
+    if (downloadData.container == null) delete downloadData.container;
+    if (downloadData.clip_mode == null) delete downloadData.clip_mode;
     
     try {
         const response = await fetch('/api/start-download', {
@@ -1085,6 +1090,7 @@ async function loadUserHistory() {
         if (historyData.history && historyData.history.length > 0) {
             const history = historyData.history;
             displayHistory(history);
+            trackHistoryTasks(history);
             if (historySection) {
                 historySection.style.display = 'block';
                 historySection.classList.add('fade-in');
@@ -1101,6 +1107,52 @@ async function loadUserHistory() {
     }
 }
 
+// Один WebSocket на все незавершённые задачи из истории вместо отдельного потока на каждую
+let historySocket = null;
+
+function trackHistoryTasks(historyItems) {
+    const pendingIds = historyItems
+        .filter(item => item.status === 'pending')
+        .map(item => item.task_id);
+
+    if (!window.WebSocket || pendingIds.length === 0) {
+        if (historySocket) {
+            historySocket.close();
+            historySocket = null;
+        }
+        return;
+    }
+
+    const subscribe = () => historySocket.send(JSON.stringify({ action: 'subscribe', task_ids: pendingIds }));
+    if (historySocket && historySocket.readyState === WebSocket.OPEN) {
+        subscribe();
+        return;
+    }
+    if (historySocket) {
+        historySocket.close();
+    }
+
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${protocol}//${window.location.host}/api/ws`);
+    historySocket = socket;
+    socket.onopen = subscribe;
+    socket.onmessage = (event) => {
+        try {
+            const message = JSON.parse(event.data);
+            if (message.status && message.status !== 'pending') {
+                loadUserHistory();
+            }
+        } catch (e) {
+            console.error('History socket message error:', e);
+        }
+    };
+    socket.onclose = () => {
+        if (historySocket === socket) {
+            historySocket = null;
+        }
+    };
+}
+
 function displayHistory(historyItems) {
     if (!historyList || !historyEmpty) return;
     
@@ -1,8 +1,9 @@
+import math
 from pathlib import Path
 
 from fastapi import FastAPI, HTTPException
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, JSONResponse
 from starlette.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 
@@ -12,12 +13,18 @@ from app.routers.front import router as new_front_router
 from app.routers.admin import router as admin_router
 from app.routers.blog import router as blog_router
 from app.config import settings
+from app.exceptions import (
+    QuotaExceededException, QuotaTooLargeException, ServiceOverloadedException, UpstreamUnavailableException,
+)
 from app.database import engine, Base
 from sqlalchemy.ext.asyncio import AsyncEngine
 from app.utils.jinja_filters import ru_date
 from app.models.cache import redis_cache
 from app.models.status import VideoDownloadStatus
 from app.models.queue import task_queue
+from app.models.speculation import SPECULATIVE_USER
+from app.models.events import progress_dispatcher
+from app.models.connections import redis_connections
 from fastapi.templating import Jinja2Templates
 
 app = FastAPI()
@@ -44,6 +51,35 @@ templates = Jinja2Templates(directory="app/frontend")
 templates.env.filters["ru_date"] = ru_date
 
 
+def retry_later_response(status_code: int, exc) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
+
+@app.exception_handler(UpstreamUnavailableException)
+async def upstream_unavailable_handler(request, exc: UpstreamUnavailableException):
+    return retry_later_response(503, exc)
+
+
+@app.exception_handler(ServiceOverloadedException)
+async def service_overloaded_handler(request, exc: ServiceOverloadedException):
+    return retry_later_response(503, exc)
+
+
+@app.exception_handler(QuotaExceededException)
+async def quota_exceeded_handler(request, exc: QuotaExceededException):
+    return retry_later_response(429, exc)
+
+
+@app.exception_handler(QuotaTooLargeException)
+async def quota_too_large_handler(request, exc: QuotaTooLargeException):
+    # повтор не поможет, поэтому без Retry-After
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
     favicon_path = Path(__file__).parent / "frontend" / "static" / "images" / "favicon.png"
@@ -85,6 +121,9 @@ async def on_startup():
             status = task.video_status.status
             user_id = await redis_cache.get_task_user(task_id)
 
+            if user_id == SPECULATIVE_USER:
+                # спекуляции не восстанавливаются: их job остался в arq, а неиспользованные снимет cron воркера
+                continue
             if status == VideoDownloadStatus.PENDING:
                 if task.download is not None:
                     if user_id:
@@ -94,9 +133,7 @@ async def on_startup():
                         elif active != task_id:
                             continue
                     try:
-
-                        arq = await task_queue.get()
-                        await arq.enqueue_job("download_video", task_id, _job_id=task_id)
+                        await task_queue.enqueue_download(task)
                     except Exception:
                         task.video_status.status = VideoDownloadStatus.ERROR
                         task.video_status.description = "Failed to resume after restart"
@@ -115,3 +152,9 @@ async def on_startup():
                     await redis_cache.release_user_active_task(user_id, task_id)
     except Exception:
         pass
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await progress_dispatcher.stop()
+    await redis_connections.close()
@@ -0,0 +1,250 @@
+import asyncio
+import os
+import socket
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from app.config import settings
+from app.models.cache import redis_cache
+
+
+# Общий и пользовательский token bucket в одном атомарном вызове. Время берётся из Redis
+# (TIME), чтобы часы реплик воркеров не влияли на пополнение. Бакет уходит в минус:
+# запросивший сразу получает токены «в долг» и спит, пока долг не будет погашен, —
+# так конкурирующие загрузки выстраиваются в очередь, а не перебирают токены по кругу.
+BANDWIDTH_LEASE_SCRIPT = """
+local global_rate = tonumber(ARGV[1])
+local user_cap = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local user_id = ARGV[4]
+local window = tonumber(ARGV[5])
+local burst_seconds = tonumber(ARGV[6])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+redis.call('ZADD', KEYS[3], now, user_id)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now - window)
+redis.call('EXPIRE', KEYS[3], math.ceil(window) * 2)
+local users = redis.call('ZCARD', KEYS[3])
+
+local user_rate = 0
+if global_rate > 0 then
+    user_rate = global_rate / users
+end
+if user_cap > 0 and (user_rate == 0 or user_cap < user_rate) then
+    user_rate = user_cap
+end
+
+local function take(key, rate)
+    if rate <= 0 then
+        return 0
+    end
+    local burst = rate * burst_seconds
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - requested
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(window) * 2)
+    if tokens >= 0 then
+        return 0
+    end
+    return -tokens / rate
+end
+
+local wait = math.max(take(KEYS[1], global_rate), take(KEYS[2], user_rate))
+return {math.ceil(wait * 1000), math.floor(user_rate), users}
+"""
+
+
+class LocalTokenBucket:
+    """Token bucket в памяти процесса (лимит на воркер); работает в долг так же, как Redis-бакеты."""
+
+    def __init__(self, rate: int, burst_seconds: float):
+        self.rate = rate
+        self.burst = rate * burst_seconds
+        self._tokens = self.burst
+        self._ts = time.monotonic()
+
+    def reserve(self, amount: int) -> float:
+        """Списывает токены и возвращает, сколько секунд нужно подождать."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate) - amount
+        self._ts = now
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+
+class Throttle:
+    """Ограничитель скорости одной задачи; ``consume`` вызывается на каждый прочитанный чанк.
+
+    Токены глобального и пользовательского бакетов берутся из Redis партиями по
+    ``BANDWIDTH_LEASE_BYTES``, чтобы не ходить в Redis на каждый чанк.
+    """
+
+    def __init__(self, scheduler: "BandwidthScheduler", task_id: str, user_id: Optional[str] = None):
+        self.scheduler = scheduler
+        self.task_id = task_id
+        self.user_id = user_id
+        self.bytes = 0
+        self.throttled_seconds = 0.0
+        self.user_rate = 0
+        self.started_at = time.monotonic()
+        self._credit = 0
+
+    async def consume(self, amount: int) -> None:
+        self.bytes += amount
+        wait = self.scheduler.worker_bucket.reserve(amount)
+        if self.scheduler.distributed:
+            while self._credit < amount:
+                wait = max(wait, await self._lease())
+                self._credit += self.scheduler.lease_bytes
+            self._credit -= amount
+        if wait > 0:
+            self.throttled_seconds += wait
+            await asyncio.sleep(wait)
+        await self.scheduler.maybe_publish()
+
+    async def account(self, amount: int) -> None:
+        """Учитывает байты, скачанные в обход ``consume`` (входы ffmpeg читает сам).
+
+        Ограничить скорость такого чтения нельзя, поэтому байты списываются с бакетов после
+        прогона без ожидания: долг отрабатывают следующие загрузки пользователя и остальные задачи.
+        """
+        self.bytes += amount
+        self.scheduler.worker_bucket.reserve(amount)
+        if self.scheduler.distributed and amount > 0:
+            await self._lease(amount)
+        await self.scheduler.maybe_publish()
+
+    async def _lease(self, amount: Optional[int] = None) -> float:
+        try:
+            wait_ms, self.user_rate, self.scheduler.active_users = await self.scheduler.lease(self.user_id, amount)
+        except Exception as e:
+            # Redis недоступен: не останавливаем загрузку, остаётся только лимит воркера
+            print(f"Throttle: failed to lease bandwidth for {self.task_id}: {e}")
+            return 0.0
+        return wait_ms / 1000
+
+    def stats(self) -> dict:
+        elapsed = max(1e-3, time.monotonic() - self.started_at)
+        return {
+            "user_id": self.user_id,
+            "bytes": self.bytes,
+            "avg_bps": int(self.bytes / elapsed),
+            "user_rate_bps": self.user_rate,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+        }
+
+    async def __aenter__(self) -> "Throttle":
+        if self.user_id is None:
+            self.user_id = self.scheduler.owner_of(self.task_id)
+        self.scheduler.register(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.scheduler.release(self)
+
+
+class BandwidthScheduler:
+    """Распределяет полосу загрузок между воркерами и пользователями.
+
+    Три уровня token bucket: общий лимит на все реплики (``BANDWIDTH_GLOBAL_BPS``),
+    справедливая доля пользователя — общий лимит, делённый на число пользователей с
+    активными загрузками, но не больше ``BANDWIDTH_USER_BPS``, — и лимит процесса воркера
+    (``BANDWIDTH_WORKER_BPS``). Ноль выключает соответствующий уровень.
+    """
+
+    PUBLISH_INTERVAL = 2.0
+    # анонимные загрузки делят одну долю полосы, а не получают по доле на задачу
+    ANONYMOUS = "anon"
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.global_rate = settings.BANDWIDTH_GLOBAL_BPS
+        self.user_cap = settings.BANDWIDTH_USER_BPS
+        self.lease_bytes = max(1, settings.BANDWIDTH_LEASE_BYTES)
+        self.worker_bucket = LocalTokenBucket(settings.BANDWIDTH_WORKER_BPS, settings.BANDWIDTH_BURST_SECONDS)
+        self.distributed = self.global_rate > 0 or self.user_cap > 0
+        self.active_users = 0
+        self.total_bytes = 0
+        self._throttles: Dict[str, Throttle] = {}
+        self._owners: Dict[str, str] = {}
+        self._published_at = 0.0
+        self._script = None
+
+    @property
+    def limited(self) -> bool:
+        """Включён ли хоть один лимит полосы."""
+        return self.distributed or self.worker_bucket.rate > 0
+
+    def throttle(self, task_id: str, user_id: Optional[str] = None) -> Throttle:
+        """Ограничитель для задачи: ``async with bandwidth.throttle(task_id) as throttle``."""
+        return Throttle(self, task_id, user_id)
+
+    @contextmanager
+    def owner(self, task_id: str, user_id: Optional[str]):
+        """Загрузка под ``task_id`` (задача или общее задание inflight) идёт от имени ``user_id``."""
+        self._owners[task_id] = user_id or self.ANONYMOUS
+        try:
+            yield
+        finally:
+            self._owners.pop(task_id, None)
+
+    def owner_of(self, task_id: str) -> str:
+        return self._owners.get(task_id, self.ANONYMOUS)
+
+    def register(self, throttle: Throttle) -> None:
+        self._throttles[throttle.task_id] = throttle
+
+    async def lease(self, user_id: str, amount: Optional[int] = None) -> tuple[int, int, int]:
+        if self._script is None:
+            self._script = redis_cache.redis.register_script(BANDWIDTH_LEASE_SCRIPT)
+        wait_ms, user_rate, users = await self._script(
+            keys=[
+                redis_cache._get_key("bandwidth:global"),
+                redis_cache._get_key(f"bandwidth:user:{user_id}"),
+                redis_cache._get_key("bandwidth:active"),
+            ],
+            args=[
+                self.global_rate,
+                self.user_cap,
+                amount or self.lease_bytes,
+                user_id,
+                settings.BANDWIDTH_ACTIVE_WINDOW_SECONDS,
+                settings.BANDWIDTH_BURST_SECONDS,
+            ],
+        )
+        return int(wait_ms), int(user_rate), int(users)
+
+    async def release(self, throttle: Throttle) -> None:
+        if self._throttles.get(throttle.task_id) is throttle:
+            del self._throttles[throttle.task_id]
+        self.total_bytes += throttle.bytes
+        await self.maybe_publish(force=True)
+
+    def stats(self) -> dict:
+        return {
+            "global_bps": self.global_rate,
+            "user_cap_bps": self.user_cap,
+            "worker_bps": self.worker_bucket.rate,
+            "active_users": self.active_users,
+            "total_bytes": self.total_bytes + sum(t.bytes for t in self._throttles.values()),
+            "tasks": {task_id: t.stats() for task_id, t in self._throttles.items()},
+        }
+
+    async def maybe_publish(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._published_at < self.PUBLISH_INTERVAL:
+            return
+        self._published_at = now
+        try:
+            await redis_cache.set_worker_stats(self.worker_id, "bandwidth", self.stats())
+        except Exception as e:
+            print(f"BandwidthScheduler: failed to publish stats: {e}")
+
+
+bandwidth = BandwidthScheduler()
@@ -4,6 +4,8 @@ from datetime import datetime, timezone
 from redis.asyncio import Redis
 
 from app.config import settings
+from app.models.codec import PayloadSerializer
+from app.models.connections import redis_connections
 from app.models.status import VideoDownloadStatus
 from app.schemas.main import SVideoResponse
 from app.models.types import DownloadTask
@@ -11,15 +13,25 @@ from app.models.types import DownloadTask
 
 class RedisCache:
     def __init__(self):
-        self.redis = Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-            decode_responses=True
-        )
+        self.redis: Redis = redis_connections.client()
+        # Бинарные записи (задачи, метаданные) читаются без декодирования в str
+        self.raw_redis: Redis = redis_connections.client(decode_responses=False)
+        self.serializer = PayloadSerializer(settings.CACHE_CODEC, settings.CACHE_COMPRESS_THRESHOLD)
         self.ttl = settings.REDIS_TTL
         self.lock_ttl = max(int(self.ttl or 0), 3600)
 
+    @staticmethod
+    def task_ttl(status: str) -> Optional[int]:
+        """TTL ключа задачи в зависимости от её состояния (None — без срока жизни)."""
+        ttl = {
+            VideoDownloadStatus.PENDING: settings.TASK_TTL_PENDING,
+            VideoDownloadStatus.COMPLETED: settings.TASK_TTL_COMPLETED,
+            VideoDownloadStatus.DONE: settings.TASK_TTL_DONE,
+            VideoDownloadStatus.ERROR: settings.TASK_TTL_ERROR,
+            VideoDownloadStatus.CANCELED: settings.TASK_TTL_CANCELED,
+        }.get(status)
+        return ttl or None
+
     def _get_key(self, key: str) -> str:
         return f"{settings.REDIS_PREFIX}{key}"
 
@@ -38,23 +50,23 @@ class RedisCache:
     async def get_video_meta(self, url: str) -> Optional[SVideoResponse]:
         """Get video metadata from cache"""
         key = self._get_key(f"meta:{url}")
-        data = await self.redis.get(key)
+        data = await self.raw_redis.get(key)
         if data:
-            return SVideoResponse.model_validate_json(data)
+            return SVideoResponse.model_validate(self.serializer.decode(data))
         return None
 
     async def set_video_meta(self, url: str, meta: SVideoResponse) -> None:
         """Store video metadata in cache"""
         key = self._get_key(f"meta:{url}")
-        await self.redis.set(key, meta.model_dump_json(), ex=self.ttl)
+        await self.raw_redis.set(key, self.serializer.encode(meta.model_dump()), ex=self.ttl)
 
     async def get_download_task(self, task_id: str) -> Optional[DownloadTask]:
         """Get download task from cache"""
         key = self._get_key(f"task:{task_id}")
-        data = await self.redis.get(key)
+        data = await self.raw_redis.get(key)
         if not data:
             return None
-        return DownloadTask.from_jsons(data)
+        return DownloadTask.from_json(self.serializer.decode(data))
 
     async def exist_download_task(self, task_id: str) -> bool:
         key = self._get_key(f"task:{task_id}")
@@ -65,9 +77,9 @@ class RedisCache:
     async def set_download_task(self, task: DownloadTask) -> None:
         """Store download task in cache"""
         key = self._get_key(f"task:{task.id_}")
-        await self.redis.set(key, task.to_jsons())
-        await self.publish_progress(task)
         status = task.video_status.status
+        await self.raw_redis.set(key, self.serializer.encode(task.to_json()), ex=self.task_ttl(status))
+        await self.publish_progress(task)
         if status in (VideoDownloadStatus.COMPLETED, VideoDownloadStatus.ERROR, VideoDownloadStatus.DONE,
                       VideoDownloadStatus.CANCELED):
             user_id = await self.get_task_user(task.id_)
@@ -86,6 +98,29 @@ class RedisCache:
         key = self._get_key(f"cancel:{task_id}")
         return bool(await self.redis.exists(key))
 
+    async def set_task_checkpoint(self, task_id: str) -> None:
+        key = self._get_key(f"checkpoint:{task_id}")
+        await self.redis.set(key, "1", ex=self.lock_ttl)
+
+    async def pop_task_checkpoint(self, task_id: str) -> bool:
+        key = self._get_key(f"checkpoint:{task_id}")
+        return bool(await self.redis.delete(key))
+
+    async def incr_task_deferrals(self, task_id: str) -> int:
+        """Сколько раз задача отложена через arq ``Retry`` (ожидание, а не падение)."""
+        key = self._get_key(f"deferrals:{task_id}")
+        count = await self.redis.incr(key)
+        await self.redis.expire(key, self.lock_ttl)
+        return count
+
+    async def get_task_deferrals(self, task_id: str) -> int:
+        key = self._get_key(f"deferrals:{task_id}")
+        return int(await self.redis.get(key) or 0)
+
+    async def clear_task_deferrals(self, task_id: str) -> None:
+        key = self._get_key(f"deferrals:{task_id}")
+        await self.redis.delete(key)
+
     async def delete_download_task(self, task_id: str):
         key = self._get_key(f"task:{task_id}")
         await self.redis.delete(key)
@@ -113,6 +148,50 @@ class RedisCache:
             except Exception:
                 pass
 
+    async def remove_user_task(self, user_id: str, task_id: str) -> None:
+        key = self._get_key(f"user:{user_id}")
+        await self.redis.lrem(key, 0, task_id)
+
+    async def incr_janitor_stats(self, files: int, bytes_: int) -> None:
+        key = self._get_key("stats:janitor")
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrby(key, "runs", 1)
+        pipe.hincrby(key, "files_removed", files)
+        pipe.hincrby(key, "bytes_reclaimed", bytes_)
+        pipe.hset(key, mapping={
+            "last_run_at": datetime.now(timezone.utc).isoformat(),
+            "last_files_removed": files,
+            "last_bytes_reclaimed": bytes_,
+        })
+        await pipe.execute()
+
+    async def get_janitor_stats(self) -> Dict[str, str]:
+        return await self.redis.hgetall(self._get_key("stats:janitor"))
+
+    async def incr_audio_stats(self, source: str, bytes_: int) -> None:
+        key = self._get_key("stats:audio")
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrby(key, f"{source}_jobs", 1)
+        pipe.hincrby(key, f"{source}_bytes", bytes_)
+        await pipe.execute()
+
+    async def get_audio_stats(self) -> Dict[str, str]:
+        return await self.redis.hgetall(self._get_key("stats:audio"))
+
+    async def set_worker_stats(self, worker_id: str, kind: str, stats: dict, ttl: int = 120) -> None:
+        """Сохраняет снимок метрик воркера; ключ живёт ttl секунд, чтобы ушедшие воркеры пропадали сами."""
+        key = self._get_key(f"workers:{kind}:{worker_id}")
+        await self.redis.set(key, json.dumps(stats), ex=ttl)
+
+    async def get_workers_stats(self, kind: str) -> Dict[str, dict]:
+        prefix = self._get_key(f"workers:{kind}:")
+        result = {}
+        async for key in self.redis.scan_iter(f"{prefix}*"):
+            data = await self.redis.get(key)
+            if data:
+                result[key[len(prefix):]] = json.loads(data)
+        return result
+
     async def list_users(self) -> List[str]:
         """Return list of user_ids that have any tasks recorded."""
         users: List[str] = []
@@ -0,0 +1,225 @@
+import ipaddress
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from app.config import settings
+from app.exceptions import UpstreamUnavailableException
+from app.models.cache import redis_cache
+
+
+# KEYS: state, probe; ARGV: probe ttl. Возвращает, сколько мс ждать (0 — запрос можно делать)
+ALLOW_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if not state or state == 'closed' then
+    return 0
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local open_until = tonumber(redis.call('HGET', KEYS[1], 'open_until')) or 0
+if state == 'open' and now < open_until then
+    return math.ceil((open_until - now) * 1000)
+end
+if redis.call('SET', KEYS[2], '1', 'NX', 'EX', ARGV[1]) then
+    redis.call('HSET', KEYS[1], 'state', 'half_open')
+    return 0
+end
+return 1000
+"""
+
+# KEYS: state; возвращает оставшееся время открытого состояния в мс, не занимая пробный запрос
+OPEN_FOR_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'state') ~= 'open' then
+    return 0
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local open_until = tonumber(redis.call('HGET', KEYS[1], 'open_until')) or 0
+return math.max(0, math.ceil((open_until - now) * 1000))
+"""
+
+# KEYS: state, probe
+# ARGV: ok (1/0), retry_after, window, min_requests, error_rate, base backoff, max backoff
+# Окно ошибок скользящее: два соседних интервала, предыдущий учитывается с убывающим весом.
+RECORD_SCRIPT = """
+local ok = ARGV[1] == '1'
+local retry_after = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local idx = math.floor(now / window)
+
+local s = redis.call('HMGET', KEYS[1], 'state', 'win', 'ok', 'err', 'prev_ok', 'prev_err', 'open_until')
+local state = s[1] or 'closed'
+local win = tonumber(s[2]) or idx
+local cur_ok, cur_err = tonumber(s[3]) or 0, tonumber(s[4]) or 0
+local prev_ok, prev_err = tonumber(s[5]) or 0, tonumber(s[6]) or 0
+if idx > win then
+    if idx == win + 1 then
+        prev_ok, prev_err = cur_ok, cur_err
+    else
+        prev_ok, prev_err = 0, 0
+    end
+    cur_ok, cur_err = 0, 0
+end
+if ok then cur_ok = cur_ok + 1 else cur_err = cur_err + 1 end
+redis.call('HSET', KEYS[1], 'win', idx, 'ok', cur_ok, 'err', cur_err, 'prev_ok', prev_ok, 'prev_err', prev_err)
+redis.call('EXPIRE', KEYS[1], 86400)
+
+if ok then
+    if state == 'half_open' then
+        redis.call('HSET', KEYS[1], 'state', 'closed', 'opens', 0)
+        redis.call('DEL', KEYS[2])
+    end
+    return 0
+end
+
+if state == 'open' then
+    if retry_after > 0 then
+        local open_until = math.max(tonumber(s[7]) or 0, now + retry_after)
+        redis.call('HSET', KEYS[1], 'open_until', tostring(open_until))
+    end
+    return 0
+end
+
+local trip = retry_after > 0 or state == 'half_open'
+if not trip then
+    local weight = 1 - (now % window) / window
+    local errors = cur_err + prev_err * weight
+    local total = cur_ok + cur_err + (prev_ok + prev_err) * weight
+    trip = total >= tonumber(ARGV[4]) and errors / total >= tonumber(ARGV[5])
+end
+if not trip then
+    return 0
+end
+
+local opens = redis.call('HINCRBY', KEYS[1], 'opens', 1)
+local backoff = math.min(tonumber(ARGV[7]), tonumber(ARGV[6]) * 2 ^ (opens - 1))
+backoff = math.max(backoff, retry_after)
+redis.call('HSET', KEYS[1], 'state', 'open', 'open_until', tostring(now + backoff))
+redis.call('DEL', KEYS[2])
+return math.ceil(backoff * 1000)
+"""
+
+
+def host_key(url_or_host: str) -> str:
+    """Группирует хосты по домену второго уровня: CDN-узлы одного сервиса делят один автомат."""
+    host = urlsplit(url_or_host).hostname if "//" in url_or_host else url_or_host
+    host = (host or "").lower().rstrip(".")
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    return ".".join(host.split(".")[-2:])
+
+
+def parse_retry_after(value: Optional[str]) -> float:
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class CircuitBreaker:
+    """Автомат защиты по хостам-источникам, общий для API и всех воркеров через Redis.
+
+    Ответы 429/5xx и сетевые ошибки считаются в скользящем окне; при доле ошибок выше
+    ``CIRCUIT_ERROR_RATE`` (или сразу при ``Retry-After``) хост «открывается» на время
+    экспоненциального backoff. Пока он открыт, запросы к нему сразу падают с
+    ``UpstreamUnavailableException``; по истечении backoff пропускается один пробный
+    запрос (half-open), и его результат закрывает автомат или открывает на больший срок.
+    Подключается к сессиям aiohttp через ``trace_config()``.
+    """
+
+    def __init__(self):
+        self._scripts = {}
+
+    @staticmethod
+    def _keys(host: str) -> list[str]:
+        return [redis_cache._get_key(f"circuit:{host}"), redis_cache._get_key(f"circuit:{host}:probe")]
+
+    async def _call(self, script: str, keys: list[str], args: list) -> int:
+        if script not in self._scripts:
+            self._scripts[script] = redis_cache.redis.register_script(script)
+        return int(await self._scripts[script](keys=keys, args=args))
+
+    async def before_request(self, url: str) -> None:
+        host = host_key(url)
+        try:
+            wait_ms = await self._call(ALLOW_SCRIPT, self._keys(host), [settings.CIRCUIT_PROBE_TIMEOUT_SECONDS])
+        except Exception as e:
+            # без Redis автомат не блокирует запросы
+            print(f"CircuitBreaker: state check for {host} failed: {e}")
+            return
+        if wait_ms:
+            raise UpstreamUnavailableException(host, wait_ms / 1000)
+
+    async def open_for(self, url: str) -> float:
+        """Сколько секунд хост ещё будет открыт (0 — можно обращаться)."""
+        try:
+            return await self._call(OPEN_FOR_SCRIPT, self._keys(host_key(url))[:1], []) / 1000
+        except Exception as e:
+            print(f"CircuitBreaker: state check for {url} failed: {e}")
+            return 0.0
+
+    async def record(self, url: str, ok: bool, retry_after: float = 0.0) -> None:
+        host = host_key(url)
+        try:
+            backoff_ms = await self._call(RECORD_SCRIPT, self._keys(host), [
+                1 if ok else 0,
+                retry_after,
+                settings.CIRCUIT_WINDOW_SECONDS,
+                settings.CIRCUIT_MIN_REQUESTS,
+                settings.CIRCUIT_ERROR_RATE,
+                settings.CIRCUIT_BACKOFF_SECONDS,
+                settings.CIRCUIT_MAX_BACKOFF_SECONDS,
+            ])
+        except Exception as e:
+            print(f"CircuitBreaker: failed to record result for {host}: {e}")
+            return
+        if backoff_ms:
+            print(f"CircuitBreaker: {host} is open for {backoff_ms / 1000:.1f}s")
+
+    async def _on_request_start(self, session, ctx, params: aiohttp.TraceRequestStartParams) -> None:
+        await self.before_request(str(params.url))
+
+    async def _on_request_end(self, session, ctx, params: aiohttp.TraceRequestEndParams) -> None:
+        status = params.response.status
+        failed = status == 429 or status >= 500
+        retry_after = parse_retry_after(params.response.headers.get("Retry-After")) if failed else 0.0
+        await self.record(str(params.url), not failed, retry_after)
+
+    async def _on_request_exception(self, session, ctx, params: aiohttp.TraceRequestExceptionParams) -> None:
+        if isinstance(params.exception, (UpstreamUnavailableException, aiohttp.InvalidURL)):
+            return
+        if isinstance(params.exception, (aiohttp.ClientError, TimeoutError)):
+            await self.record(str(params.url), False)
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(self._on_request_start)
+        config.on_request_end.append(self._on_request_end)
+        config.on_request_exception.append(self._on_request_exception)
+        return config
+
+    async def stats(self) -> Dict[str, dict]:
+        prefix = redis_cache._get_key("circuit:")
+        result = {}
+        async for key in redis_cache.redis.scan_iter(f"{prefix}*"):
+            if key.endswith(":probe"):
+                continue
+            result[key[len(prefix):]] = await redis_cache.redis.hgetall(key)
+        return result
+
+
+circuit_breaker = CircuitBreaker()
@@ -0,0 +1,158 @@
+"""Компактная сериализация задач и метаданных для хранения в Redis.
+
+Формат записи: ``MAGIC`` (1 байт) + версия схемы (1 байт) + флаги (1 байт) + payload.
+Младшие 4 бита флагов — идентификатор кодека, бит ``FLAG_ZSTD`` — payload сжат zstd.
+Старые записи (чистый JSON) начинаются с ``{`` и читаются как раньше.
+"""
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+
+MAGIC = 0xD7
+SCHEMA_VERSION = 1
+HEADER_SIZE = 3
+
+CODEC_MASK = 0x0F
+FLAG_ZSTD = 0x10
+
+
+class CodecError(ValueError):
+    """Не удалось разобрать запись из кэша"""
+
+
+class Codec(ABC):
+    name = "codec"
+    codec_id = -1
+
+    @staticmethod
+    def available() -> bool:
+        return True
+
+    @abstractmethod
+    def dumps(self, obj: Any) -> bytes:
+        ...
+
+    @abstractmethod
+    def loads(self, data: bytes) -> Any:
+        ...
+
+
+class JsonCodec(Codec):
+    name = "json"
+    codec_id = 0
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+    codec_id = 1
+
+    @staticmethod
+    def available() -> bool:
+        return orjson is not None
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    codec_id = 2
+
+    @staticmethod
+    def available() -> bool:
+        return msgpack is not None
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS: dict[str, Codec] = {codec.name: codec for codec in (JsonCodec(), OrjsonCodec(), MsgpackCodec())}
+CODECS_BY_ID: dict[int, Codec] = {codec.codec_id: codec for codec in CODECS.values()}
+
+
+def get_codec(name: str) -> Codec:
+    """Возвращает кодек по имени; если библиотека не установлена — stdlib json."""
+    codec = CODECS.get((name or "").lower())
+    if codec is None or not codec.available():
+        return CODECS[JsonCodec.name]
+    return codec
+
+
+class PayloadSerializer:
+    """Кодирует словари в версионированный бинарный формат и читает старый JSON.
+
+    Args:
+        codec_name: Кодек для новых записей (``orjson``, ``msgpack`` или ``json``).
+        compress_threshold: Минимальный размер payload в байтах для сжатия zstd; 0 — не сжимать.
+        compress_level: Уровень сжатия zstd.
+    """
+
+    def __init__(self, codec_name: str = OrjsonCodec.name, compress_threshold: int = 0, compress_level: int = 3):
+        self.codec = get_codec(codec_name)
+        self.compress_threshold = compress_threshold if zstandard is not None else 0
+        self._compressor = zstandard.ZstdCompressor(level=compress_level) if self.compress_threshold else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+    def encode(self, obj: Any) -> bytes:
+        payload = self.codec.dumps(obj)
+        flags = self.codec.codec_id
+        if self._compressor is not None and len(payload) >= self.compress_threshold:
+            compressed = self._compressor.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= FLAG_ZSTD
+        return bytes((MAGIC, SCHEMA_VERSION, flags)) + payload
+
+    def decode(self, data: Optional[Union[bytes, str]]) -> Any:
+        if data is None:
+            return None
+        if isinstance(data, str):
+            return json.loads(data)
+        if not data or data[0] != MAGIC:
+            # Запись в старом формате: JSON-строка без заголовка
+            return json.loads(data)
+        if len(data) < HEADER_SIZE:
+            raise CodecError("Truncated cache record")
+
+        version, flags = data[1], data[2]
+        if version > SCHEMA_VERSION:
+            raise CodecError(f"Unsupported cache schema version: {version}")
+
+        codec = CODECS_BY_ID.get(flags & CODEC_MASK)
+        if codec is None or not codec.available():
+            raise CodecError(f"Unsupported cache codec id: {flags & CODEC_MASK}")
+
+        payload = data[HEADER_SIZE:]
+        if flags & FLAG_ZSTD:
+            if self._decompressor is None:
+                raise CodecError("zstd-compressed record but zstandard is not installed")
+            payload = self._decompressor.decompress(payload)
+        return codec.loads(payload)
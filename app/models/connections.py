@@ -0,0 +1,125 @@
+from typing import Dict, Optional
+
+from arq.connections import ArqRedis, RedisSettings
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.client import PubSub
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from app.config import settings
+
+
+class CountingConnectionPool(BlockingConnectionPool):
+    """BlockingConnectionPool, который сам считает выданные и созданные соединения для метрик."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_use = 0
+        self.created = 0
+
+    def make_connection(self):
+        self.created += 1
+        return super().make_connection()
+
+    async def get_connection(self, *args, **kwargs):
+        connection = await super().get_connection(*args, **kwargs)
+        self.in_use += 1
+        return connection
+
+    async def release(self, connection) -> None:
+        self.in_use = max(0, self.in_use - 1)
+        await super().release(connection)
+
+
+class RedisConnections:
+    """Единая точка создания подключений к Redis для API и воркера.
+
+    Держит по одному ограниченному пулу на режим декодирования: текстовый
+    (``decode_responses=True``) для служебных ключей и pubsub и бинарный — для
+    записей кэша и arq. Все клиенты, созданные здесь, делят эти пулы.
+    """
+
+    def __init__(self):
+        self._pools: Dict[bool, CountingConnectionPool] = {}
+
+    @staticmethod
+    def _retry() -> Optional[Retry]:
+        if settings.REDIS_RETRY_ATTEMPTS <= 0:
+            return None
+        return Retry(ExponentialBackoff(cap=1.0, base=0.05), settings.REDIS_RETRY_ATTEMPTS)
+
+    def _connection_kwargs(self) -> dict:
+        return dict(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT,
+            socket_keepalive=settings.REDIS_SOCKET_KEEPALIVE,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+            retry_on_timeout=settings.REDIS_RETRY_ON_TIMEOUT,
+            retry_on_error=[RedisConnectionError, RedisTimeoutError],
+            retry=self._retry(),
+        )
+
+    def _new_pool(self, decode_responses: bool) -> CountingConnectionPool:
+        return CountingConnectionPool(
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            decode_responses=decode_responses,
+            **self._connection_kwargs(),
+        )
+
+    def pool(self, decode_responses: bool = True) -> CountingConnectionPool:
+        pool = self._pools.get(decode_responses)
+        if pool is None:
+            pool = self._new_pool(decode_responses)
+            self._pools[decode_responses] = pool
+        return pool
+
+    def client(self, decode_responses: bool = True) -> Redis:
+        return Redis(connection_pool=self.pool(decode_responses))
+
+    def pubsub(self) -> PubSub:
+        return self.client().pubsub()
+
+    def arq(self) -> ArqRedis:
+        """arq-клиент поверх бинарного пула (задания arq сериализуются pickle)."""
+        return ArqRedis(self.pool(decode_responses=False))
+
+    def worker_arq(self) -> ArqRedis:
+        """arq-клиент со своим пулом для одного Worker: ``Worker.close()`` закрывает пул клиента."""
+        return ArqRedis(self._new_pool(decode_responses=False))
+
+    @staticmethod
+    def arq_settings() -> RedisSettings:
+        return RedisSettings(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            database=settings.REDIS_DB,
+            conn_timeout=settings.REDIS_CONNECT_TIMEOUT,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            retry_on_timeout=settings.REDIS_RETRY_ON_TIMEOUT,
+        )
+
+    def stats(self) -> Dict[str, dict]:
+        """Загрузка пулов: сколько соединений создано, занято и свободно."""
+        result = {}
+        for decode_responses, pool in self._pools.items():
+            result["text" if decode_responses else "binary"] = {
+                "max_connections": pool.max_connections,
+                "in_use": pool.in_use,
+                "available": max(0, pool.created - pool.in_use),
+                "created": pool.created,
+                "utilization": round(pool.in_use / pool.max_connections, 3) if pool.max_connections else 0.0,
+            }
+        return result
+
+    async def close(self) -> None:
+        for pool in self._pools.values():
+            await pool.disconnect()
+        self._pools.clear()
+
+
+redis_connections = RedisConnections()
@@ -0,0 +1,100 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Set
+
+from app.config import settings
+from app.exceptions import DownloadCheckpointed
+from app.models.cache import redis_cache
+from app.utils.helpers import resume_offset
+
+
+class WorkerDrain:
+    """Плавная остановка воркера по SIGTERM.
+
+    Воркер перестаёт брать задания; те, что успеют по ETA до ``WORKER_DRAIN_SECONDS``,
+    доделываются, остальным сразу выставляется запрос контрольной точки. Парсеры проверяют
+    его в циклах чтения через ``check`` и выходят с ``DownloadCheckpointed``, оставляя
+    частично скачанные файлы на диске; задание возвращается в очередь через ``Retry``
+    и на другой реплике продолжается с этих файлов.
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, drain_seconds: int, checkpoint_grace_seconds: int):
+        self.drain_seconds = drain_seconds
+        self.checkpoint_grace_seconds = checkpoint_grace_seconds
+        self.draining = False
+        self._checkpoint_all = False
+        self._checkpoint: Set[str] = set()
+        self._running: Set[str] = set()
+
+    @contextmanager
+    def track(self, task_id: str):
+        """Отмечает ID, под которым парсер качает, как выполняющийся в этом процессе."""
+        self._running.add(task_id)
+        try:
+            yield
+        finally:
+            self._running.discard(task_id)
+            self._checkpoint.discard(task_id)
+
+    def should_checkpoint(self, task_id: str) -> bool:
+        return self._checkpoint_all or task_id in self._checkpoint
+
+    def check(self, task_id: str) -> None:
+        """Вызывается из циклов скачивания (в том числе из потоков); прерывает загрузку при остановке."""
+        if self.should_checkpoint(task_id):
+            raise DownloadCheckpointed()
+
+    @staticmethod
+    async def checkpointed(task_id: str) -> None:
+        """Отмечает, что загрузка ``task_id`` остановлена на контрольной точке и её файлы можно докачать."""
+        await redis_cache.set_task_checkpoint(task_id)
+
+    @staticmethod
+    async def resumable(task_id: str) -> bool:
+        """Можно ли докачивать файлы ``task_id``: только после контрольной точки.
+
+        Без отметки частичные файлы могли остаться от упавшей попытки, и их содержимому нельзя
+        доверять. Отметка снимается при чтении: следующая остановка поставит её снова.
+        """
+        return await redis_cache.pop_task_checkpoint(task_id)
+
+    async def resume_offset(self, task_id: str, path: Path) -> int:
+        """Смещение докачки ``path``; 0 — файл пишется заново."""
+        return resume_offset(path) if await self.resumable(task_id) else 0
+
+    async def _request_long_checkpoints(self, deadline: float) -> None:
+        for task_id in tuple(self._running):
+            task = await redis_cache.get_download_task(task_id)
+            eta = task.video_status.eta_seconds if task else None
+            if eta is None or time.monotonic() + eta > deadline:
+                self._checkpoint.add(task_id)
+
+    async def _wait_running(self, workers, until: float) -> bool:
+        while time.monotonic() < until:
+            if not any(not t.done() for w in workers for t in w.tasks.values()):
+                return True
+            await asyncio.sleep(self.POLL_INTERVAL)
+        return False
+
+    async def drain(self, workers) -> None:
+        self.draining = True
+        for worker in workers:
+            worker.allow_pick_jobs = False
+        deadline = time.monotonic() + self.drain_seconds
+        print(f"WorkerDrain: draining {len(self._running)} downloads, deadline {self.drain_seconds}s")
+
+        await self._request_long_checkpoints(deadline)
+        if await self._wait_running(workers, deadline):
+            print("WorkerDrain: no jobs left running")
+            return
+
+        self._checkpoint_all = True
+        if not await self._wait_running(workers, time.monotonic() + self.checkpoint_grace_seconds):
+            print("WorkerDrain: checkpoint grace expired, cancelling remaining jobs")
+
+
+worker_drain = WorkerDrain(settings.WORKER_DRAIN_SECONDS, settings.WORKER_CHECKPOINT_GRACE_SECONDS)
@@ -0,0 +1,128 @@
+import asyncio
+from collections import defaultdict
+from contextlib import suppress
+from typing import Dict, Optional, Set, Union
+
+from app.config import settings
+from app.models.cache import redis_cache
+from app.models.connections import redis_connections
+
+
+class EventQueue(asyncio.Queue):
+    """Ограниченная очередь событий одной задачи; при переполнении выбрасывает самое старое."""
+
+    def publish(self, task_id: str, data: str) -> bool:
+        dropped = False
+        if self.full():
+            with suppress(asyncio.QueueEmpty):
+                self.get_nowait()
+            dropped = True
+        self.put_nowait(data)
+        return dropped
+
+
+class LatestEventsBuffer:
+    """Буфер для подписчика на много задач: хранит только последнее событие по каждой задаче."""
+
+    def __init__(self):
+        self._latest: Dict[str, str] = {}
+        self._ready = asyncio.Event()
+
+    def publish(self, task_id: str, data: str) -> bool:
+        dropped = task_id in self._latest
+        self._latest[task_id] = data
+        self._ready.set()
+        return dropped
+
+    async def get(self) -> Dict[str, str]:
+        await self._ready.wait()
+        self._ready.clear()
+        latest, self._latest = self._latest, {}
+        return latest
+
+
+Subscriber = Union[EventQueue, LatestEventsBuffer]
+
+
+class ProgressDispatcher:
+    """Одна pattern-подписка ``events:*`` на процесс, раздающая сообщения по локальным очередям.
+
+    Обработчики SSE/WebSocket регистрируют подписчика (``EventQueue`` или ``LatestEventsBuffer``)
+    на нужные task_id. Каждое событие — полный снимок статуса, поэтому при переполнении
+    можно выбрасывать старые сообщения: последнее всегда актуально.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[Subscriber]] = defaultdict(set)
+        self._task: Optional[asyncio.Task] = None
+        self._pattern = redis_cache.channel_for_task("*")
+        self._prefix = self._pattern[:-1]
+        self.dropped = 0
+
+    def new_queue(self) -> EventQueue:
+        return EventQueue(maxsize=self.queue_size)
+
+    async def subscribe(self, task_id: str, subscriber: Subscriber) -> None:
+        self._subscribers[task_id].add(subscriber)
+        self._ensure_started()
+
+    def unsubscribe(self, task_id: str, subscriber: Subscriber) -> None:
+        subscribers = self._subscribers.get(task_id)
+        if not subscribers:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[task_id]
+
+    def stats(self) -> dict:
+        return {
+            "tasks": len(self._subscribers),
+            "subscribers": sum(len(s) for s in self._subscribers.values()),
+            "dropped": self.dropped,
+            "running": self._task is not None and not self._task.done(),
+        }
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _dispatch(self, channel: str, data: str) -> None:
+        if not channel.startswith(self._prefix):
+            return
+        task_id = channel[len(self._prefix):]
+        for subscriber in tuple(self._subscribers.get(task_id, ())):
+            if subscriber.publish(task_id, data):
+                self.dropped += 1
+
+    async def _run(self) -> None:
+        backoff = 0.5
+        while True:
+            pubsub = redis_connections.pubsub()
+            try:
+                await pubsub.psubscribe(self._pattern)
+                backoff = 0.5
+                while True:
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg and msg.get("type") == "pmessage":
+                        self._dispatch(msg["channel"], msg["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"ProgressDispatcher: pubsub error: {e}, reconnecting in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 10.0)
+            finally:
+                # aclose снимает подписки и возвращает соединение в пул даже при оборванной связи
+                with suppress(Exception):
+                    await pubsub.aclose()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+progress_dispatcher = ProgressDispatcher(settings.EVENTS_QUEUE_SIZE)
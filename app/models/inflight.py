@@ -0,0 +1,302 @@
+import asyncio
+import json
+import os
+import shutil
+import uuid
+from contextlib import suppress
+from pathlib import Path
+from typing import List, Optional
+
+from app.config import settings
+from app.exceptions import DownloadCheckpointed, UpstreamUnavailableException
+from app.models.cache import redis_cache
+from app.models.events import LatestEventsBuffer, progress_dispatcher
+from app.models.status import VideoDownloadStatus
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoDownload
+
+
+# KEYS: job, refs, task->signature; ARGV: task_id, new job id ('' — только присоединиться), job ttl, refs ttl, signature
+ATTACH_SCRIPT = """
+local job = redis.call('GET', KEYS[1])
+if not job then
+    if ARGV[2] == '' then
+        return false
+    end
+    job = ARGV[2]
+    redis.call('SET', KEYS[1], job, 'EX', ARGV[3])
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('SET', KEYS[3], ARGV[5], 'EX', ARGV[4])
+return job
+"""
+
+# KEYS: job, refs; ARGV: task_id. Возвращает ID задания, если ушла последняя ссылка на него
+RELEASE_SCRIPT = """
+redis.call('SREM', KEYS[2], ARGV[1])
+if redis.call('SCARD', KEYS[2]) > 0 then
+    return false
+end
+local job = redis.call('GET', KEYS[1])
+redis.call('DEL', KEYS[1])
+return job
+"""
+
+# KEYS: job, refs; ARGV: job id. Закрывает задание для новых подписчиков и забирает их список
+FINISH_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+local refs = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[2])
+return refs
+"""
+
+# KEYS: job, refs, parked; ARGV: job id, refs ttl. Откладывает задание до перезапуска, если оно ещё кому-то нужно
+PARK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+if redis.call('SCARD', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('SET', KEYS[3], ARGV[1], 'EX', ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+# KEYS: job, refs, parked; ARGV: job ttl. Забирает отложенное задание: {job id, 1 — продолжать / 0 — никому не нужно}
+RESUME_SCRIPT = """
+local job = redis.call('GET', KEYS[3])
+if not job then
+    return false
+end
+redis.call('DEL', KEYS[3])
+if redis.call('SCARD', KEYS[2]) == 0 or redis.call('EXISTS', KEYS[1]) == 1 then
+    return {job, 0}
+end
+redis.call('SET', KEYS[1], job, 'EX', ARGV[1])
+return {job, 1}
+"""
+
+MIRRORED_FIELDS = ("percent", "speed_bps", "eta_seconds", "description")
+
+
+def job_signature(service, download: SVideoDownload) -> str:
+    """Ключ одинаковой работы: канонический ID ролика + форматы + границы фрагмента + контейнер."""
+    return "|".join(str(part) for part in (
+        service.canonical_id(download.url),
+        download.video_format_id,
+        download.audio_format_id,
+        download.start_seconds,
+        download.end_seconds,
+        download.container,
+        download.clip_mode,
+    ))
+
+
+def link_or_copy(source: Path, target: Path) -> None:
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+class InflightJobs:
+    """Склеивает одинаковые загрузки разных пользователей в одно задание воркера.
+
+    Скачивание идёт под внутренним ID задания (запись задачи без ``download``, чтобы
+    её не перезапускало восстановление после рестарта), а задачи пользователей только
+    ссылаются на него: ведущий воркер копирует им прогресс и по завершении раздаёт
+    каждой свою жёсткую ссылку (или копию) результата. Отмена снимает одну ссылку;
+    задание останавливается, когда ссылок не осталось.
+    """
+
+    MIRROR_INTERVAL = 0.5
+
+    def __init__(self):
+        self.enabled = settings.INFLIGHT_DEDUP
+        self.heartbeat = settings.INFLIGHT_HEARTBEAT_SECONDS
+        self.refs_ttl = settings.INFLIGHT_REFS_TTL
+        self._scripts = {}
+
+    def _keys(self, signature: str) -> List[str]:
+        return [redis_cache._get_key(f"inflight:job:{signature}"), redis_cache._get_key(f"inflight:refs:{signature}")]
+
+    @staticmethod
+    def _parked_key(signature: str) -> str:
+        return redis_cache._get_key(f"inflight:parked:{signature}")
+
+    @staticmethod
+    def _task_key(task_id: str) -> str:
+        return redis_cache._get_key(f"inflight:task:{task_id}")
+
+    async def _call(self, script: str, keys: List[str], args: list):
+        if script not in self._scripts:
+            self._scripts[script] = redis_cache.redis.register_script(script)
+        return await self._scripts[script](keys=keys, args=args)
+
+    @staticmethod
+    def new_job_id() -> str:
+        return str(uuid.uuid4())
+
+    async def attach(self, task_id: str, signature: str, new_job_id: str = "") -> Optional[str]:
+        """Присоединяет задачу к текущему заданию; если его нет и передан ``new_job_id`` — создаёт."""
+        return await self._call(
+            ATTACH_SCRIPT,
+            self._keys(signature) + [self._task_key(task_id)],
+            [task_id, new_job_id, self.heartbeat, self.refs_ttl, signature],
+        )
+
+    async def release(self, task_id: str) -> Optional[str]:
+        """Снимает ссылку задачи; возвращает ID задания, если его пора отменить."""
+        signature = await redis_cache.redis.get(self._task_key(task_id))
+        if not signature:
+            return None
+        await redis_cache.redis.delete(self._task_key(task_id))
+        return await self._call(RELEASE_SCRIPT, self._keys(signature), [task_id])
+
+    async def has_parked(self, signature: str) -> bool:
+        return bool(await redis_cache.redis.exists(self._parked_key(signature)))
+
+    async def resume_parked(self, signature: str) -> Optional[str]:
+        """Забирает задание, отложенное при остановке воркера; ненужное никому — удаляет."""
+        result = await self._call(RESUME_SCRIPT, self._keys(signature) + [self._parked_key(signature)],
+                                  [self.heartbeat])
+        if not result:
+            return None
+        job_id, resume = result
+        if not int(resume):
+            await redis_cache.delete_download_task(job_id)
+            return None
+        return job_id
+
+    async def _park(self, signature: str, job_id: str) -> None:
+        parked = await self._call(PARK_SCRIPT, self._keys(signature) + [self._parked_key(signature)],
+                                  [job_id, self.refs_ttl])
+        if not parked:
+            await redis_cache.delete_download_task(job_id)
+            return
+        job_task = await redis_cache.get_download_task(job_id)
+        if job_task is not None:
+            # присоединённые задачи видят, что загрузка приостановлена, а не зависла
+            await self._copy_progress(self._keys(signature)[1], job_task.video_status.model_dump())
+
+    async def _finish(self, signature: str, job_id: str) -> List[str]:
+        return await self._call(FINISH_SCRIPT, self._keys(signature), [job_id])
+
+    async def create_job_task(self, task: DownloadTask, job_id: str) -> DownloadTask:
+        existing = await redis_cache.get_download_task(job_id)
+        if existing is not None:
+            # продолжение отложенного задания: его файлы и запись остались от прошлой попытки
+            return existing
+        video_status = task.video_status.model_copy(update={"task_id": job_id})
+        job_task = DownloadTask(video_status)
+        await redis_cache.set_download_task(job_task)
+        user_id = await redis_cache.get_task_user(task.id_)
+        if user_id:
+            # для учёта полосы; active-блокировка пользователя остаётся за его задачей
+            await redis_cache.set_task_user(job_id, user_id)
+        return job_task
+
+    @staticmethod
+    async def _copy_progress(refs_key: str, snapshot: dict) -> None:
+        for task_id in await redis_cache.redis.smembers(refs_key):
+            task = await redis_cache.get_download_task(task_id)
+            if task is None or task.video_status.status != VideoDownloadStatus.PENDING:
+                continue
+            for field in MIRRORED_FIELDS:
+                setattr(task.video_status, field, snapshot.get(field))
+            await redis_cache.set_download_task(task)
+
+    async def _mirror_progress(self, signature: str, job_id: str) -> None:
+        job_key, refs_key = self._keys(signature)
+        buffer = LatestEventsBuffer()
+        await progress_dispatcher.subscribe(job_id, buffer)
+        try:
+            while True:
+                latest = {}
+                with suppress(asyncio.TimeoutError):
+                    latest = await asyncio.wait_for(buffer.get(), timeout=self.heartbeat / 3)
+                try:
+                    pipe = redis_cache.redis.pipeline(transaction=False)
+                    pipe.expire(job_key, self.heartbeat)
+                    pipe.expire(refs_key, self.refs_ttl)
+                    await pipe.execute()
+                    if job_id in latest:
+                        await self._copy_progress(refs_key, json.loads(latest[job_id]))
+                except Exception as e:
+                    print(f"InflightJobs: failed to mirror progress of {job_id}: {e}")
+                await asyncio.sleep(self.MIRROR_INTERVAL)
+        finally:
+            progress_dispatcher.unsubscribe(job_id, buffer)
+
+    @staticmethod
+    async def _stop(mirror: asyncio.Task) -> None:
+        mirror.cancel()
+        with suppress(asyncio.CancelledError):
+            await mirror
+
+    async def run(self, signature: str, job_id: str, download) -> None:
+        """Выполняет ``download(job_id)`` и раздаёт результат всем присоединившимся задачам.
+
+        Прерванное остановкой воркера задание (контрольная точка или отмена arq, после
+        которой job будет перезапущен) или упёршееся в открытый автомат источника не
+        завершается, а откладывается до следующей попытки.
+        """
+        mirror = asyncio.create_task(self._mirror_progress(signature, job_id))
+        try:
+            await download(job_id)
+        except (DownloadCheckpointed, UpstreamUnavailableException, asyncio.CancelledError):
+            await self._stop(mirror)
+            await self._park(signature, job_id)
+            raise
+        except BaseException:
+            await self._stop(mirror)
+            await self._complete(signature, job_id)
+            raise
+        await self._stop(mirror)
+        await self._complete(signature, job_id)
+
+    async def _complete(self, signature: str, job_id: str) -> None:
+        refs = await self._finish(signature, job_id)
+        job_task = await redis_cache.get_download_task(job_id)
+        await self._deliver(job_task, refs)
+        if job_task is not None:
+            if job_task.filepath.is_file():
+                job_task.filepath.unlink(missing_ok=True)
+            await redis_cache.delete_download_task(job_id)
+
+    async def _deliver(self, job_task: Optional[DownloadTask], refs: List[str]) -> None:
+        for task_id in refs:
+            await redis_cache.redis.delete(self._task_key(task_id))
+            task = await redis_cache.get_download_task(task_id)
+            if task is None or task.video_status.status != VideoDownloadStatus.PENDING:
+                continue
+            if job_task is None:
+                task.video_status.status = VideoDownloadStatus.ERROR
+                task.video_status.description = "Shared download was lost"
+            elif job_task.video_status.status == VideoDownloadStatus.COMPLETED and job_task.filepath.is_file():
+                source = job_task.filepath
+                target = source.with_name(source.name.replace(job_task.id_, task_id, 1))
+                try:
+                    await asyncio.to_thread(link_or_copy, source, target)
+                    task.filepath = target
+                    task.video_status.status = VideoDownloadStatus.COMPLETED
+                    task.video_status.percent = 100
+                    task.video_status.description = VideoDownloadStatus.COMPLETED
+                except OSError as e:
+                    task.video_status.status = VideoDownloadStatus.ERROR
+                    task.video_status.description = str(e)
+            elif job_task.video_status.status == VideoDownloadStatus.CANCELED:
+                task.video_status.status = VideoDownloadStatus.CANCELED
+                task.video_status.description = job_task.video_status.description
+            else:
+                task.video_status.status = VideoDownloadStatus.ERROR
+                task.video_status.description = job_task.video_status.description or "Shared download failed"
+            await redis_cache.set_download_task(task)
+
+
+inflight_jobs = InflightJobs()
@@ -0,0 +1,143 @@
+import asyncio
+import re
+import shutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from app.config import settings
+from app.models.cache import redis_cache
+from app.models.status import VideoDownloadStatus
+from app.models.types import DownloadTask
+
+
+TASK_ID_RE = re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})")
+
+
+@dataclass
+class StorageEntry:
+    path: Path
+    task_id: Optional[str]
+    size: int
+    mtime: float
+
+
+@dataclass
+class JanitorReport:
+    files_removed: int = 0
+    bytes_reclaimed: int = 0
+    user_refs_removed: int = 0
+
+
+def _entry_size(path: Path) -> tuple[int, float]:
+    if path.is_dir():
+        size, mtime = 0, path.stat().st_mtime
+        for file in path.rglob("*"):
+            if file.is_file():
+                stat = file.stat()
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime)
+        return size, mtime
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime
+
+
+def scan_download_folder(root: Path) -> list[StorageEntry]:
+    """Собирает файлы и каталоги вида DOWNLOAD_FOLDER/<author>/<task_id>_..."""
+    entries: list[StorageEntry] = []
+    if not root.exists():
+        return entries
+    for author_dir in root.iterdir():
+        if not author_dir.is_dir():
+            continue
+        for path in author_dir.iterdir():
+            match = TASK_ID_RE.match(path.name)
+            try:
+                size, mtime = _entry_size(path)
+            except FileNotFoundError:
+                continue
+            entries.append(StorageEntry(path, match.group(1) if match else None, size, mtime))
+    return entries
+
+
+def _remove_entry(path: Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _remove_empty_dirs(root: Path) -> None:
+    for author_dir in root.iterdir():
+        if author_dir.is_dir() and not any(author_dir.iterdir()):
+            author_dir.rmdir()
+
+
+def cron_schedule(interval_minutes: int) -> dict:
+    """Наборы ``hour``/``minute`` для arq cron, срабатывающего каждые ``interval_minutes`` минут."""
+    if interval_minutes <= 60:
+        return {"minute": set(range(0, 60, interval_minutes))}
+    return {"hour": set(range(0, 24, interval_minutes // 60)), "minute": {0}}
+
+
+class StorageJanitor:
+    """Сверяет содержимое DOWNLOAD_FOLDER с задачами в Redis и удаляет осиротевшие файлы.
+
+    Файл удаляется, если его задачи больше нет в Redis, задача завершилась ошибкой/отменой
+    или уже отдана пользователю, либо это промежуточный файл завершённой задачи.
+    Файлы задач в процессе скачивания трогаются только если давно не изменялись.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _is_orphan(self, entry: StorageEntry, task: Optional[DownloadTask], now: float) -> bool:
+        age = now - entry.mtime
+        if age < settings.JANITOR_ORPHAN_GRACE_SECONDS:
+            return False
+        if task is None:
+            return True
+
+        status = task.video_status.status
+        if status == VideoDownloadStatus.PENDING:
+            return age > settings.JANITOR_STALE_PENDING_SECONDS
+        if status == VideoDownloadStatus.COMPLETED:
+            return entry.path != task.filepath
+        return True
+
+    async def run(self) -> JanitorReport:
+        report = JanitorReport()
+        now = time.time()
+        entries = await asyncio.to_thread(scan_download_folder, self.root)
+
+        tasks: dict[str, Optional[DownloadTask]] = {}
+        for entry in entries:
+            if entry.task_id is None:
+                continue
+            if entry.task_id not in tasks:
+                tasks[entry.task_id] = await redis_cache.get_download_task(entry.task_id)
+            if not self._is_orphan(entry, tasks[entry.task_id], now):
+                continue
+            await asyncio.to_thread(_remove_entry, entry.path)
+            report.files_removed += 1
+            report.bytes_reclaimed += entry.size
+
+        if self.root.exists():
+            await asyncio.to_thread(_remove_empty_dirs, self.root)
+
+        for user_id in await redis_cache.list_users():
+            for task_id in await redis_cache.get_user_tasks(user_id):
+                if not await redis_cache.exist_download_task(task_id):
+                    await redis_cache.remove_user_task(user_id, task_id)
+                    report.user_refs_removed += 1
+
+        await redis_cache.incr_janitor_stats(report.files_removed, report.bytes_reclaimed)
+        print(f"Janitor: removed {report.files_removed} entries, reclaimed {report.bytes_reclaimed} bytes, "
+              f"dropped {report.user_refs_removed} stale history refs")
+        return report
+
+
+storage_janitor = StorageJanitor(Path(settings.DOWNLOAD_FOLDER))
+# промежуточные файлы на tmpfs повторяют структуру DOWNLOAD_FOLDER
+scratch_janitor = StorageJanitor(Path(settings.SCRATCH_TMPFS_DIR)) if settings.SCRATCH_TMPFS_DIR else None
@@ -1,32 +1,375 @@
 import asyncio
+import shutil
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Union
 
+from app.config import settings
+from app.exceptions import FFmpegError, FFmpegTimeoutError
+from app.models.bandwidth import bandwidth
 from app.models.cache import redis_cache
+from app.models.probe import MediaInfo, media_probe, probe_key
+from app.models.scratch import scratch_space
 from app.models.types import DownloadTask
 from app.schemas.main import SVideoDownload
-from app.utils.video_utils import cut_media
+from app.utils.ffmpeg import AudioContainer, audio_codec_args, build_ffmpeg_headers_arg, run_ffmpeg
+from app.utils.video_utils import (
+    combine_audio_and_video,
+    cut_media,
+    extract_audio,
+    smart_cut,
+    task_progress,
+)
+from app.utils.transcode import transcoder
+
+# Контейнеры, для которых индекс (moov) переносится в начало файла
+FASTSTART_SUFFIXES = (".mp4", ".m4a", ".mov")
+
+
+async def _run_direct(func, *args, **kwargs):
+    """Вызов в обход ``transcoder.run`` с той же сигнатурой."""
+    return await func(*args, **kwargs)
+
+
+class ClipMode:
+    COPY = "copy"  # по ключевым кадрам, без перекодирования (начало может сдвинуться раньше)
+    SMART = "smart"  # покадрово точно: перекодируются только неполные GOP на границах
+
+
+class AudioSource:
+    """Откуда взят звук для задачи «только аудио» — для учёта трафика."""
+    TRACK = "audio_track"  # отдельная аудиодорожка источника (itag, DASH, HLS-рендиция)
+    VIDEO_STREAM = "video_stream"  # звук вынут ffmpeg из удалённого видеопотока, без локальной копии
+    FULL_DOWNLOAD = "full_download"  # видео скачано целиком и перекодировано
 
 
 class PostPrecess:
+    """Планировщик постобработки скачанных дорожек.
+
+    Склейка видео и аудио, обрезка фрагмента, извлечение звука (копией в m4a/opus или в MP3) и faststart
+    собираются в один вызов ffmpeg — без промежуточных файлов и повторного чтения
+    диска. Если один проход не удался, те же операции выполняются по шагам.
+    """
+
     def __init__(self, task: DownloadTask, download_video: SVideoDownload):
         self.task = task
         self.download_video = download_video
 
+    @property
+    def audio_suffix(self) -> str:
+        """Расширение файла «только аудио» по выбранному контейнеру (по умолчанию MP3)."""
+        return "." + (self.download_video.container or AudioContainer.MP3)
+
+    @property
+    def is_clipped(self) -> bool:
+        return self.download_video.start_seconds is not None or self.download_video.end_seconds is not None
+
+    @property
+    def smart_clip(self) -> bool:
+        return self.is_clipped and self.download_video.clip_mode == ClipMode.SMART
+
+    def clip_duration(self, duration: Optional[float] = None) -> float | None:
+        """Длина фрагмента; ``duration`` — длительность ролика, если в метаданных её нет."""
+        start = self.download_video.start_seconds or 0
+        end = self.download_video.end_seconds
+        if end is None:
+            end = self.task.video_status.video.duration or duration
+        return max(0, end - start) if end else None
+
+    def _trim_args(self, clip_start: Optional[float] = None) -> list[str]:
+        args = []
+        if clip_start is None:
+            clip_start = self.download_video.start_seconds
+        if clip_start is not None:
+            args += ["-ss", str(clip_start)]
+        if self.download_video.end_seconds is not None:
+            args += ["-to", str(self.download_video.end_seconds + 1)]
+        return args
+
+    def plan(self, inputs: Sequence[Union[Path, str]], output: Path, audio_only: bool,
+             input_args: Sequence[str] = (), audio_codec: Optional[str] = None,
+             clip_start: Optional[float] = None) -> list[str]:
+        """Аргументы ffmpeg для одного прохода: вход(ы) с обрезкой, склейка или перекодирование, выход.
+
+        Входом может быть и URL: тогда ffmpeg сам читает из источника только нужный фрагмент.
+        ``audio_codec`` — кодек звука входа, если известен: не подходящий контейнеру перекодируется.
+        ``clip_start`` заменяет начало фрагмента (окно для smart cut начинается с ключевого кадра).
+        """
+        trim = self._trim_args(clip_start)
+        args = []
+        for path in inputs:
+            # обрезка на входе: ffmpeg перематывает каждый вход, не читая лишнее
+            args += [*input_args, *trim, "-i", str(path)]
+        if audio_only:
+            args += ["-vn", *audio_codec_args(output.as_posix(), audio_codec)]
+        elif len(inputs) == 2:
+            args += ["-map", "0:v:0", "-map", "1:a:0", "-c", "copy", "-shortest"]
+        else:
+            args += ["-c", "copy"]
+        if output.suffix.lower() in FASTSTART_SUFFIXES:
+            args += ["-movflags", "+faststart"]
+        return [*args, "-y", output.as_posix()]
+
+    @staticmethod
+    def encodes(output: Path, audio_only: bool) -> bool:
+        """Перекодирует ли ``plan`` звук (проход нагружает CPU, а не только сеть и диск)."""
+        return audio_only and "copy" not in audio_codec_args(output.as_posix())
+
+    def _default_output(self, inputs: list[Path], audio_only: bool) -> Path:
+        source = inputs[0]
+        if audio_only:
+            output = source.with_suffix(self.audio_suffix)
+            return output if output != source else source.with_name(source.stem + "_clip" + source.suffix)
+        if len(inputs) == 2:
+            return source.with_name(source.stem + "_out.mp4")
+        return source.with_name(source.stem + "_clip" + source.suffix)
+
+    def _description(self, inputs: list[Path], audio_only: bool) -> str:
+        if audio_only:
+            return "Converting to MP3" if self.audio_suffix == ".mp3" else "Extracting audio track"
+        if len(inputs) == 2:
+            return "Merging tracks"
+        return "Clipping selected fragment"
+
+    @staticmethod
+    def _small_clip(clip: Optional[float], duration: Optional[float]) -> bool:
+        return bool(duration and clip) and clip / duration <= settings.CLIP_PARTIAL_FETCH_MAX_RATIO
+
+    def should_fetch_clip(self) -> bool:
+        """Стоит ли качать только фрагмент, а не весь ролик.
+
+        Без длительности в метаданных решение откладывается до ``fetch_clip``: там она берётся из ffprobe источника.
+        """
+        if not settings.CLIP_PARTIAL_FETCH or not self.is_clipped or bandwidth.limited:
+            return False
+        duration = self.task.video_status.video.duration
+        return not duration or self._small_clip(self.clip_duration(), duration)
+
+    async def fetch_clip(self,
+                         video_url: str,
+                         audio_url: Optional[str] = None,
+                         output: Path = None,
+                         headers: Optional[Dict[str, str]] = None) -> bool:
+        """Скачивает из источника сразу готовый фрагмент одним проходом ffmpeg.
+
+        ffmpeg по индексу (moov/sidx у MP4, список сегментов у HLS) читает диапазонами
+        только ту часть, что попадает в окно клипа. Длительность (если её нет в метаданных)
+        и дорожки берутся из кэша ffprobe по ссылке ещё до скачивания. Возвращает False,
+        если так не вышло, — тогда парсер качает ролик целиком, как обычно.
+        """
+        inputs = [url for url in (video_url, audio_url) if url]
+        duration = self.task.video_status.video.duration
+        media = await self._remote_media(video_url, headers) if self.smart_clip or not duration else None
+        if not duration:
+            duration = media.duration if media is not None else None
+            if not self._small_clip(self.clip_duration(duration), duration):
+                return False
+        if self.smart_clip:
+            return await self._fetch_smart_clip(inputs, output, headers, media)
+        return await self._fetch_remote(inputs, output, False, headers, "Downloading selected fragment")
+
+    async def _remote_media(self, url: str, headers: Optional[Dict[str, str]]) -> Optional[MediaInfo]:
+        """Сведения об удалённой видеодорожке из кэша ffprobe (ключ — ролик и формат)."""
+        try:
+            return await media_probe.probe_url(url, probe_key(self.download_video.url,
+                                                              self.download_video.video_format_id), headers)
+        except FFmpegError as e:
+            print(f"PostProcess: failed to probe {url}: {e}")
+            return None
+
+    async def _fetch_smart_clip(self, inputs: list[str], output: Path, headers: Optional[Dict[str, str]],
+                                media: Optional[MediaInfo]) -> bool:
+        """Smart cut без полного ролика: копией качается окно от ключевого кадра перед началом, края режутся локально."""
+        if media is None:
+            return False
+        video = media.video or {}
+        if video.get("codec_name") != "h264":
+            # smart cut умеет только H.264 — как и для скачанного файла, режем по ключевым кадрам
+            return await self._fetch_remote(inputs, output, False, headers, "Downloading selected fragment")
+        start = self.download_video.start_seconds or 0
+        try:
+            keyframe = await media_probe.keyframe_before(inputs[0], media, start, headers) if start else 0.0
+        except FFmpegError as e:
+            print(f"PostProcess: failed to find a keyframe in {inputs[0]}: {e}")
+            keyframe = None
+        if keyframe is None:
+            return False
+
+        window = output.with_name(output.stem + "_window" + output.suffix)
+        if not await self._fetch_remote(inputs, window, False, headers, "Downloading selected fragment",
+                                        clip_start=keyframe):
+            return False
+        try:
+            if not await self._smart_cut([window], output, self.clip_duration(media.duration), offset=keyframe):
+                return False
+        finally:
+            window.unlink(missing_ok=True)
+        self.task.filepath = output
+        return True
+
+    async def fetch_audio(self,
+                          url: str,
+                          output: Path,
+                          headers: Optional[Dict[str, str]] = None,
+                          source: str = AudioSource.TRACK) -> bool:
+        """Готовит аудиофайл прямо из удалённого потока: аудиодорожки или, если её нет, видео (``-vn``).
+
+        Видео локально не сохраняется; выбранный фрагмент вырезается в том же проходе.
+        Возвращает False при ошибке ffmpeg или включённых лимитах полосы — тогда парсер идёт обычным путём.
+        """
+        return await self._fetch_remote([url], output, True, headers, "Extracting audio track", source)
+
+    async def _fetch_remote(self, inputs: list[str], output: Path, audio_only: bool,
+                            headers: Optional[Dict[str, str]], description: str,
+                            source: Optional[str] = None, clip_start: Optional[float] = None) -> bool:
+        if bandwidth.limited:
+            # входы ffmpeg читает сам, и ограничить скорость можно только после прогона:
+            # при лимитах полосы парсер качает через Throttle, как обычно
+            return False
+        output.parent.mkdir(parents=True, exist_ok=True)
+        self.task.filepath = output
+        self.task.video_status.description = description
+        await redis_cache.set_download_task(self.task)
+        duration = self.clip_duration() if self.is_clipped else self.task.video_status.video.duration
+        args = self.plan(inputs, output, audio_only, build_ffmpeg_headers_arg(headers), clip_start=clip_start)
+        # копия дорожек упирается в сеть, а перекодирование (например, в MP3) ждёт слот энкодера
+        run = transcoder.run if self.encodes(output, audio_only) else _run_direct
+        try:
+            async with bandwidth.throttle(self.task.id_) as throttle:
+                bytes_read = await run(run_ffmpeg, args, **task_progress(self.task, duration))
+                await throttle.account(bytes_read)
+        except FFmpegError as e:
+            print(f"PostProcess: remote fetch failed for {self.task.id_}, downloading the whole video: {e}")
+            output.unlink(missing_ok=True)
+            return False
+        if audio_only:
+            await self.report_audio(source, bytes_read)
+        return True
+
+    async def report_audio(self, source: str, bytes_read: int) -> None:
+        """Учитывает, сколько байт пришлось скачать ради задачи «только аудио»."""
+        print(f"PostProcess: audio job {self.task.id_} transferred {bytes_read} bytes ({source})")
+        await redis_cache.incr_audio_stats(source, bytes_read)
+
+    async def process(self,
+                      video: Optional[Path] = None,
+                      audio: Optional[Path] = None,
+                      output: Optional[Path] = None,
+                      audio_only: bool = False):
+        """Доводит дорожки до итогового файла и записывает его в ``task.filepath``.
+
+        Без аргументов обрабатывает уже готовый ``task.filepath`` (только обрезка).
+        Входные файлы удаляются после успешной обработки.
+        """
+        inputs = [path for path in (video, audio) if path is not None] or [self.task.filepath]
+        if audio_only:
+            inputs = inputs[-1:]
+        # дорожка уже в нужном контейнере (например, m4a с YouTube) — обрабатывать нечего
+        if len(inputs) == 1 and not self.is_clipped and (not audio_only or inputs[0].suffix == self.audio_suffix):
+            if output is not None and output != inputs[0]:
+                # дорожка может лежать на tmpfs, а rename между томами невозможен
+                await asyncio.to_thread(shutil.move, inputs[0], output)
+                self.task.filepath = output
+            else:
+                self.task.filepath = inputs[0]
+            return
+
+        if output is None or output in inputs:
+            output = self._default_output(inputs, audio_only)
+        self.task.video_status.description = self._description(inputs, audio_only)
+        await redis_cache.set_download_task(self.task)
+
+        duration = self.clip_duration() if self.is_clipped else await self._duration(inputs[0], audio_only)
+        audio_codec = await self._audio_codec(inputs[0]) if audio_only else None
+        if not (self.smart_clip and not audio_only and await self._smart_cut(inputs, output, duration)):
+            try:
+                await transcoder.run(run_ffmpeg, self.plan(inputs, output, audio_only, audio_codec=audio_codec),
+                                     **task_progress(self.task, duration))
+            except FFmpegTimeoutError:
+                output.unlink(missing_ok=True)
+                raise
+            except FFmpegError as e:
+                print(f"PostProcess: single pass failed for {self.task.id_}, falling back to steps: {e}")
+                output.unlink(missing_ok=True)
+                await self._process_in_steps(inputs, output, audio_only, duration, audio_codec)
+
+        for path in inputs:
+            path.unlink(missing_ok=True)
+        self.task.filepath = output
+
+    async def _media(self, path: Path, audio_only: bool = False, keyframes: bool = False) -> Optional[MediaInfo]:
+        """Сведения о скачанной дорожке из кэша ffprobe (ключ — ролик и формат дорожки)."""
+        format_id = self.download_video.audio_format_id if audio_only else self.download_video.video_format_id
+        try:
+            return await media_probe.probe(path.as_posix(), probe_key(self.download_video.url, format_id),
+                                           keyframes=keyframes)
+        except (FFmpegError, OSError) as e:
+            print(f"PostProcess: failed to probe {path}: {e}")
+            return None
+
+    async def _duration(self, path: Path, audio_only: bool) -> Optional[float]:
+        media = await self._media(path, audio_only)
+        return media.duration if media is not None else self.task.video_status.video.duration
+
+    async def _audio_codec(self, path: Path) -> Optional[str]:
+        """Кодек звука дорожки: от него зависит, можно ли скопировать её в выбранный контейнер."""
+        media = await self._media(path, audio_only=True)
+        audio = media.audio if media is not None else None
+        return audio.get("codec_name") if audio else None
+
+    async def _smart_cut(self, inputs: list[Path], output: Path, duration: Optional[float],
+                         offset: float = 0.0) -> bool:
+        """Покадрово точная обрезка; False — не вышло, режем по ключевым кадрам.
+
+        ``offset`` — секунда ролика, с которой начинается входной файл (окно, скачанное от ключевого кадра).
+        """
+        media = await self._media(inputs[0], keyframes=True)
+        if media is None:
+            return False
+        audio = inputs[1].as_posix() if len(inputs) == 2 else None
+        start, end = self.download_video.start_seconds or 0, self.download_video.end_seconds
+        try:
+            await transcoder.run(smart_cut, inputs[0].as_posix(), output.as_posix(), media,
+                                 start - offset, end - offset if end is not None else None, audio,
+                                 **task_progress(self.task, duration))
+        except FFmpegTimeoutError:
+            output.unlink(missing_ok=True)
+            raise
+        except FFmpegError as e:
+            print(f"PostProcess: smart cut failed for {self.task.id_}, cutting at keyframes: {e}")
+            output.unlink(missing_ok=True)
+            return False
+        return True
+
+    def _intermediate(self, output: Path, name: str, size: int) -> Path:
+        """Промежуточный файл шага рядом с результатом или, если он небольшой, на tmpfs."""
+        return scratch_space.stage(self.task.id_, output.with_name(output.stem + name), size)
 
-    async def process(self):
-        await self.clip()
-
-    async def clip(self):
-        if self.download_video.start_seconds is not None or self.download_video.end_seconds is not None:
-            self.task.video_status.description = "Clipping selected fragment"
-            await redis_cache.set_download_task(self.task)
-
-            clipped_path = self.task.filepath.with_name(self.task.filepath.stem + "_clip" + self.task.filepath.suffix)
-            await asyncio.to_thread(
-                cut_media,
-                self.task.filepath.as_posix(),
-                clipped_path.as_posix(),
-                self.download_video.start_seconds,
-                self.download_video.end_seconds,
-            )
-            self.task.filepath.unlink(missing_ok=True)
-            self.task.filepath = clipped_path
+    async def _process_in_steps(self, inputs: list[Path], output: Path, audio_only: bool,
+                                duration: Optional[float], audio_codec: Optional[str] = None) -> None:
+        current = inputs[0]
+        intermediates = []
+        size = sum(path.stat().st_size for path in inputs if path.is_file())
+        try:
+            if len(inputs) == 2:
+                merged = self._intermediate(output, "_merged.mp4", size)
+                await transcoder.run(combine_audio_and_video, current.as_posix(), inputs[1].as_posix(),
+                                     merged.as_posix(), **task_progress(self.task))
+                intermediates.append(merged)
+                current = merged
+            if audio_only:
+                converted = self._intermediate(output, "_converted" + output.suffix, size)
+                await transcoder.run(extract_audio, current.as_posix(), converted.as_posix(), audio_codec,
+                                     **task_progress(self.task))
+                intermediates.append(converted)
+                current = converted
+            if self.is_clipped:
+                clipped = self._intermediate(output, "_clip" + current.suffix, size)
+                await transcoder.run(cut_media, current.as_posix(), clipped.as_posix(),
+                                     self.download_video.start_seconds, self.download_video.end_seconds,
+                                     **task_progress(self.task, duration))
+                intermediates.append(clipped)
+                current = clipped
+            await asyncio.to_thread(shutil.move, current, output)
+        finally:
+            for path in intermediates:
+                path.unlink(missing_ok=True)
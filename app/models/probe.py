@@ -0,0 +1,182 @@
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Optional
+
+from app.config import settings
+from app.exceptions import FFmpegError
+from app.models.cache import redis_cache
+from app.utils.ffmpeg import build_ffmpeg_headers_arg, run_ffprobe
+
+STREAM_FIELDS = "index,codec_type,codec_name,profile,pix_fmt,width,height,r_frame_rate,bit_rate,sample_rate,channels"
+FORMAT_FIELDS = "duration,size,bit_rate,start_time"
+# запас на погрешность времён пакетов при сравнении с границей фрагмента
+SEEK_TOLERANCE = 0.001
+
+
+def _number(value, cast=float):
+    try:
+        return cast(value) if value not in (None, "", "N/A") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def probe_key(url: str, format_id: str) -> str:
+    """Ключ кэша: канонический ID ролика + формат (подписанные ссылки CDN меняются, ролик — нет)."""
+    # services импортирует парсеры, а парсеры — постобработку, поэтому импорт здесь
+    from app.models.services import VideoServicesManager
+    return f"{VideoServicesManager.get_service(url).canonical_id(url)}:{format_id}"
+
+
+@dataclass
+class MediaInfo:
+    duration: Optional[float] = None
+    size: Optional[int] = None
+    bit_rate: Optional[int] = None
+    # время первого пакета контейнера: -ss и индекс ключевых кадров отсчитываются от него
+    start_time: float = 0.0
+    streams: list[dict] = field(default_factory=list)
+    # времена ключевых кадров первой видеодорожки от start_time; None — индекс не строился
+    keyframes: Optional[list[float]] = None
+
+    @property
+    def video(self) -> Optional[dict]:
+        return next((s for s in self.streams if s.get("codec_type") == "video"), None)
+
+    @property
+    def audio(self) -> Optional[dict]:
+        return next((s for s in self.streams if s.get("codec_type") == "audio"), None)
+
+    def keyframes_between(self, start: float, end: float) -> list[float]:
+        return [t for t in self.keyframes or [] if start <= t <= end]
+
+    def to_jsons(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_jsons(cls, json_: str) -> "MediaInfo":
+        return cls(**json.loads(json_))
+
+
+class MediaProbe:
+    """Кэш ffprobe: один запуск на скачанный артефакт или удалённую ссылку.
+
+    Длительность, дорожки, битрейты и (по запросу) индекс ключевых кадров хранятся в
+    Redis по ключу «канонический ID ролика + формат», так что обрезка, конвертация и
+    прогресс повторных задач того же формата не запускают ffprobe заново. У локального
+    файла к ключу добавляется размер: частичные артефакты (фрагмент, недокачанный файл)
+    не перезаписывают запись полного. Для ссылки полный индекс ключевых кадров не
+    строится — это означало бы скачать её целиком; ключевой кадр у границы фрагмента
+    ищется отдельно, в коротком окне (``keyframe_before``).
+    """
+
+    def __init__(self):
+        self.ttl = settings.PROBE_CACHE_TTL_SECONDS
+
+    @staticmethod
+    def _key(name: str) -> str:
+        return redis_cache._get_key(f"probe:{name}")
+
+    async def _count(self, field_: str) -> None:
+        await redis_cache.redis.hincrby(self._key("stats"), field_, 1)
+
+    async def get(self, key: str) -> Optional[MediaInfo]:
+        data = await redis_cache.redis.get(self._key(f"media:{key}"))
+        return MediaInfo.from_jsons(data) if data else None
+
+    async def probe(self, path: str, key: Optional[str] = None, keyframes: bool = False) -> MediaInfo:
+        """Сведения о файле ``path``: из кэша по ``key`` или свежим запуском ffprobe."""
+        if key:
+            key = f"{key}:{os.path.getsize(path)}"
+            info = await self.get(key)
+            if info is not None and (info.keyframes is not None or not keyframes):
+                await self._count("hits")
+                return info
+            await self._count("misses")
+
+        info = await self._run(path)
+        if keyframes:
+            info.keyframes = await self._keyframes(path, info.start_time)
+        if key:
+            await redis_cache.redis.set(self._key(f"media:{key}"), info.to_jsons(), ex=self.ttl)
+        return info
+
+    async def probe_url(self, url: str, key: str, headers: Optional[Dict[str, str]] = None) -> MediaInfo:
+        """Сведения об удалённом потоке до скачивания: ffprobe читает только заголовок и индекс."""
+        info = await self.get(key)
+        if info is not None:
+            await self._count("hits")
+            return info
+        await self._count("misses")
+        info = await self._run(url, headers)
+        await redis_cache.redis.set(self._key(f"media:{key}"), info.to_jsons(), ex=self.ttl)
+        return info
+
+    async def keyframe_before(self,
+                              url: str,
+                              media: MediaInfo,
+                              position: float,
+                              headers: Optional[Dict[str, str]] = None) -> Optional[float]:
+        """Последний ключевой кадр не позже ``position``; None — в окне поиска его нет."""
+        lookback = settings.CLIP_KEYFRAME_LOOKBACK_SECONDS
+        # окно задаётся в абсолютном времени потока, а позиция — от start_time
+        start = media.start_time + max(0.0, position - lookback)
+        end = media.start_time + position + SEEK_TOLERANCE
+        keyframes = await self._keyframes(url, media.start_time, headers, f"{start}%{end}")
+        keyframes = [t for t in keyframes if t <= position + SEEK_TOLERANCE]
+        return keyframes[-1] if keyframes else None
+
+    async def _run(self, source: str, headers: Optional[Dict[str, str]] = None) -> MediaInfo:
+        output = await run_ffprobe([
+            *build_ffmpeg_headers_arg(headers),
+            "-show_entries", f"stream={STREAM_FIELDS}:format={FORMAT_FIELDS}",
+            "-of", "json", source,
+        ])
+        try:
+            data = json.loads(output)
+        except ValueError:
+            raise FFmpegError("ffprobe returned malformed output", 0, output[-500:])
+        media_format = data.get("format", {})
+        streams = []
+        for stream in data.get("streams", []):
+            stream = {k: v for k, v in stream.items() if k in STREAM_FIELDS.split(",")}
+            for name in ("bit_rate", "sample_rate", "channels", "width", "height"):
+                if name in stream:
+                    stream[name] = _number(stream[name], int)
+            streams.append(stream)
+        return MediaInfo(
+            duration=_number(media_format.get("duration")),
+            size=_number(media_format.get("size"), int),
+            bit_rate=_number(media_format.get("bit_rate"), int),
+            start_time=_number(media_format.get("start_time")) or 0.0,
+            streams=streams,
+        )
+
+    @staticmethod
+    async def _keyframes(source: str,
+                         start_time: float = 0.0,
+                         headers: Optional[Dict[str, str]] = None,
+                         interval: Optional[str] = None) -> list[float]:
+        # только флаги пакетов: файл демультиплексируется, но не декодируется;
+        # время не округляется — граница, сдвинутая раньше ключевого кадра, попала бы в копируемый GOP не целиком
+        output = await run_ffprobe([
+            *build_ffmpeg_headers_arg(headers),
+            *(["-read_intervals", interval] if interval else []),
+            "-select_streams", "v:0",
+            "-show_entries", "packet=pts_time,flags",
+            "-of", "csv=p=0", source,
+        ])
+        keyframes = []
+        for line in output.splitlines():
+            pts_time, _, flags = line.partition(",")
+            if "K" in flags and _number(pts_time) is not None:
+                keyframes.append(float(pts_time) - start_time)
+        return sorted(keyframes)
+
+    async def stats(self) -> dict:
+        stats = {k: int(v) for k, v in (await redis_cache.redis.hgetall(self._key("stats"))).items()}
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        return {"hit_rate": round(stats.get("hits", 0) / lookups, 3) if lookups else None, **stats}
+
+
+media_probe = MediaProbe()
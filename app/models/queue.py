@@ -1,8 +1,59 @@
 from typing import Optional
 
-from arq.connections import ArqRedis, RedisSettings, create_pool
+from arq.connections import ArqRedis
+from arq.constants import default_queue_name
+from arq.jobs import Job
 
 from app.config import settings
+from app.models.connections import redis_connections
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoDownload, SVideoResponse
+
+
+class QueueName:
+    EXPRESS = "express"
+    STANDARD = "standard"
+    BULK = "bulk"
+
+
+def arq_queue_name(name: str) -> str:
+    """Имя sorted set очереди arq; standard остаётся очередью по умолчанию для совместимости."""
+    if name == QueueName.STANDARD:
+        return default_queue_name
+    return f"{default_queue_name}:{name}"
+
+
+def estimate_job(video: Optional[SVideoResponse], download: SVideoDownload) -> tuple[int, int]:
+    """Оценивает объём (байты) и длительность (секунды) задачи с учётом фрагмента."""
+    duration = int(video.duration or 0) if video else 0
+    filesize = 0
+    if video:
+        for video_format in video.formats:
+            if (video_format.video_format_id == download.video_format_id and
+                    video_format.audio_format_id == download.audio_format_id):
+                filesize = int(video_format.filesize or 0)
+                break
+
+    if download.start_seconds is not None or download.end_seconds is not None:
+        start = download.start_seconds or 0
+        end = download.end_seconds if download.end_seconds is not None else duration
+        clip = max(0, end - start)
+        if duration > 0 and clip:
+            filesize = int(filesize * min(1.0, clip / duration))
+        duration = clip or duration
+    return filesize, duration
+
+
+def choose_queue(video: Optional[SVideoResponse], download: SVideoDownload) -> str:
+    filesize, duration = estimate_job(video, download)
+    if filesize >= settings.QUEUE_BULK_MIN_BYTES or duration >= settings.QUEUE_BULK_MIN_SECONDS:
+        return QueueName.BULK
+    if filesize == 0 or duration == 0:
+        # размер или длительность неизвестны (нет метаданных, HEAD не удался) — не занимаем express
+        return QueueName.STANDARD
+    if filesize <= settings.QUEUE_EXPRESS_MAX_BYTES and duration <= settings.QUEUE_EXPRESS_MAX_SECONDS:
+        return QueueName.EXPRESS
+    return QueueName.STANDARD
 
 
 class TaskQueue:
@@ -11,16 +62,16 @@ class TaskQueue:
 
     async def get(self) -> ArqRedis:
         if self._pool is None:
-            self._pool = await create_pool(
-                RedisSettings(
-                    host=settings.REDIS_HOST,
-                    port=settings.REDIS_PORT,
-                    database=settings.REDIS_DB,
-                )
-            )
+            self._pool = redis_connections.arq()
         return self._pool
 
-
-task_queue = TaskQueue()
+    async def enqueue_download(self, task: DownloadTask, queue: Optional[str] = None) -> Optional[Job]:
+        """Ставит задачу скачивания в очередь, выбранную по размеру и длительности (или в ``queue``)."""
+        arq = await self.get()
+        queue = queue or choose_queue(task.video_status.video, task.download)
+        return await arq.enqueue_job(
+            "download_video", task.id_, _job_id=task.id_, _queue_name=arq_queue_name(queue)
+        )
 
 
+task_queue = TaskQueue()
@@ -0,0 +1,206 @@
+import math
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from app.config import settings
+from app.exceptions import QuotaExceededException, QuotaTooLargeException, ServiceOverloadedException
+from app.models.cache import redis_cache
+from app.models.queue import QueueName, arq_queue_name, task_queue
+
+
+# Скользящее окно из двух интервалов: предыдущий учитывается с весом, убывающим к концу текущего.
+# KEYS: счётчики; ARGV: window, затем пары (limit, amount) на каждый ключ.
+# Либо списывает amount со всех счётчиков и возвращает {0, 0, номер окна}, либо (если хоть
+# один лимит превышен) ничего не меняет и возвращает {мс до освобождения, номер счётчика}.
+QUOTA_SCRIPT = """
+local window = tonumber(ARGV[1])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local idx = math.floor(now / window)
+local elapsed = now - idx * window
+local weight = 1 - elapsed / window
+
+local counters = {}
+for i, key in ipairs(KEYS) do
+    local limit = tonumber(ARGV[i * 2])
+    local amount = tonumber(ARGV[i * 2 + 1])
+    local s = redis.call('HMGET', key, 'win', 'cur', 'prev')
+    local win = tonumber(s[1]) or idx
+    local cur, prev = tonumber(s[2]) or 0, tonumber(s[3]) or 0
+    if idx > win then
+        if idx == win + 1 then prev = cur else prev = 0 end
+        cur = 0
+    end
+    local need = cur + prev * weight + amount - limit
+    if need > 0 then
+        local wait
+        if amount > limit then
+            wait = window
+        elseif prev * weight >= need then
+            wait = need * window / prev
+        else
+            wait = (window - elapsed) + (need - prev * weight) * window / math.max(cur, 1)
+        end
+        return {math.ceil(wait * 1000), i}
+    end
+    counters[i] = {cur + amount, prev}
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'win', idx, 'cur', tostring(counters[i][1]), 'prev', tostring(counters[i][2]))
+    redis.call('EXPIRE', key, math.ceil(window) * 2)
+end
+return {0, 0, idx}
+"""
+
+# Возврат списанного: ARGV — номер окна списания, затем amount на каждый ключ. Если окно
+# успело смениться, списанное лежит уже в prev.
+REFUND_SCRIPT = """
+local idx = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    local amount = tonumber(ARGV[i + 1])
+    local s = redis.call('HMGET', key, 'win', 'cur', 'prev')
+    local win = tonumber(s[1])
+    if win == idx then
+        redis.call('HSET', key, 'cur', tostring(math.max(0, (tonumber(s[2]) or 0) - amount)))
+    elseif win == idx + 1 then
+        redis.call('HSET', key, 'prev', tostring(math.max(0, (tonumber(s[3]) or 0) - amount)))
+    end
+end
+return 0
+"""
+
+
+class QuotaKind:
+    DOWNLOADS = "downloads"
+    BYTES = "bytes"
+    FORMATS = "formats"
+
+
+@dataclass
+class QuotaCharge:
+    """Списание ``consume``: по нему ``refund`` возвращает квоту отклонённому запросу."""
+    keys: List[str]
+    amounts: List[int]
+    window: int
+
+
+class Quotas:
+    """Лимиты на пользователя и на IP в скользящем окне ``QUOTA_WINDOW_SECONDS``.
+
+    Считаются запуски загрузок, их оценочный объём (по размеру формата и фрагменту) и
+    запросы форматов. Проверка атомарна для всех затронутых счётчиков: отклонённый
+    запрос ничего не списывает, а отказанный уже после списания возвращает его через
+    ``refund``. Запрос больше лимита окна отклоняется сразу ``QuotaTooLargeException``.
+    Лимит 0 выключает счётчик; пользователь «0» (без cookie) ограничивается только по IP.
+    """
+
+    def __init__(self):
+        self._script = None
+        self._refund_script = None
+
+    @staticmethod
+    def limit(kind: str, scope: str) -> int:
+        return getattr(settings, f"QUOTA_{scope.upper()}_{kind.upper()}")
+
+    async def consume(self, user_id: Optional[str], ip: Optional[str],
+                      amounts: dict[str, int]) -> Optional[QuotaCharge]:
+        keys, args, labels = [], [settings.QUOTA_WINDOW_SECONDS], []
+        for scope, subject in (("user", user_id), ("ip", ip)):
+            if not subject or subject == "0":
+                continue
+            for kind, amount in amounts.items():
+                limit = self.limit(kind, scope)
+                if limit <= 0:
+                    continue
+                if amount > limit:
+                    raise QuotaTooLargeException(f"{scope} {kind}", amount, limit)
+                keys.append(redis_cache._get_key(f"quota:{kind}:{scope}:{subject}"))
+                args += [limit, amount]
+                labels.append(f"{scope} {kind}")
+        if not keys:
+            return None
+        if self._script is None:
+            self._script = redis_cache.redis.register_script(QUOTA_SCRIPT)
+        try:
+            wait_ms, index, *window = await self._script(keys=keys, args=args)
+        except Exception as e:
+            # счётчики недоступны — не отказываем в обслуживании
+            print(f"Quotas: failed to check quota: {e}")
+            return None
+        if int(wait_ms):
+            raise QuotaExceededException(labels[int(index) - 1], int(wait_ms) / 1000)
+        return QuotaCharge(keys, args[2::2], int(window[0]))
+
+    async def refund(self, charge: Optional[QuotaCharge]) -> None:
+        if charge is None:
+            return
+        if self._refund_script is None:
+            self._refund_script = redis_cache.redis.register_script(REFUND_SCRIPT)
+        try:
+            await self._refund_script(keys=charge.keys, args=[charge.window, *charge.amounts])
+        except Exception as e:
+            print(f"Quotas: failed to refund quota: {e}")
+
+
+class LoadShedder:
+    """Отклоняет новые загрузки, пока очередь arq не разгрузится.
+
+    Глубина — число задач во всех очередях, отставание — оценка времени их выполнения
+    всеми слотами воркеров (``LOAD_SHED_AVG_JOB_SECONDS`` на задачу). Retry-After —
+    время, за которое очередь опустится до 80% порога.
+    """
+
+    MEASURE_INTERVAL = 1.0
+
+    def __init__(self):
+        self._measured_at = 0.0
+        self._depth = 0
+        self._capacity = 1
+
+    async def _measure(self) -> None:
+        now = time.monotonic()
+        if now - self._measured_at < self.MEASURE_INTERVAL:
+            return
+        self._measured_at = now
+        arq = await task_queue.get()
+        pipe = arq.pipeline(transaction=False)
+        for name in (QueueName.EXPRESS, QueueName.STANDARD, QueueName.BULK):
+            pipe.zcard(arq_queue_name(name))
+        self._depth = sum(await pipe.execute())
+        workers = await redis_cache.get_workers_stats("slots")
+        self._capacity = max(1, sum(w.get("total_slots", 0) for w in workers.values()) or settings.WORKER_MAX_JOBS)
+
+    def backlog_seconds(self, depth: int) -> float:
+        return depth / self._capacity * settings.LOAD_SHED_AVG_JOB_SECONDS
+
+    async def check(self) -> None:
+        max_depth, max_backlog = settings.LOAD_SHED_QUEUE_DEPTH, settings.LOAD_SHED_BACKLOG_SECONDS
+        if max_depth <= 0 and max_backlog <= 0:
+            return
+        try:
+            await self._measure()
+        except Exception as e:
+            print(f"LoadShedder: failed to measure queue depth: {e}")
+            return
+        backlog = self.backlog_seconds(self._depth)
+        if not ((max_depth > 0 and self._depth >= max_depth) or (max_backlog > 0 and backlog >= max_backlog)):
+            return
+        resume_depth = self._depth
+        if max_depth > 0:
+            resume_depth = min(resume_depth, int(max_depth * 0.8))
+        if max_backlog > 0:
+            resume_depth = min(resume_depth, int(max_backlog * 0.8 / settings.LOAD_SHED_AVG_JOB_SECONDS * self._capacity))
+        retry_after = self.backlog_seconds(self._depth - resume_depth)
+        raise ServiceOverloadedException(min(settings.LOAD_SHED_MAX_RETRY_AFTER, max(1, math.ceil(retry_after))))
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._depth,
+            "worker_slots": self._capacity,
+            "backlog_seconds": round(self.backlog_seconds(self._depth), 1),
+        }
+
+
+quotas = Quotas()
+load_shedder = LoadShedder()
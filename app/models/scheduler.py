@@ -0,0 +1,97 @@
+import math
+import os
+import socket
+import time
+from collections import defaultdict
+from typing import Dict
+
+from app.config import settings
+from app.models.cache import redis_cache
+
+
+class ServiceSlots:
+    """Пулы слотов воркера по сервисам со взвешенным справедливым разделением.
+
+    Сервис получает слот, если не превышен его ``max_concurrency`` и он укладывается
+    в свою долю общих слотов (пропорционально весу среди сервисов, у которых есть
+    работа). Сверх доли можно брать слоты, только пока другие сервисы не ждут.
+    Задача, не получившая слот, откладывается через arq ``Retry`` и не занимает ``max_jobs``.
+    """
+
+    WAITING_WINDOW = 30.0
+
+    def __init__(self, total_slots: int):
+        self.total_slots = total_slots
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._in_use: Dict[str, int] = defaultdict(int)
+        self._limits: Dict[str, int] = {}
+        self._weights: Dict[str, int] = {}
+        self._waiting_at: Dict[str, float] = {}
+        self.deferred: Dict[str, int] = defaultdict(int)
+
+    def _register(self, service) -> str:
+        self._limits[service.name] = service.get_max_concurrency()
+        self._weights[service.name] = service.get_weight()
+        return service.name
+
+    def _is_waiting(self, name: str, now: float) -> bool:
+        return now - self._waiting_at.get(name, 0.0) < self.WAITING_WINDOW
+
+    def fair_share(self, name: str, now: float) -> int:
+        active = {n for n, used in self._in_use.items() if used > 0}
+        active |= {n for n in self._waiting_at if self._is_waiting(n, now)}
+        active.add(name)
+        total_weight = sum(self._weights.get(n, 1) for n in active)
+        return max(1, math.floor(self.total_slots * self._weights.get(name, 1) / total_weight))
+
+    def try_acquire(self, service) -> bool:
+        name = self._register(service)
+        now = time.monotonic()
+        in_use = self._in_use[name]
+
+        allowed = in_use < self._limits[name]
+        if allowed and in_use >= self.fair_share(name, now):
+            others_waiting = any(self._is_waiting(n, now) for n in self._waiting_at if n != name)
+            allowed = not others_waiting
+
+        if not allowed:
+            self._waiting_at[name] = now
+            self.deferred[name] += 1
+            return False
+        self._in_use[name] += 1
+        self._waiting_at.pop(name, None)
+        return True
+
+    def release(self, service) -> None:
+        self._in_use[service.name] = max(0, self._in_use[service.name] - 1)
+
+    @staticmethod
+    def defer_seconds(job_try: int) -> float:
+        return min(30.0, 2.0 * max(1, job_try))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "worker_id": self.worker_id,
+            "total_slots": self.total_slots,
+            "services": {
+                name: {
+                    "in_use": self._in_use.get(name, 0),
+                    "max_concurrency": limit,
+                    "weight": self._weights.get(name, 1),
+                    "fair_share": self.fair_share(name, now),
+                    "waiting": self._is_waiting(name, now),
+                    "deferred": self.deferred.get(name, 0),
+                }
+                for name, limit in self._limits.items()
+            },
+        }
+
+    async def publish(self) -> None:
+        try:
+            await redis_cache.set_worker_stats(self.worker_id, "slots", self.stats())
+        except Exception as e:
+            print(f"ServiceSlots: failed to publish stats: {e}")
+
+
+service_slots = ServiceSlots(settings.WORKER_MAX_JOBS)
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import shutil
+import socket
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional
+
+from app.config import settings
+from app.models.cache import redis_cache
+from app.models.janitor import scan_download_folder
+from app.models.queue import estimate_job
+from app.models.types import DownloadTask
+
+
+@dataclass
+class Reservation:
+    task_id: str
+    reserved: int
+    # ID, под которыми задача пишет файлы: сама задача и общее задание inflight
+    owners: set[str] = field(default_factory=set)
+    used: int = 0
+    peak: int = 0
+    staged: int = 0
+
+    @property
+    def outstanding(self) -> int:
+        """Сколько задача ещё может дописать на диск сверх уже записанного."""
+        return max(0, self.reserved - self.used)
+
+    def stats(self) -> dict:
+        return {"reserved": self.reserved, "used": self.used, "peak": self.peak, "tmpfs": self.staged}
+
+
+class ScratchSpace:
+    """Допуск задач по свободному месту в DOWNLOAD_FOLDER и размещение промежуточных файлов.
+
+    Перед стартом задача резервирует оценку своего объёма (размер формата ×
+    ``SCRATCH_RESERVE_FACTOR``: дорожки и результат лежат на диске одновременно).
+    Резерв выдаётся, если свободного места хватает с учётом того, что ещё допишут
+    запущенные задачи, и запаса ``SCRATCH_MIN_FREE_BYTES``; иначе задача ждёт через
+    arq ``Retry``, как при занятых слотах. Небольшие промежуточные файлы (аудиодорожки,
+    шаги постобработки) можно держать на tmpfs (``SCRATCH_TMPFS_DIR``) в пределах
+    ``SCRATCH_TMPFS_MAX_BYTES`` на воркер.
+
+    Резервы живут в памяти процесса: DOWNLOAD_FOLDER должен принадлежать одному
+    процессу воркера (все его очереди arq работают в нём). Обход каталога кэшируется на
+    ``SCRATCH_SCAN_TTL_SECONDS`` — резервы, выданные после замера, учтены в ``outstanding``.
+    """
+
+    RECENT_JOBS = 20
+
+    def __init__(self, root: Path, tmpfs: Optional[Path]):
+        self.root = root
+        self.tmpfs = tmpfs
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._reservations: Dict[str, Reservation] = {}
+        self._owners: Dict[str, Reservation] = {}
+        self._staged = 0
+        self._scan_lock = asyncio.Lock()
+        self._scanned: Optional[tuple[Dict[str, int], int, int]] = None
+        self._scanned_at = 0.0
+        self.admitted = 0
+        self.deferred = 0
+        self._recent: deque = deque(maxlen=self.RECENT_JOBS)
+
+    @staticmethod
+    def estimate(task: DownloadTask) -> int:
+        """Оценка места под задачу; фрагмент не учитывается — ролик обычно качается целиком."""
+        if task.download is None:
+            return 0
+        download = task.download.model_copy(update={"start_seconds": None, "end_seconds": None})
+        filesize, _ = estimate_job(task.video_status.video, download)
+        return int(filesize * settings.SCRATCH_RESERVE_FACTOR)
+
+    def _scan(self) -> tuple[Dict[str, int], int, int]:
+        """Занятое задачами по ID и (свободно, всего) байт на томе DOWNLOAD_FOLDER."""
+        usage = defaultdict(int)
+        for entry in scan_download_folder(self.root):
+            if entry.task_id is not None:
+                usage[entry.task_id] += entry.size
+        disk = shutil.disk_usage(self.root)
+        return usage, disk.free, disk.total
+
+    async def _cached_scan(self) -> tuple[Dict[str, int], int, int]:
+        """``_scan`` не чаще раза в ``SCRATCH_SCAN_TTL_SECONDS``; одновременные вызовы ждут один обход."""
+        async with self._scan_lock:
+            if self._scanned is None or time.monotonic() - self._scanned_at >= settings.SCRATCH_SCAN_TTL_SECONDS:
+                self._scanned = await asyncio.to_thread(self._scan)
+                self._scanned_at = time.monotonic()
+            return self._scanned
+
+    def _apply_usage(self, usage: Dict[str, int]) -> None:
+        for reservation in self._reservations.values():
+            reservation.used = sum(usage.get(owner, 0) for owner in reservation.owners)
+            reservation.peak = max(reservation.peak, reservation.used)
+
+    async def reserve(self, task_id: str, bytes_: int) -> bool:
+        """Резервирует ``bytes_`` под задачу; False — места пока нет, задачу стоит отложить."""
+        if task_id in self._reservations:
+            return True
+        usage, free, total = await self._cached_scan()
+        # между замером и записью резерва нет await: задачи процесса не обгоняют друг друга
+        self._apply_usage(usage)
+        outstanding = sum(r.outstanding for r in self._reservations.values())
+        available = free - outstanding - settings.SCRATCH_MIN_FREE_BYTES
+        # задаче больше места, чем есть на томе вообще, ждать бессмысленно — пусть пробует
+        if bytes_ > available and bytes_ <= total - settings.SCRATCH_MIN_FREE_BYTES:
+            self.deferred += 1
+            await self.publish(free)
+            return False
+        reservation = Reservation(task_id, bytes_, owners={task_id})
+        self._reservations[task_id] = reservation
+        self._owners[task_id] = reservation
+        self.admitted += 1
+        await self.publish(free)
+        return True
+
+    def track(self, task_id: str, owner: str) -> None:
+        """Файлы задачи пишутся ещё и под ``owner`` (ID общего задания inflight)."""
+        reservation = self._reservations.get(task_id)
+        if reservation is not None:
+            reservation.owners.add(owner)
+            self._owners[owner] = reservation
+
+    async def release(self, task_id: str) -> None:
+        reservation = self._reservations.pop(task_id, None)
+        if reservation is None:
+            return
+        for owner in reservation.owners:
+            self._owners.pop(owner, None)
+        self._staged -= reservation.staged
+        usage, free, _ = await self._cached_scan()
+        # файлы задачи могли быть удалены или перенесены: следующий допуск замеряет диск заново
+        self._scanned = None
+        reservation.used = sum(usage.get(owner, 0) for owner in reservation.owners)
+        reservation.peak = max(reservation.peak, reservation.used)
+        self._recent.append({"task_id": task_id, **reservation.stats()})
+        print(f"ScratchSpace: {task_id} reserved {reservation.reserved} bytes, used {reservation.used} "
+              f"(peak seen {reservation.peak}), staged {reservation.staged} on tmpfs")
+        await self.publish(free)
+
+    def stage(self, owner: str, path: Path, size: Optional[int]) -> Path:
+        """Путь для промежуточного файла: на tmpfs, если он небольшой и там есть место, иначе ``path``.
+
+        ``path`` — место файла в DOWNLOAD_FOLDER; на tmpfs сохраняется та же структура
+        каталогов, так что имя с ID задачи видит и janitor.
+        """
+        reservation = self._owners.get(owner)
+        if self.tmpfs is None or reservation is None or not size:
+            return path
+        try:
+            staged = self.tmpfs / path.relative_to(self.root)
+        except ValueError:
+            return path
+        if staged.exists():
+            # докачка файла, уже начатого на tmpfs
+            return staged
+        if (path.exists() or size > settings.SCRATCH_TMPFS_MAX_FILE_BYTES or
+                self._staged + size > settings.SCRATCH_TMPFS_MAX_BYTES):
+            return path
+        staged.parent.mkdir(parents=True, exist_ok=True)
+        reservation.staged += size
+        self._staged += size
+        return staged
+
+    def stats(self, free: Optional[int] = None) -> dict:
+        return {
+            "free_bytes": free,
+            "reserved_bytes": sum(r.reserved for r in self._reservations.values()),
+            "outstanding_bytes": sum(r.outstanding for r in self._reservations.values()),
+            "tmpfs_bytes": self._staged,
+            "admitted": self.admitted,
+            "deferred": self.deferred,
+            "jobs": {task_id: r.stats() for task_id, r in self._reservations.items()},
+            "recent": list(self._recent),
+        }
+
+    async def publish(self, free: Optional[int] = None) -> None:
+        try:
+            await redis_cache.set_worker_stats(self.worker_id, "scratch", self.stats(free))
+        except Exception as e:
+            print(f"ScratchSpace: failed to publish stats: {e}")
+
+
+scratch_space = ScratchSpace(
+    Path(settings.DOWNLOAD_FOLDER),
+    Path(settings.SCRATCH_TMPFS_DIR) if settings.SCRATCH_TMPFS_DIR else None,
+)
@@ -1,6 +1,10 @@
+import re
+from urllib.parse import urlsplit
+
 from fastapi import HTTPException
 from starlette import status
 
+from app.config import settings
 from app.parsers import YouTubeParser, InstagramParser, VkParser, RutubeParser, TikTokParser
 
 
@@ -8,28 +12,67 @@ class VideoServiceBase:
     name = "VideoService"
     key_words = list()
     parser = None
+    # Сколько задач сервиса воркер выполняет одновременно и его вес при делении слотов
+    max_concurrency = 4
+    weight = 1
+    # Регулярки, извлекающие ID ролика из ссылки (первая группа)
+    id_patterns: list[str] = []
+    # Хосты API/CDN, кроме хоста самой ссылки, от которых зависит загрузка (для автомата защиты)
+    upstream_hosts: list[str] = []
 
     @classmethod
     def match_url(cls, url: str) -> bool:
         return any(keyword in url for keyword in cls.key_words)
 
+    @classmethod
+    def canonical_id(cls, url: str) -> str:
+        """Канонический ID ролика: одинаковый для разных вариантов ссылки на одно видео."""
+        for pattern in cls.id_patterns:
+            match = re.search(pattern, url)
+            if match:
+                return f"{cls.name}:{match.group(1)}"
+        parts = urlsplit(url.strip())
+        host = parts.netloc.lower().removeprefix("www.").removeprefix("m.")
+        return f"{cls.name}:{host}{parts.path.rstrip('/')}"
+
+    @classmethod
+    def circuit_hosts(cls, url: str) -> list[str]:
+        return [url, *cls.upstream_hosts]
+
+    @classmethod
+    def get_max_concurrency(cls) -> int:
+        return max(1, settings.SERVICE_CONCURRENCY.get(cls.name, cls.max_concurrency))
+
+    @classmethod
+    def get_weight(cls) -> int:
+        return max(1, settings.SERVICE_WEIGHTS.get(cls.name, cls.weight))
+
 
 class YoutubeVideoService(VideoServiceBase):
     name = "YouTube"
     key_words = ['youtube', 'youtu.be', 'shorts']
     parser = YouTubeParser
+    id_patterns = [r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]{11})"]
+    max_concurrency = 4
+    weight = 2
 
 
 class InstagramVideoService(VideoServiceBase):
     name = "Instagram"
     key_words = ['instagram', 'reels']
     parser = InstagramParser
+    id_patterns = [r"/(?:p|reel|reels|tv)/([\w-]+)"]
+    max_concurrency = 4
+    weight = 2
 
 
 class VkVideoService(VideoServiceBase):
     name = "VK"
     key_words = ['vkvideo', 'vk.com/video', 'vk.com/club', 'vk.com/clip']
     parser = VkParser
+    id_patterns = [r"(?:video|clip)(-?\d+_\d+)"]
+    max_concurrency = 3
+    weight = 2
 
 
 class RutubeVideoService(VideoServiceBase):
@@ -42,6 +85,13 @@ class RutubeVideoService(VideoServiceBase):
         'rutube.ru/embed',
     ]
     parser = RutubeParser
+    id_patterns = [
+        r"rutube\.ru/video/([a-zA-Z0-9\-]+)",
+        r"rutube\.ru/(?:play/embed|play/private|embed)/([a-zA-Z0-9\-]+)",
+    ]
+    # HLS-загрузки держат процесс ffmpeg на всё время скачивания
+    max_concurrency = 2
+    weight = 1
 
 
 class TikTokVideoService(VideoServiceBase):
@@ -52,6 +102,10 @@ class TikTokVideoService(VideoServiceBase):
         'vt.tiktok.com',
     ]
     parser = TikTokParser
+    id_patterns = [r"/video/(\d+)"]
+    upstream_hosts = ["tikwm.com"]
+    max_concurrency = 6
+    weight = 3
 
 
 class VideoServicesManager:
@@ -0,0 +1,222 @@
+import asyncio
+import time
+import uuid
+from typing import Optional
+
+from app.config import settings
+from app.models.cache import redis_cache
+from app.models.inflight import inflight_jobs, job_signature, link_or_copy
+from app.models.queue import QueueName, estimate_job, task_queue
+from app.models.services import VideoServicesManager
+from app.models.status import VideoDownloadStatus
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoDownload, SVideoResponse, SVideoStatus
+
+# Владелец спекулятивных задач: получает одну долю полосы, как обычный пользователь
+SPECULATIVE_USER = "speculative"
+
+
+class PickKind:
+    AUDIO = "audio"
+    BEST = "best"
+    OTHER = "other"
+
+
+def best_video_format(video: SVideoResponse):
+    video_formats = [f for f in video.formats if f.video_format_id]
+    return max(video_formats, key=lambda f: f.filesize or 0, default=None)
+
+
+def classify_pick(video: SVideoResponse, download: SVideoDownload) -> str:
+    if not download.video_format_id:
+        return PickKind.AUDIO
+    best = best_video_format(video)
+    if best is not None and best.video_format_id == download.video_format_id:
+        return PickKind.BEST
+    return PickKind.OTHER
+
+
+class SpeculativePrefetch:
+    """Начинает скачивать самый вероятный формат, пока пользователь выбирает его в списке.
+
+    После get-formats по статистике выборов сервиса (лучшее MP4 или «только аудио»)
+    ставится спекулятивная задача в очередь bulk. Она идёт через ``inflight_jobs``,
+    поэтому настоящая загрузка того же формата просто присоединяется к ней, а если
+    спекуляция уже закончилась — забирает готовый файл (``claim``). Выбор другого
+    формата отменяет спекуляцию сразу, невостребованная отменяется через
+    ``SPECULATIVE_TTL_SECONDS``. Бюджет — размер файла и число одновременных спекуляций
+    (``spec:active``): спекуляция выходит из него, когда её задание завершилось или его
+    забрал пользователь; срок жизни файла отдельно ведёт ``spec:expiry``.
+    """
+
+    def __init__(self):
+        self.enabled = settings.SPECULATIVE_PREFETCH and settings.INFLIGHT_DEDUP
+        self.ttl = settings.SPECULATIVE_TTL_SECONDS
+
+    @staticmethod
+    def _key(name: str) -> str:
+        return redis_cache._get_key(f"spec:{name}")
+
+    async def _count(self, field: str, amount: int = 1) -> None:
+        await redis_cache.redis.hincrby(self._key("stats"), field, amount)
+
+    async def record_pick(self, service, video: SVideoResponse, download: SVideoDownload) -> None:
+        await redis_cache.redis.hincrby(self._key(f"picks:{service.name}"), classify_pick(video, download), 1)
+
+    async def predict(self, service, video: SVideoResponse) -> Optional[SVideoDownload]:
+        picks = {k: int(v) for k, v in (await redis_cache.redis.hgetall(self._key(f"picks:{service.name}"))).items()}
+        total = sum(picks.values())
+        if total < settings.SPECULATIVE_MIN_SAMPLES:
+            return None
+        kind = max((PickKind.AUDIO, PickKind.BEST), key=lambda k: picks.get(k, 0))
+        if picks.get(kind, 0) / total < settings.SPECULATIVE_MIN_SHARE:
+            return None
+        if kind == PickKind.AUDIO:
+            audio = next((f for f in video.formats if not f.video_format_id), None)
+            if audio is None:
+                return None
+            return SVideoDownload(url=video.url, video_format_id="", audio_format_id=audio.audio_format_id,
+                                  container=audio.container)
+        best = best_video_format(video)
+        if best is None:
+            return None
+        return SVideoDownload(url=video.url, video_format_id=best.video_format_id,
+                              audio_format_id=best.audio_format_id)
+
+    async def maybe_start(self, url: str, video: SVideoResponse) -> None:
+        """Вызывается фоном после get-formats; любые ошибки только логируются."""
+        if not self.enabled:
+            return
+        try:
+            await self._start(url, video)
+        except Exception as e:
+            print(f"SpeculativePrefetch: failed to start for {url}: {e}")
+
+    async def _start(self, url: str, video: SVideoResponse) -> None:
+        service = VideoServicesManager.get_service(url)
+        download = await self.predict(service, video.model_copy(update={"url": url}))
+        if download is None:
+            return
+        filesize, _ = estimate_job(video, download)
+        if not filesize or filesize > settings.SPECULATIVE_MAX_BYTES:
+            await self._count("skipped_budget")
+            return
+        if await redis_cache.redis.zcard(self._key("active")) >= settings.SPECULATIVE_MAX_ACTIVE:
+            await self._count("skipped_budget")
+            return
+        signature = job_signature(service, download)
+        spec_id = str(uuid.uuid4())
+        if not await redis_cache.redis.set(self._key(f"url:{service.canonical_id(url)}"), spec_id,
+                                           ex=self.ttl, nx=True):
+            return
+        await redis_cache.redis.set(self._key(f"sig:{signature}"), spec_id, ex=self.ttl)
+        await redis_cache.redis.zadd(self._key("active"), {spec_id: time.time() + self.ttl})
+        await redis_cache.redis.zadd(self._key("expiry"), {spec_id: time.time() + self.ttl})
+
+        task = DownloadTask(SVideoStatus(
+            task_id=spec_id,
+            status=VideoDownloadStatus.PENDING,
+            video=video,
+            created_at=time.time(),
+        ), download=download)
+        await redis_cache.set_download_task(task)
+        await redis_cache.set_task_user(spec_id, SPECULATIVE_USER)
+        await task_queue.enqueue_download(task, queue=QueueName.BULK)
+        await self._count("started")
+
+    async def resolve(self, service, download: SVideoDownload) -> None:
+        """Пользователь выбрал формат: засчитывает попадание или отменяет спекуляцию по этой ссылке."""
+        if not self.enabled:
+            return
+        spec_id = await redis_cache.redis.get(self._key(f"url:{service.canonical_id(download.url)}"))
+        if not spec_id:
+            return
+        if await redis_cache.redis.get(self._key(f"sig:{job_signature(service, download)}")) == spec_id:
+            if await redis_cache.redis.set(self._key(f"hit:{spec_id}"), "1", ex=self.ttl, nx=True):
+                await self._count("hits")
+                # загрузку теперь ждёт пользователь, бюджет спекуляций она больше не занимает
+                await self.finished(spec_id)
+            return
+        await self._count("misses")
+        await self.cancel(spec_id)
+
+    async def claim(self, task: DownloadTask, signature: str) -> bool:
+        """Отдаёт задаче уже скачанный спекуляцией файл того же формата."""
+        if not self.enabled:
+            return False
+        spec_id = await redis_cache.redis.get(self._key(f"sig:{signature}"))
+        if not spec_id or spec_id == task.id_:
+            return False
+        spec = await redis_cache.get_download_task(spec_id)
+        if (spec is None or spec.video_status.status != VideoDownloadStatus.COMPLETED or
+                not spec.filepath or not spec.filepath.is_file()):
+            return False
+        source = spec.filepath
+        target = source.with_name(source.name.replace(spec_id, task.id_, 1))
+        try:
+            await asyncio.to_thread(link_or_copy, source, target)
+        except OSError as e:
+            print(f"SpeculativePrefetch: failed to reuse {source}: {e}")
+            return False
+        task.filepath = target
+        task.video_status.status = VideoDownloadStatus.COMPLETED
+        task.video_status.percent = 100
+        task.video_status.description = VideoDownloadStatus.COMPLETED
+        await redis_cache.set_download_task(task)
+        await self.finished(spec_id)
+        return True
+
+    async def finished(self, spec_id: str) -> None:
+        """Освобождает место спекуляции в бюджете; файл остаётся до ``expire``."""
+        await redis_cache.redis.zrem(self._key("active"), spec_id)
+
+    async def cancel(self, spec_id: str) -> None:
+        """Останавливает спекуляцию и удаляет её файл; невостребованные байты учитываются как потерянные."""
+        spec = await redis_cache.get_download_task(spec_id)
+        hit = await redis_cache.redis.exists(self._key(f"hit:{spec_id}"))
+        await redis_cache.redis.zrem(self._key("active"), spec_id)
+        await redis_cache.redis.zrem(self._key("expiry"), spec_id)
+        if spec is None:
+            return
+        if spec.download is not None:
+            service = VideoServicesManager.get_service(spec.download.url)
+            for key in (f"url:{service.canonical_id(spec.download.url)}",
+                        f"sig:{job_signature(service, spec.download)}"):
+                await redis_cache.redis.eval(
+                    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0",
+                    1, self._key(key), spec_id,
+                )
+        if not hit:
+            filesize, _ = estimate_job(spec.video_status.video, spec.download) if spec.download else (0, 0)
+            wasted = filesize if spec.video_status.status == VideoDownloadStatus.COMPLETED \
+                else int(filesize * (spec.video_status.percent or 0) / 100)
+            await self._count("wasted_bytes", wasted)
+
+        job_id = await inflight_jobs.release(spec_id)
+        if job_id:
+            await redis_cache.set_task_canceled(job_id)
+        if spec.filepath and spec.filepath.is_file():
+            spec.filepath.unlink(missing_ok=True)
+        await redis_cache.delete_download_task(spec_id)
+
+    async def expire(self) -> int:
+        """Отменяет спекуляции старше ``SPECULATIVE_TTL_SECONDS`` (вызывается cron-задачей воркера)."""
+        expired = await redis_cache.redis.zrangebyscore(self._key("expiry"), "-inf", time.time())
+        for spec_id in expired:
+            if not await redis_cache.redis.exists(self._key(f"hit:{spec_id}")):
+                await self._count("misses")
+            await self.cancel(spec_id)
+        return len(expired)
+
+    async def stats(self) -> dict:
+        stats = {k: int(v) for k, v in (await redis_cache.redis.hgetall(self._key("stats"))).items()}
+        resolved = stats.get("hits", 0) + stats.get("misses", 0)
+        return {
+            "enabled": self.enabled,
+            "active": await redis_cache.redis.zcard(self._key("active")),
+            "hit_rate": round(stats.get("hits", 0) / resolved, 3) if resolved else None,
+            **stats,
+        }
+
+
+speculative_prefetch = SpeculativePrefetch()
@@ -27,7 +27,10 @@ class DownloadTask:
 
     @classmethod
     def from_jsons(cls, json_: str) -> "DownloadTask":
-        task_data = json.loads(json_)
+        return cls.from_json(json.loads(json_))
+
+    @classmethod
+    def from_json(cls, task_data: dict) -> "DownloadTask":
         return cls(
             video_status=SVideoStatus.model_validate(task_data["video_status"]),
             filepath=Path(task_data.get("filepath", "")),
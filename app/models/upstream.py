@@ -0,0 +1,171 @@
+import asyncio
+import random
+import uuid
+from contextlib import suppress
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from app.config import settings
+from app.exceptions import UpstreamUnavailableException
+from app.models.cache import redis_cache
+
+
+# KEYS: leases (zset: lease id -> срок действия); ARGV: limit, min, ttl, ids...
+# Выдаёт столько соединений, сколько свободно (до числа переданных ID), но не меньше min — иначе ничего.
+ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local free = tonumber(ARGV[1]) - redis.call('ZCARD', KEYS[1])
+local wanted = #ARGV - 3
+local granted = math.min(free, wanted)
+if granted < tonumber(ARGV[2]) then
+    return 0
+end
+for i = 1, granted do
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[3 + i])
+end
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3])) * 2)
+return granted
+"""
+
+# KEYS: leases; ARGV: ttl, ids... Продлевает только ещё живые аренды
+RENEW_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local renewed = 0
+for i = 2, #ARGV do
+    renewed = renewed + redis.call('ZADD', KEYS[1], 'XX', 'CH', now + tonumber(ARGV[1]), ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[1])) * 2)
+return renewed
+"""
+
+
+def upstream_host(url_or_host: str) -> str:
+    """Хост, по которому считается бюджет: имя из URL или группа из ``UPSTREAM_HOST_GROUPS``.
+
+    В отличие от автомата защиты, узлы CDN не склеиваются по домену: у каждого свой бюджет,
+    если группа не задана явно (``{"googlevideo.com": "googlevideo.com"}``).
+    """
+    host = urlsplit(url_or_host).hostname if "//" in url_or_host else url_or_host
+    host = (host or "").lower().rstrip(".")
+    for suffix, group in settings.UPSTREAM_HOST_GROUPS.items():
+        if host == suffix or host.endswith("." + suffix):
+            return group
+    return host
+
+
+class ConnectionLease:
+    """Аренда соединений к одному хосту: ``count`` — сколько параллельных запросов разрешено."""
+
+    def __init__(self, budget: "UpstreamConnections", host: str, want: int, min_count: int):
+        self.budget = budget
+        self.host = host
+        self.want = want
+        self.min_count = min(min_count, want)
+        self.ids: List[str] = []
+        self._renewer = None
+
+    @property
+    def count(self) -> int:
+        # без Redis (ids пусты после сбоя) не ограничиваем
+        return len(self.ids) or self.want
+
+    async def __aenter__(self) -> "ConnectionLease":
+        self.ids = await self.budget.acquire(self.host, self.want, self.min_count)
+        if self.ids:
+            self._renewer = asyncio.create_task(self._renew())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._renewer is not None:
+            self._renewer.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._renewer
+        await self.budget.release(self.host, self.ids)
+
+    async def _renew(self) -> None:
+        while True:
+            await asyncio.sleep(self.budget.ttl / 3)
+            try:
+                await self.budget.renew(self.host, self.ids)
+            except Exception as e:
+                print(f"UpstreamConnections: failed to renew lease on {self.host}: {e}")
+
+
+class UpstreamConnections:
+    """Общий на все реплики бюджет одновременных соединений к каждому хосту-источнику.
+
+    Соединения выдаются арендами с TTL в Redis (ZSET с временем истечения), которые
+    держатель продлевает, пока качает, — аренды упавшего воркера освобождаются сами.
+    Запросивший несколько соединений получает столько, сколько сейчас свободно, и
+    подстраивает под это свою параллельность; если нет даже ``min_count``, ждёт.
+    Бюджет ведётся по имени хоста (см. ``upstream_host``); лимит — ``UPSTREAM_HOST_CONNECTIONS[host]``
+    или ``UPSTREAM_CONNECTIONS_PER_HOST``.
+    """
+
+    def __init__(self):
+        self.ttl = settings.UPSTREAM_LEASE_TTL_SECONDS
+        self._scripts = {}
+
+    @staticmethod
+    def _key(host: str) -> str:
+        return redis_cache._get_key(f"upstream:conns:{host}")
+
+    @staticmethod
+    def limit(host: str) -> int:
+        return max(1, settings.UPSTREAM_HOST_CONNECTIONS.get(host, settings.UPSTREAM_CONNECTIONS_PER_HOST))
+
+    async def _call(self, script: str, keys: List[str], args: list) -> int:
+        if script not in self._scripts:
+            self._scripts[script] = redis_cache.redis.register_script(script)
+        return int(await self._scripts[script](keys=keys, args=args))
+
+    def lease(self, url: str, want: int = 1, min_count: int = 1) -> ConnectionLease:
+        """``async with upstream_connections.lease(url, want=n) as lease`` — качать в ``lease.count`` потоков."""
+        return ConnectionLease(self, upstream_host(url), max(1, want), max(1, min_count))
+
+    async def acquire(self, host: str, want: int, min_count: int) -> List[str]:
+        ids = [str(uuid.uuid4()) for _ in range(want)]
+        limit = self.limit(host)
+        min_count = min(min_count, limit)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.UPSTREAM_LEASE_WAIT_SECONDS
+        delay = settings.UPSTREAM_LEASE_POLL_SECONDS
+        while True:
+            try:
+                granted = await self._call(ACQUIRE_SCRIPT, [self._key(host)], [limit, min_count, self.ttl, *ids])
+            except Exception as e:
+                # без Redis бюджет не соблюдается, но загрузки не останавливаются
+                print(f"UpstreamConnections: failed to lease connections to {host}: {e}")
+                return []
+            if granted:
+                return ids[:granted]
+            if loop.time() >= deadline:
+                # бюджет хоста занят надолго: задание отложится так же, как при открытом автомате
+                raise UpstreamUnavailableException(host, settings.UPSTREAM_LEASE_WAIT_SECONDS)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 5.0)
+
+    async def renew(self, host: str, ids: List[str]) -> None:
+        await self._call(RENEW_SCRIPT, [self._key(host)], [self.ttl, *ids])
+
+    async def release(self, host: str, ids: List[str]) -> None:
+        if not ids:
+            return
+        try:
+            await redis_cache.redis.zrem(self._key(host), *ids)
+        except Exception as e:
+            print(f"UpstreamConnections: failed to release connections to {host}: {e}")
+
+    async def stats(self) -> Dict[str, dict]:
+        prefix = redis_cache._get_key("upstream:conns:")
+        result = {}
+        async for key in redis_cache.redis.scan_iter(f"{prefix}*"):
+            host = key[len(prefix):]
+            result[host] = {"leased": await redis_cache.redis.zcard(key), "limit": self.limit(host)}
+        return result
+
+
+upstream_connections = UpstreamConnections()
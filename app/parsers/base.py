@@ -1,6 +1,8 @@
 from abc import ABC, abstractmethod
+from typing import Optional, Sequence
 
-from app.schemas.main import SVideoResponse, SVideoDownload
+from app.schemas.main import SVideoFormat, SVideoResponse, SVideoDownload
+from app.utils.ffmpeg import AudioContainer
 
 
 class BaseParser(ABC):
@@ -17,4 +19,18 @@ class BaseParser(ABC):
 
     @abstractmethod
     async def download(self, task_id: str, download_video: SVideoDownload):
-        ...
\ No newline at end of file
+        ...
+
+    @staticmethod
+    def audio_formats(audio_format_id: str, filesize: Optional[int],
+                      containers: Sequence[str] = (AudioContainer.M4A, AudioContainer.MP3)) -> list[SVideoFormat]:
+        """Варианты «только аудио»: первыми идут контейнеры без перекодирования — они готовы быстрее."""
+        return [
+            SVideoFormat(
+                quality=f"Audio only ({container.upper()})",
+                video_format_id="",
+                audio_format_id=audio_format_id,
+                filesize=filesize,
+                container=container,
+            ) for container in containers
+        ]
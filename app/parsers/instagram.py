@@ -3,21 +3,28 @@ import asyncio
 import aiofiles
 import time
 from pathlib import Path
+from typing import Optional
 
 import aiohttp
 from dataclasses import dataclass
 from bs4 import BeautifulSoup
 
 from app.config import settings
+from app.models.bandwidth import bandwidth
 from app.models.cache import redis_cache
-from app.models.post_process import PostPrecess
+from app.models.circuit import circuit_breaker
+from app.models.drain import worker_drain
+from app.models.post_process import AudioSource, PostPrecess
+from app.models.scratch import scratch_space
 from app.models.status import VideoDownloadStatus
 from app.models.types import DownloadTask
+from app.models.upstream import upstream_connections
 
 from app.parsers.base import BaseParser
 from app.schemas.main import SVideoResponse, SVideoDownload, SVideoFormat
+from app.utils.helpers import range_already_complete, range_headers
 from app.utils.validators_utils import fallback_background_task
-from app.utils.video_utils import save_preview_on_s3, convert_to_mp3
+from app.utils.video_utils import save_preview_on_s3
 import re
 
 
@@ -30,6 +37,9 @@ class InstagramVideo:
     quality: str
     size: int
     author: str
+    # отдельная аудиодорожка из DASH-манифеста, если она есть
+    audio_url: Optional[str] = None
+    audio_size: int = 0
 
     @classmethod
     def from_json(cls, json_: dict):
@@ -51,11 +61,14 @@ class InstagramVideo:
 
         video_size = int(
             manifest_soup.select_one("AdaptationSet[contentType='video'] Representation").attrs['FBContentLength'])
-        audio_size = int(
-            manifest_soup.select_one("AdaptationSet[contentType='audio'] Representation").attrs['FBContentLength'])
+        audio_representation = manifest_soup.select_one("AdaptationSet[contentType='audio'] Representation")
+        audio_size = int(audio_representation.attrs['FBContentLength'])
         full_size = video_size + audio_size
+        audio_base_url = audio_representation.select_one("BaseURL")
+        audio_url = audio_base_url.text.strip() if audio_base_url is not None else None
 
-        return cls(video_title, video_url, video_preview_url, video_duration, video_quality, full_size, video_author)
+        return cls(video_title, video_url, video_preview_url, video_duration, video_quality, full_size, video_author,
+                   audio_url or None, audio_size)
 
 
 class InstagramParser(BaseParser):
@@ -79,7 +92,7 @@ class InstagramParser(BaseParser):
     @fallback_background_task
     async def download(self, task_id: str, download_video: SVideoDownload):
         task: DownloadTask = await redis_cache.get_download_task(task_id)
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(trace_configs=[circuit_breaker.trace_config()]) as session:
             async with session.get(self.url, headers=self.headers) as response:
                 response.raise_for_status()
                 response_text = await response.text()
@@ -92,52 +105,77 @@ class InstagramParser(BaseParser):
 
             task.video_status.description = "Downloading video track" if not is_audio_only else "Downloading audio track"
             await redis_cache.set_download_task(task)
-            async with session.get(video.content_url, headers=self._asset_headers) as response:
-                response.raise_for_status()
-
-                total_size = int(response.headers.get('Content-Length', 0))
-                bytes_read = 0
-                last_t = time.time()
-                last_bytes = 0
-                temp_path = download_path
-
-                if is_audio_only:
-                    temp_path = download_path.with_suffix('.temp')
-
-                async with aiofiles.open(temp_path, 'wb') as f:
-                    while True:
-                        chunk = await response.content.read(8192)  # читаем по 8 КБ
-                        if not chunk:
-                            break
-                        await f.write(chunk)
-                        bytes_read += len(chunk)
-                        now = time.time()
-                        dt = max(1e-3, now - last_t)
-                        speed = float(max(0, bytes_read - last_bytes)) / dt  # bytes/sec
-                        last_t = now
-                        last_bytes = bytes_read
-                        if total_size:
-                            task.video_status.percent = int((bytes_read / total_size) * 100)
-                            remain = max(0, total_size - bytes_read)
-                            task.video_status.speed_bps = speed
-                            task.video_status.eta_seconds = int(remain / speed) if speed > 0 else None
-                        await redis_cache.set_download_task(task)
-
-                if is_audio_only:
-                    task.video_status.description = "Converting to MP3"
-                    await redis_cache.set_download_task(task)
-                    mp3_path = download_path.with_suffix('.mp3')
-                    await asyncio.to_thread(convert_to_mp3,
-                                            temp_path.as_posix(),
-                                            mp3_path.as_posix()
-                                            )
-                    temp_path.unlink(missing_ok=True)
-                    task.filepath = mp3_path
+            post_process = PostPrecess(task, download_video)
+            temp_path = download_path
+            if is_audio_only:
+                temp_path = download_path.with_suffix('.temp')
+                download_path = download_path.with_suffix(post_process.audio_suffix)
+
+            fetched = False
+            if is_audio_only:
+                # аудиодорожка из DASH-манифеста; без неё звук вынимается из видеопотока
+                audio_url = video.audio_url or video.content_url
+                source = AudioSource.TRACK if video.audio_url else AudioSource.VIDEO_STREAM
+                async with upstream_connections.lease(audio_url):
+                    fetched = await post_process.fetch_audio(audio_url, download_path, self._asset_headers, source)
+            elif post_process.should_fetch_clip():
+                async with upstream_connections.lease(video.content_url):
+                    fetched = await post_process.fetch_clip(video.content_url,
+                                                            output=download_path.with_name(download_path.name + '.mp4'),
+                                                            headers=self._asset_headers)
+            if fetched:
+                task.video_status.status = VideoDownloadStatus.COMPLETED
+                task.video_status.description = VideoDownloadStatus.COMPLETED
+                await redis_cache.set_download_task(task)
+                return
+
+            if is_audio_only:
+                # видео качается целиком только ради звука: небольшое можно держать на tmpfs
+                temp_path = scratch_space.stage(task_id, temp_path, video.size)
+            offset = await worker_drain.resume_offset(task_id, temp_path)
+            async with upstream_connections.lease(video.content_url), \
+                    session.get(video.content_url, headers=range_headers(self._asset_headers, offset)) as response:
+                if range_already_complete(response.status, offset, response.headers.get('Content-Range')):
+                    total_size = offset
                 else:
-                    task.filepath = temp_path
-
-        post_process = PostPrecess(task, download_video)
-        await post_process.process()
+                    response.raise_for_status()
+                    if response.status != 206:
+                        offset = 0
+
+                    total_size = offset + int(response.headers.get('Content-Length', 0))
+                    bytes_read = offset
+                    last_t = time.time()
+                    last_bytes = offset
+
+                    async with aiofiles.open(temp_path, 'ab' if offset else 'wb') as f, \
+                            bandwidth.throttle(task_id) as throttle:
+                        while True:
+                            chunk = await response.content.read(8192)  # читаем по 8 КБ
+                            if not chunk:
+                                break
+                            worker_drain.check(task_id)
+                            await throttle.consume(len(chunk))
+                            await f.write(chunk)
+                            bytes_read += len(chunk)
+                            now = time.time()
+                            dt = max(1e-3, now - last_t)
+                            speed = float(max(0, bytes_read - last_bytes)) / dt  # bytes/sec
+                            last_t = now
+                            last_bytes = bytes_read
+                            if total_size:
+                                task.video_status.percent = int((bytes_read / total_size) * 100)
+                                remain = max(0, total_size - bytes_read)
+                                task.video_status.speed_bps = speed
+                                task.video_status.eta_seconds = int(remain / speed) if speed > 0 else None
+                            await redis_cache.set_download_task(task)
+
+                task.filepath = temp_path
+
+        if is_audio_only:
+            await post_process.report_audio(AudioSource.FULL_DOWNLOAD, total_size)
+            await post_process.process(audio=temp_path, output=download_path, audio_only=True)
+        else:
+            await post_process.process(video=temp_path)
 
         task.video_status.status = VideoDownloadStatus.COMPLETED
         task.video_status.description = VideoDownloadStatus.COMPLETED
@@ -230,7 +268,7 @@ class InstagramParser(BaseParser):
         return InstagramVideo(title, og_video, preview, duration, quality, 0, author)
 
     async def get_formats(self) -> SVideoResponse:
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(trace_configs=[circuit_breaker.trace_config()]) as session:
             async with session.get(self.url, headers=self.headers) as response:
                 response.raise_for_status()
                 response_text = await response.text()
@@ -239,7 +277,7 @@ class InstagramParser(BaseParser):
 
         if not video.size:
             try:
-                async with aiohttp.ClientSession() as session2:
+                async with aiohttp.ClientSession(trace_configs=[circuit_breaker.trace_config()]) as session2:
                     async with session2.head(video.content_url, headers=self._asset_headers) as head_resp:
                         clen = head_resp.headers.get('Content-Length') or head_resp.headers.get('content-length')
                         if clen:
@@ -258,14 +296,7 @@ class InstagramParser(BaseParser):
                     "filesize": video.size,
                 }
             ),
-            SVideoFormat(
-                **{
-                    "quality": "Audio only",
-                    "video_format_id": "",
-                    "audio_format_id": "audio",
-                    "filesize": video.size // 4,
-                }
-            )
+            *self.audio_formats("audio", video.audio_size or video.size // 4),
         ]
         return SVideoResponse(
             url=self.url,
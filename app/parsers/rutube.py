@@ -1,4 +1,3 @@
-import asyncio
 import re
 from dataclasses import dataclass
 from pathlib import Path
@@ -9,17 +8,20 @@ from bs4 import BeautifulSoup
 
 from app.config import settings
 from app.exceptions import DownloadUserCanceledException
+from app.models.bandwidth import bandwidth
 from app.models.cache import redis_cache
-from app.models.post_process import PostPrecess
+from app.models.circuit import circuit_breaker
+from app.models.drain import worker_drain
+from app.models.post_process import AudioSource, PostPrecess
 from app.models.status import VideoDownloadStatus
 from app.models.types import DownloadTask
+from app.models.upstream import upstream_connections
 from app.parsers.base import BaseParser
 from app.schemas.main import SVideoResponse, SVideoDownload, SVideoFormat
 from app.utils.helpers import remove_all_spec_chars
 from app.utils.validators_utils import fallback_background_task
 from app.utils.video_utils import (
     save_preview_on_s3,
-    convert_to_mp3,
     download_hls_to_file,
 )
 
@@ -144,7 +146,7 @@ class RutubeParser(BaseParser):
         return None
 
     async def _fetch_rutube_video(self) -> RutubeVideo:
-        async with aiohttp.ClientSession(headers=self._headers) as session:
+        async with aiohttp.ClientSession(headers=self._headers, trace_configs=[circuit_breaker.trace_config()]) as session:
             # 1) Play options -> HLS master and preview
             async with session.get(self.OPTIONS_URL.format(video_id=self.video_id)) as resp:
                 resp.raise_for_status()
@@ -269,16 +271,8 @@ class RutubeParser(BaseParser):
 
         if video.variants:
             min_h = min(video.variants.keys(), key=lambda x: int(re.sub("[^0-9]", "", x)))
-            available_formats.append(
-                SVideoFormat(
-                    **{
-                        "quality": "Audio only",
-                        "video_format_id": "",
-                        "audio_format_id": str(min_h),
-                        "filesize": int(((128000) / 8) * int(video.duration)) if video.duration else 0,
-                    }
-                )
-            )
+            available_formats += self.audio_formats(
+                str(min_h), int(((128000) / 8) * int(video.duration)) if video.duration else 0)
 
         return SVideoResponse(
             url=self.url,
@@ -308,7 +302,8 @@ class RutubeParser(BaseParser):
 
         chosen_variant = video.variants[chosen_id]
 
-        extension = ".mp3" if is_audio_only else ".mp4"
+        post_process = PostPrecess(task, download_video)
+        extension = post_process.audio_suffix if is_audio_only else ".mp4"
         author_dir_name = remove_all_spec_chars(video.author or "rutube")
         file_name = f"{task_id}_{remove_all_spec_chars(video.title or 'rutube')}{extension}"
         download_path = Path(settings.DOWNLOAD_FOLDER) / author_dir_name / file_name
@@ -319,9 +314,7 @@ class RutubeParser(BaseParser):
         task.filepath = temp_path
         await redis_cache.set_download_task(task)
 
-        event_loop = asyncio.get_running_loop()
-
-        def on_progress(seconds_done: float, percent: float):
+        async def on_progress(seconds_done: float, percent: float):
             task.video_status.percent = float(percent)
             try:
                 total = float(video.duration or 0)
@@ -348,49 +341,66 @@ class RutubeParser(BaseParser):
                         task.video_status.eta_seconds = int(remain)
             except Exception:
                 pass
-            asyncio.run_coroutine_threadsafe(redis_cache.set_download_task(task), event_loop)
-
-        is_cancel = False
-        async def check_redis_cancel():
-            nonlocal is_cancel
-            is_cancel = await redis_cache.is_task_canceled(task_id)
+            await redis_cache.set_download_task(task)
 
-        def check():
-            asyncio.run_coroutine_threadsafe(check_redis_cancel(), event_loop)
-            return is_cancel
+        async def check() -> bool:
+            # HLS через ffmpeg не докачивается: при остановке воркера ffmpeg завершается и задача начнётся заново
+            worker_drain.check(task_id)
+            return await redis_cache.is_task_canceled(task_id)
 
         audio_hls = chosen_variant.get("audio") or chosen_variant.get("video")
         video_hls = None
 
+        if is_audio_only and "audio" not in chosen_variant:
+            # аудиорендиция общая для качеств — берём её у любого варианта, где она объявлена
+            audio_hls = next((v["audio"] for v in video.variants.values() if v.get("audio")), audio_hls)
+        audio_source = AudioSource.TRACK if audio_hls != chosen_variant.get("video") else AudioSource.VIDEO_STREAM
+
         if not is_audio_only:
             video_hls = chosen_variant["video"]
 
-        await asyncio.to_thread(
-            download_hls_to_file,
-            audio_hls,
-            temp_path.as_posix(),
-            int(video.duration) if video.duration else 0,
-            video_hls,
-            on_progress,
-            self._headers,
-            check
-        )
-
+        # ffmpeg читает оба плейлиста одновременно — по соединению на каждый
+        connections = 2 if video_hls else 1
+        fetched = False
         if is_audio_only:
-            task.video_status.description = "Converting to MP3"
+            # аудиофайл собирается прямо из сегментов плейлиста, без промежуточного MP4
+            async with upstream_connections.lease(audio_hls):
+                fetched = await post_process.fetch_audio(audio_hls, download_path, self._headers, audio_source)
+        elif post_process.should_fetch_clip():
+            # из плейлиста берутся только сегменты, попадающие во фрагмент
+            async with upstream_connections.lease(audio_hls, want=connections, min_count=connections):
+                fetched = await post_process.fetch_clip(
+                    video_hls,
+                    audio_hls if audio_hls != video_hls else None,
+                    output=download_path,
+                    headers=self._headers,
+                )
+        if fetched:
+            task.video_status.status = VideoDownloadStatus.COMPLETED
+            task.video_status.description = VideoDownloadStatus.COMPLETED
             await redis_cache.set_download_task(task)
-            await asyncio.to_thread(
-                convert_to_mp3,
+            return
+
+        async with bandwidth.throttle(task_id) as throttle, \
+                upstream_connections.lease(audio_hls, want=connections, min_count=connections):
+            bytes_read = await download_hls_to_file(
+                audio_hls,
                 temp_path.as_posix(),
-                download_path.as_posix(),
+                int(video.duration) if video.duration else 0,
+                video_hls,
+                on_progress,
+                self._headers,
+                check
             )
-            temp_path.unlink(missing_ok=True)
-            task.filepath = download_path
-        else:
-            task.filepath = temp_path
+            # сегменты читает ffmpeg: полосу учитываем по итогу
+            await throttle.account(bytes_read)
 
-        post_process = PostPrecess(task, download_video)
-        await post_process.process()
+        if is_audio_only:
+            await post_process.report_audio(
+                AudioSource.TRACK if audio_source == AudioSource.TRACK else AudioSource.FULL_DOWNLOAD, bytes_read)
+            await post_process.process(audio=temp_path, output=download_path, audio_only=True)
+        else:
+            await post_process.process(video=temp_path)
 
         task.video_status.status = VideoDownloadStatus.COMPLETED
         task.video_status.description = VideoDownloadStatus.COMPLETED
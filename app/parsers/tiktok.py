@@ -7,15 +7,20 @@ from dataclasses import dataclass
 
 from app.config import settings
 from app.exceptions import DownloadUserCanceledException
+from app.models.bandwidth import bandwidth
 from app.models.cache import redis_cache
-from app.models.post_process import PostPrecess
+from app.models.circuit import circuit_breaker
+from app.models.drain import worker_drain
+from app.models.post_process import AudioSource, PostPrecess
 from app.models.status import VideoDownloadStatus
 from app.models.types import DownloadTask
+from app.models.upstream import upstream_connections
 from app.parsers.base import BaseParser
 from app.schemas.main import SVideoResponse, SVideoDownload, SVideoFormat
-from app.utils.helpers import remove_all_spec_chars
+from app.utils.ffmpeg import AudioContainer
+from app.utils.helpers import range_already_complete, range_headers, remove_all_spec_chars
 from app.utils.validators_utils import fallback_background_task
-from app.utils.video_utils import save_preview_on_s3, convert_to_mp3
+from app.utils.video_utils import save_preview_on_s3
 
 
 @dataclass
@@ -41,7 +46,7 @@ class TikTokParser(BaseParser):
         self.api_url = f"https://www.tikwm.com/api/?url={self.url}&hd=1"
 
     async def _get_video_info(self):
-        async with aiohttp.ClientSession(headers=self.api_headers) as session:
+        async with aiohttp.ClientSession(headers=self.api_headers, trace_configs=[circuit_breaker.trace_config()]) as session:
             async with session.get(self.api_url) as resp:
                 resp.raise_for_status()
                 payload = await resp.json()
@@ -66,7 +71,8 @@ class TikTokParser(BaseParser):
 
         video_size = 0
         audio_size = 0
-        async with aiohttp.ClientSession(headers={"User-Agent": self.api_headers["User-Agent"]}) as hs:
+        async with aiohttp.ClientSession(headers={"User-Agent": self.api_headers["User-Agent"]},
+                                         trace_configs=[circuit_breaker.trace_config()]) as hs:
             if video_url:
                 async with hs.head(video_url, allow_redirects=True) as h:
                     if h.status < 400 and h.headers.get("Content-Length"):
@@ -94,7 +100,9 @@ class TikTokParser(BaseParser):
 
         formats = [
             SVideoFormat(quality="MP4", video_format_id="video", audio_format_id="audio", filesize=video.video_size),
-            SVideoFormat(quality="Audio only", video_format_id="", audio_format_id="audio", filesize=video.audio_size),
+            # отдельный трек уже в MP3 — он и есть быстрый вариант
+            *self.audio_formats("audio", video.audio_size,
+                                (AudioContainer.MP3,) if video.audio_url else (AudioContainer.M4A, AudioContainer.MP3)),
         ]
 
         return SVideoResponse(
@@ -112,7 +120,8 @@ class TikTokParser(BaseParser):
 
         video = await self._get_video_info()
         is_audio_only = not download_video.video_format_id
-        extension = ".mp3" if is_audio_only else ".mp4"
+        post_process = PostPrecess(task, download_video)
+        extension = post_process.audio_suffix if is_audio_only else ".mp4"
         out_dir = Path(settings.DOWNLOAD_FOLDER) / remove_all_spec_chars(video.author)
         out_dir.mkdir(parents=True, exist_ok=True)
         out_path = out_dir / f"{task_id}_{remove_all_spec_chars(video.title)}{extension}"
@@ -121,51 +130,72 @@ class TikTokParser(BaseParser):
         if not source_url:
             raise ValueError("TikTok: no suitable media stream")
 
+        # музыкальный трек TikTok уже в MP3: перекладывать его нужно, только если выбран другой контейнер
+        needs_audio_pass = is_audio_only and (video.audio_url is None or extension != ".mp3")
         temp_path = out_path
-        if is_audio_only and video.audio_url is None:
+        if needs_audio_pass:
             temp_path = out_path.with_suffix(".temp")
 
+        if is_audio_only and video.audio_url is None:
+            # отдельного трека нет: звук вынимается из видеопотока без его копии на диске
+            async with upstream_connections.lease(source_url):
+                fetched = await post_process.fetch_audio(source_url, out_path,
+                                                         {"User-Agent": self.api_headers["User-Agent"]},
+                                                         AudioSource.VIDEO_STREAM)
+            if fetched:
+                task.video_status.status = VideoDownloadStatus.COMPLETED
+                task.video_status.description = VideoDownloadStatus.COMPLETED
+                await redis_cache.set_download_task(task)
+                return
+
         task.filepath = temp_path
         task.video_status.description = "Downloading audio track" if is_audio_only else "Downloading video track"
         await redis_cache.set_download_task(task)
 
-        async with aiohttp.ClientSession(headers={"User-Agent": self.api_headers["User-Agent"]}) as dl_sess:
-            async with dl_sess.get(source_url) as r:
-                r.raise_for_status()
-                total = int(r.headers.get("Content-Length", 0))
-                read = 0
-                last_t = time.time()
-                last_bytes = 0
-                async with aiofiles.open(temp_path, "wb") as f:
-                    async for chunk in r.content.iter_chunked(1024 * 64):
-                        if not chunk:
-                            break
-                        await f.write(chunk)
-                        read += len(chunk)
-                        now = time.time()
-                        dt = max(1e-3, now - last_t)
-                        speed = float(max(0, read - last_bytes)) / dt
-                        last_t = now
-                        last_bytes = read
-                        if total:
-                            task.video_status.percent = int(read / total * 100)
-                            remain = max(0, total - read)
-                            task.video_status.speed_bps = speed
-                            task.video_status.eta_seconds = int(remain / speed) if speed > 0 else None
-                        await redis_cache.set_download_task(task)
-                        if await redis_cache.is_task_canceled(task_id):
-                            raise DownloadUserCanceledException()
-
-        if is_audio_only and video.audio_url is None:
-            task.video_status.description = "Converting to MP3"
-            await redis_cache.set_download_task(task)
-            await convert_to_mp3(temp_path.as_posix(), out_path.as_posix())
-            temp_path.unlink(missing_ok=True)
-
-        task.filepath = out_path
-
-        post_process = PostPrecess(task, download_video)
-        await post_process.process()
+        offset = await worker_drain.resume_offset(task_id, temp_path)
+        async with aiohttp.ClientSession(headers={"User-Agent": self.api_headers["User-Agent"]},
+                                         trace_configs=[circuit_breaker.trace_config()]) as dl_sess:
+            async with upstream_connections.lease(source_url), \
+                    dl_sess.get(source_url, headers=range_headers({}, offset)) as r:
+                if range_already_complete(r.status, offset, r.headers.get("Content-Range")):
+                    total = offset
+                else:
+                    r.raise_for_status()
+                    if r.status != 206:
+                        offset = 0
+                    total = offset + int(r.headers.get("Content-Length", 0))
+                    read = offset
+                    last_t = time.time()
+                    last_bytes = offset
+                    async with aiofiles.open(temp_path, "ab" if offset else "wb") as f, \
+                            bandwidth.throttle(task_id) as throttle:
+                        async for chunk in r.content.iter_chunked(1024 * 64):
+                            if not chunk:
+                                break
+                            worker_drain.check(task_id)
+                            await throttle.consume(len(chunk))
+                            await f.write(chunk)
+                            read += len(chunk)
+                            now = time.time()
+                            dt = max(1e-3, now - last_t)
+                            speed = float(max(0, read - last_bytes)) / dt
+                            last_t = now
+                            last_bytes = read
+                            if total:
+                                task.video_status.percent = int(read / total * 100)
+                                remain = max(0, total - read)
+                                task.video_status.speed_bps = speed
+                                task.video_status.eta_seconds = int(remain / speed) if speed > 0 else None
+                            await redis_cache.set_download_task(task)
+                            if await redis_cache.is_task_canceled(task_id):
+                                raise DownloadUserCanceledException()
+
+        if is_audio_only:
+            await post_process.report_audio(AudioSource.TRACK if video.audio_url else AudioSource.FULL_DOWNLOAD, total)
+        if needs_audio_pass:
+            await post_process.process(audio=temp_path, output=out_path, audio_only=True)
+        else:
+            await post_process.process(video=temp_path, output=out_path)
 
         task.video_status.status = VideoDownloadStatus.COMPLETED
         task.video_status.description = VideoDownloadStatus.COMPLETED
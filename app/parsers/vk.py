@@ -4,21 +4,25 @@ import re
 import ssl
 import aiofiles
 from pathlib import Path
+from shutil import rmtree
 
 import aiohttp
 from dataclasses import dataclass
 
 from app.config import settings
-from app.exceptions import DownloadUserCanceledException
+from app.exceptions import DownloadCheckpointed, DownloadUserCanceledException
+from app.models.bandwidth import bandwidth, Throttle
 from app.models.cache import redis_cache
-from app.models.post_process import PostPrecess
+from app.models.circuit import circuit_breaker
+from app.models.drain import worker_drain
+from app.models.post_process import AudioSource, PostPrecess
 from app.models.status import VideoDownloadStatus
 from app.models.types import DownloadTask
+from app.models.upstream import upstream_connections
 from app.parsers.base import BaseParser
 from app.schemas.main import SVideoResponse, SVideoDownload, SVideoFormat
 from app.utils.helpers import remove_all_spec_chars
 from app.utils.validators_utils import fallback_background_task
-from app.utils.video_utils import convert_to_mp3
 
 
 @dataclass
@@ -93,18 +97,31 @@ class VkParser(BaseParser):
                            task_id: str,
                            task: DownloadTask,
                            download_path: Path,
+                           throttle: Throttle,
                            ):
+        part_file = download_path.parent / task_id / f"part_{part_number}.tmp"
+        part_file.parent.mkdir(parents=True, exist_ok=True)
+        # после контрольной точки часть уже может быть скачана частично: докачиваем хвост
+        done = part_file.stat().st_size if part_file.exists() else 0
+        if done > end - start + 1:
+            done = 0
+        if done:
+            async with self._lock:
+                self.bytes_read += done
+        if start + done > end:
+            return part_file
+
         headers = {
             **self._headers,
-            "Range": f"bytes={start}-{end}",
+            "Range": f"bytes={start + done}-{end}",
         }
         async with session.get(url, headers=headers, ssl=self._ssl_context) as resp:
             resp.raise_for_status()
 
-            part_file = download_path.parent / task_id / f"part_{part_number}.tmp"
-            part_file.parent.mkdir(parents=True, exist_ok=True)
-            async with aiofiles.open(part_file, "wb") as f:
+            async with aiofiles.open(part_file, "ab" if done else "wb") as f:
                 async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
+                    worker_drain.check(task_id)
+                    await throttle.consume(len(chunk))
                     async with self._lock:
                         self.bytes_read += len(chunk)
                         task.video_status.percent = int((self.bytes_read / self.total_size) * 100)
@@ -169,12 +186,14 @@ class VkParser(BaseParser):
     @fallback_background_task
     async def download(self, task_id: str, download_video: SVideoDownload):
         task: DownloadTask = await redis_cache.get_download_task(task_id)
-        async with aiohttp.ClientSession(headers=self._headers, connector=aiohttp.TCPConnector(ssl=self._ssl_context)) as session:
+        async with aiohttp.ClientSession(headers=self._headers, connector=aiohttp.TCPConnector(ssl=self._ssl_context),
+                                         trace_configs=[circuit_breaker.trace_config()]) as session:
             response_json = await self._get_video_info(session)
             video = VkVideo.from_json(response_json)
 
             is_audio_only = not download_video.video_format_id
-            extension = '.mp3' if is_audio_only else '.mp4'
+            post_process = PostPrecess(task, download_video)
+            extension = post_process.audio_suffix if is_audio_only else '.mp4'
 
             download_path = (
                     Path(settings.DOWNLOAD_FOLDER) /
@@ -192,6 +211,21 @@ class VkParser(BaseParser):
             else:
                 content_url = video.content_urls[download_video.video_format_id]
 
+            fetched = False
+            if is_audio_only:
+                # отдельной аудиодорожки у VK нет: звук берётся из самого лёгкого видеопотока, без его копии на диске
+                async with upstream_connections.lease(content_url):
+                    fetched = await post_process.fetch_audio(content_url, download_path, self._headers,
+                                                             AudioSource.VIDEO_STREAM)
+            elif post_process.should_fetch_clip():
+                async with upstream_connections.lease(content_url):
+                    fetched = await post_process.fetch_clip(content_url, output=download_path, headers=self._headers)
+            if fetched:
+                task.video_status.status = VideoDownloadStatus.COMPLETED
+                task.video_status.description = VideoDownloadStatus.COMPLETED
+                await redis_cache.set_download_task(task)
+                return
+
             async with session.get(content_url, ssl=self._ssl_context) as response:
                 response.raise_for_status()
                 self.total_size = int(response.headers.get('Content-Length', 0))
@@ -206,38 +240,45 @@ class VkParser(BaseParser):
 
             task.filepath = download_path.parent / task_id
             await redis_cache.set_download_task(task)
-            tasks = [
-                asyncio.create_task(
-                    self._fetch_range(session, content_url, start, end, part_num, task_id, task, temp_path)
-                )
-                for start, end, part_num in ranges
-            ]
-            try:
-                part_files = await asyncio.gather(*tasks)
-            except DownloadUserCanceledException:
-                for t in tasks:
-                    t.cancel()
-                await asyncio.gather(*tasks, return_exceptions=True)
-                raise
+            # части от прерванной попытки годятся только после контрольной точки и если размер файла не изменился
+            size_marker = task.filepath / "size"
+            resumable = await worker_drain.resumable(task_id)
+            if task.filepath.exists() and (not resumable or not size_marker.exists() or
+                                           size_marker.read_text() != str(self.total_size)):
+                rmtree(task.filepath)
+            task.filepath.mkdir(parents=True, exist_ok=True)
+            size_marker.write_text(str(self.total_size))
+            async with bandwidth.throttle(task_id) as throttle, \
+                    upstream_connections.lease(content_url, want=self.CONNECTIONS_COUNT) as lease:
+                # части остаются те же (от них зависит докачка), но качаются в столько потоков, сколько дал бюджет хоста
+                parallel = asyncio.Semaphore(lease.count)
+
+                async def fetch_part(start: int, end: int, part_num: int) -> Path:
+                    async with parallel:
+                        return await self._fetch_range(session, content_url, start, end, part_num, task_id, task,
+                                                       temp_path, throttle)
+
+                tasks = [asyncio.create_task(fetch_part(start, end, part_num)) for start, end, part_num in ranges]
+                try:
+                    part_files = await asyncio.gather(*tasks)
+                except (DownloadUserCanceledException, DownloadCheckpointed):
+                    for t in tasks:
+                        t.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+            size_marker.unlink(missing_ok=True)
 
             task.video_status.description = "Merging parts"
             await redis_cache.set_download_task(task)
             await self._merge_parts(part_files, temp_path)
 
-            if is_audio_only:
-                task.video_status.description = "Converting to MP3"
-                await redis_cache.set_download_task(task)
-                await asyncio.to_thread(convert_to_mp3,
-                                    temp_path.as_posix(),
-                                    download_path.as_posix()
-                                    )
-                temp_path.unlink(missing_ok=True)
-                task.filepath = download_path
-            else:
-                task.filepath = temp_path
+            task.filepath = temp_path
 
-        post_process = PostPrecess(task, download_video)
-        await post_process.process()
+        if is_audio_only:
+            await post_process.report_audio(AudioSource.FULL_DOWNLOAD, self.total_size)
+            await post_process.process(audio=temp_path, output=download_path, audio_only=True)
+        else:
+            await post_process.process(video=temp_path)
 
         task.video_status.status = VideoDownloadStatus.COMPLETED
         task.video_status.description = VideoDownloadStatus.COMPLETED
@@ -262,7 +303,8 @@ class VkParser(BaseParser):
 
     async def get_formats(self) -> SVideoResponse:
         try:
-            async with aiohttp.ClientSession(headers=self._headers, connector=aiohttp.TCPConnector(ssl=self._ssl_context)) as session:
+            async with aiohttp.ClientSession(headers=self._headers, connector=aiohttp.TCPConnector(ssl=self._ssl_context),
+                                         trace_configs=[circuit_breaker.trace_config()]) as session:
                 response_json = await self._get_video_info(session)
             
             video = VkVideo.from_json(response_json)
@@ -270,7 +312,8 @@ class VkParser(BaseParser):
             if not video.content_urls:
                 raise ValueError("No video URLs found in VK response")
 
-            async with aiohttp.ClientSession(headers=self._headers, connector=aiohttp.TCPConnector(ssl=self._ssl_context)) as session:
+            async with aiohttp.ClientSession(headers=self._headers, connector=aiohttp.TCPConnector(ssl=self._ssl_context),
+                                         trace_configs=[circuit_breaker.trace_config()]) as session:
                 file_sizes = await self._get_file_sizes(session, video.content_urls)
             
             video.content_sizes = file_sizes
@@ -290,16 +333,7 @@ class VkParser(BaseParser):
                 )
 
             min_quality = min(video.content_urls.keys(), key=int)
-            available_formats.append(
-                SVideoFormat(
-                    **{
-                        "quality": "Audio only",
-                        "video_format_id": "",
-                        "audio_format_id": min_quality,
-                        "filesize": video.content_sizes.get(min_quality),
-                    }
-                )
-            )
+            available_formats += self.audio_formats(min_quality, video.content_sizes.get(min_quality))
             
             return SVideoResponse(
                 url=self.url,
@@ -14,17 +14,25 @@ from bs4 import BeautifulSoup
 
 from app.config import settings
 from app.exceptions import DownloadUserCanceledException
+from app.models.bandwidth import bandwidth
 from app.models.cache import redis_cache
-from app.models.post_process import PostPrecess
+from app.models.circuit import circuit_breaker
+from app.models.drain import worker_drain
+from app.models.post_process import AudioSource, PostPrecess
+from app.models.scratch import scratch_space
 from app.models.status import VideoDownloadStatus
 from app.models.types import DownloadTask
+from app.models.upstream import upstream_connections
 from app.parsers.base import BaseParser
 from app.schemas.main import SVideoFormat, SVideoResponse, SVideoDownload, SYoutubeSearchItem
+from app.utils.ffmpeg import AudioContainer
 from app.utils.validators_utils import fallback_background_task
-from app.utils.video_utils import save_preview_on_s3, combine_audio_and_video, convert_to_mp3
+from app.utils.video_utils import ThumbnailVariant, save_preview_on_s3
 
 
 class YouTubeParser(BaseParser):
+    # CDN, с которого pytubefix скачивает потоки
+    MEDIA_HOST = "googlevideo.com"
 
     def __init__(self, url):
         self.url = url
@@ -40,7 +48,7 @@ class YouTubeParser(BaseParser):
                 "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
                 "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
                 "Accept-Language": "ru,en;q=0.9",
-            }) as session:
+            }, trace_configs=[circuit_breaker.trace_config()]) as session:
                 async with session.get(search_url) as resp:
                     resp.raise_for_status()
                     html = await resp.text()
@@ -119,7 +127,8 @@ class YouTubeParser(BaseParser):
                 ))
 
                 if thumbnail_url:
-                    upload_jobs.append(save_preview_on_s3(thumbnail_url, title or url, (author or "youtube")))
+                    upload_jobs.append(save_preview_on_s3(thumbnail_url, title or url, (author or "youtube"),
+                                                          variant=ThumbnailVariant.CARD))
 
                 if len(result_items) >= 30:
                     break
@@ -151,6 +160,8 @@ class YouTubeParser(BaseParser):
 
         def post_process_hook(stream_: Stream, chunk: bytes, bytes_remaining: int):
             nonlocal last_t, last_bytes
+            # pytubefix не умеет докачку: прерванный трек скачается заново, готовые переиспользуются (skip_existing)
+            worker_drain.check(task_id)
             bytes_received = stream_.filesize - bytes_remaining
             percent = round(100.0 * bytes_received / float(stream_.filesize), 1)
             now = time.time()
@@ -165,6 +176,9 @@ class YouTubeParser(BaseParser):
             task.video_status.speed_bps = speed
             task.video_status.eta_seconds = eta
 
+            # Блокирует поток pytubefix, пока у задачи не появятся токены на следующий чанк
+            asyncio.run_coroutine_threadsafe(throttle.consume(len(chunk)), event_loop).result()
+
             async def _update_and_check():
                 await redis_cache.set_download_task(task)
                 if await redis_cache.is_task_canceled(task_id):
@@ -177,62 +191,87 @@ class YouTubeParser(BaseParser):
 
         self._yt.register_on_progress_callback(post_process_hook)
 
-        if not download_video.video_format_id:
-            task.video_status.description = "Downloading audio track"
+        post_process = PostPrecess(task, download_video)
+        if post_process.should_fetch_clip() and await self._fetch_clip(task_id, post_process, download_path):
+            task.video_status.status = VideoDownloadStatus.COMPLETED
+            task.video_status.description = VideoDownloadStatus.COMPLETED
             await redis_cache.set_download_task(task)
-            audio_path = Path(await asyncio.to_thread(
-                self._yt.streams.get_by_itag(download_video.audio_format_id).download,
-                output_path=download_path.as_posix(),
-                filename_prefix=f"{task_id}_audio_"
-            ))
+            return
 
-            task.video_status.description = "Converting to MP3"
-            await redis_cache.set_download_task(task)
-            out_path = audio_path.with_suffix('.mp3')
-            await asyncio.to_thread(convert_to_mp3,
-                                    audio_path.as_posix(),
-                                    out_path.as_posix()
-                                    )
-            audio_path.unlink(missing_ok=True)
-            task.filepath = out_path
-
-        else:
-            # Стандартная логика для видео
-            task.video_status.description = "Downloading video track"
-            await redis_cache.set_download_task(task)
-            video_path = Path(await asyncio.to_thread(
-                self._yt.streams.get_by_itag(download_video.video_format_id).download,
-                output_path=download_path.as_posix(),
-                filename_prefix=f"{task_id}_video_"
-            ))
-            if download_video.audio_format_id != download_video.video_format_id:
+        async with bandwidth.throttle(task_id) as throttle:
+            if not download_video.video_format_id:
                 task.video_status.description = "Downloading audio track"
                 await redis_cache.set_download_task(task)
-                audio_path = Path(await asyncio.to_thread(
-                    self._yt.streams.get_by_itag(download_video.audio_format_id).download,
-                    output_path=download_path.as_posix(),
-                    filename_prefix=f"{task_id}_audio_"
-                ))
-                task.video_status.description = "Merging tracks"
-                await redis_cache.set_download_task(task)
-                out_path = video_path.with_name(video_path.stem + "_out.mp4")
-                await asyncio.to_thread(combine_audio_and_video,
-                                        video_path.as_posix(),
-                                        audio_path.as_posix(),
-                                        out_path.as_posix()
-                                        )
-                audio_path.unlink(missing_ok=True)
-                video_path.unlink(missing_ok=True)
-                video_path = out_path
-            task.filepath = video_path
+                audio_path = await self._download_audio(task_id, download_video.audio_format_id, download_path)
+                await post_process.report_audio(AudioSource.TRACK, audio_path.stat().st_size)
+                # дорожка могла лечь на tmpfs, а готовый файл должен быть в DOWNLOAD_FOLDER
+                output = download_path / audio_path.with_suffix(post_process.audio_suffix).name
+                tracks = {"audio": audio_path, "output": output, "audio_only": True}
 
-        post_process = PostPrecess(task, download_video)
-        await post_process.process()
+            else:
+                # Стандартная логика для видео
+                task.video_status.description = "Downloading video track"
+                await redis_cache.set_download_task(task)
+                video_path = await self._download_stream(self._yt.streams.get_by_itag(download_video.video_format_id),
+                                                         download_path, f"{task_id}_video_")
+                tracks = {"video": video_path}
+                if download_video.audio_format_id != download_video.video_format_id:
+                    task.video_status.description = "Downloading audio track"
+                    await redis_cache.set_download_task(task)
+                    tracks["audio"] = await self._download_audio(task_id, download_video.audio_format_id,
+                                                                  download_path)
+                    tracks["output"] = video_path.with_name(video_path.stem + "_out.mp4")
+
+        # склейка, обрезка и перекодирование — одним проходом ffmpeg
+        await post_process.process(**tracks)
 
         task.video_status.status = VideoDownloadStatus.COMPLETED
         task.video_status.description = VideoDownloadStatus.COMPLETED
         await redis_cache.set_download_task(task)
 
+    async def _download_audio(self, task_id: str, itag: str, download_path: Path) -> Path:
+        """Скачивает аудиодорожку; небольшая кладётся на tmpfs, если он настроен."""
+        stream = self._yt.streams.get_by_itag(itag)
+        prefix = f"{task_id}_audio_"
+        target = scratch_space.stage(task_id, download_path / f"{prefix}{stream.default_filename}", stream.filesize)
+        return await self._download_stream(stream, target.parent, prefix)
+
+    async def _download_stream(self, stream: Stream, output_path: Path, prefix: str) -> Path:
+        """Качает поток pytubefix в одно соединение к googlevideo.
+
+        Соединение арендуется только на время самой загрузки: между дорожками и во время
+        склейки в ``post_process.process`` бюджет хоста свободен для других задач.
+        """
+        async with upstream_connections.lease(self.MEDIA_HOST):
+            return Path(await asyncio.to_thread(
+                stream.download,
+                output_path=output_path.as_posix(),
+                filename_prefix=prefix
+            ))
+
+    async def _fetch_clip(self, task_id: str, post_process: PostPrecess, download_path: Path) -> bool:
+        """Скачивает только выбранный фрагмент прямо с CDN, без полных треков."""
+        download_video = post_process.download_video
+        is_audio_only = not download_video.video_format_id
+
+        def stream_url(itag) -> tuple[str, str]:
+            stream = self._yt.streams.get_by_itag(itag)
+            return stream.url, stream.default_filename
+
+        audio_url, filename = await asyncio.to_thread(stream_url, download_video.audio_format_id)
+        video_url = None
+        if not is_audio_only:
+            video_url, filename = await asyncio.to_thread(stream_url, download_video.video_format_id)
+            if download_video.audio_format_id == download_video.video_format_id:
+                audio_url = None
+        prefix = "audio" if is_audio_only else "video"
+        output = download_path / Path(f"{task_id}_{prefix}_{filename}").with_suffix(post_process.audio_suffix if is_audio_only else ".mp4")
+        connections = 2 if video_url and audio_url else 1
+        async with upstream_connections.lease(self.MEDIA_HOST, want=connections, min_count=connections):
+            if is_audio_only:
+                return await post_process.fetch_audio(audio_url, output)
+            return await post_process.fetch_clip(video_url, audio_url, output=output)
+
     @staticmethod
     def _format_filter(stream: Stream):
         return (
@@ -249,9 +288,20 @@ class YouTubeParser(BaseParser):
         ) or streams.filter(only_audio=True).order_by('abr').first()
         return main_stream
 
+    @staticmethod
+    def _get_audio_only_streams(streams: StreamQuery) -> dict[str, Stream]:
+        """Лучшие аудиодорожки для копирования без перекодирования: AAC для m4a, Opus для opus."""
+        audio_only = streams.filter(only_audio=True)
+        found = {
+            AudioContainer.M4A: audio_only.filter(mime_type="audio/mp4").order_by('abr').last(),
+            AudioContainer.OPUS: audio_only.filter(audio_codec="opus").order_by('abr').last(),
+        }
+        return {container: stream for container, stream in found.items() if stream is not None}
+
     async def get_formats(self) -> SVideoResponse:
         streams = await asyncio.to_thread(lambda: self._yt.streams.fmt_streams)
         audio = await asyncio.to_thread(self._get_audio_stream, streams)
+        audio_tracks = await asyncio.to_thread(self._get_audio_only_streams, streams)
 
         preview_url = await save_preview_on_s3(self._yt.thumbnail_url, self._yt.title, self._yt.author)
         duration = timedelta(milliseconds=int(audio.durationMs)).seconds
@@ -268,14 +318,11 @@ class YouTubeParser(BaseParser):
             ) for v_format in filter(self._format_filter, streams)
         ]
 
-        # Add audio-only format
-        audio_format = SVideoFormat(
-            quality="Audio only",
-            video_format_id="",
-            audio_format_id=str(audio.itag),
-            filesize=round(audio.filesize, 2)
-        )
-        available_formats.append(audio_format)
+        # Add audio-only formats: готовые дорожки копируются как есть, MP3 перекодируется из AAC
+        for container, stream in audio_tracks.items():
+            available_formats += self.audio_formats(str(stream.itag), stream.filesize, (container,))
+        mp3_source = audio_tracks.get(AudioContainer.M4A, audio)
+        available_formats += self.audio_formats(str(mp3_source.itag), mp3_source.filesize, (AudioContainer.MP3,))
 
         return SVideoResponse(
             url=self.url,
@@ -16,6 +16,13 @@ from app.models.admin_user import AdminUser
 from app.models.blog import BlogPost, PostStatus
 from app.schemas.blog import SPostCreate, SPostUpdate
 from app.models.cache import redis_cache
+from app.models.circuit import circuit_breaker
+from app.models.connections import redis_connections
+from app.models.events import progress_dispatcher
+from app.models.probe import media_probe
+from app.models.quota import load_shedder
+from app.models.speculation import speculative_prefetch
+from app.models.upstream import upstream_connections
 from app.s3.client import s3_client
 import io
 
@@ -144,6 +151,44 @@ async def redis_users(
     )
 
 
+@router.get("/metrics")
+async def metrics(admin: AdminUser = Depends(get_current_admin)):
+    return JSONResponse({
+        "janitor": await redis_cache.get_janitor_stats(),
+        "audio_jobs": await redis_cache.get_audio_stats(),
+        "redis_pools": redis_connections.stats(),
+        "progress_events": progress_dispatcher.stats(),
+        "worker_slots": await redis_cache.get_workers_stats("slots"),
+        "transcode": await redis_cache.get_workers_stats("transcode"),
+        "thumbnail": await redis_cache.get_workers_stats("thumbnail"),
+        "bandwidth": await redis_cache.get_workers_stats("bandwidth"),
+        "scratch": await redis_cache.get_workers_stats("scratch"),
+        "circuits": await circuit_breaker.stats(),
+        "media_probe": await media_probe.stats(),
+        "upstream_connections": await upstream_connections.stats(),
+        "load_shedding": load_shedder.stats(),
+        "speculative_prefetch": await speculative_prefetch.stats(),
+    })
+
+
+@router.get("/bandwidth", response_class=HTMLResponse)
+async def bandwidth_allocation(request: Request, admin: AdminUser = Depends(get_current_admin)):
+    workers = await redis_cache.get_workers_stats("bandwidth")
+    rows = []
+    for worker_id, stats in sorted(workers.items()):
+        for task_id, task in stats.get("tasks", {}).items():
+            rows.append({"worker_id": worker_id, "task_id": task_id, **task})
+    rows.sort(key=lambda r: (r.get("user_id") or "", r["task_id"]))
+    return templates.TemplateResponse(
+        "admin/bandwidth.html",
+        {
+            "request": request,
+            "workers": workers,
+            "rows": rows,
+        },
+    )
+
+
 @router.get("/redis/users/{user_id}", response_class=HTMLResponse)
 async def redis_user_detail(user_id: str, request: Request, admin: AdminUser = Depends(get_current_admin)):
     active_task_id = await redis_cache.get_user_active_task(user_id)
@@ -1,3 +1,4 @@
+import asyncio
 import uuid
 
 from logging import getLogger
@@ -8,12 +9,16 @@ from fastapi import APIRouter, BackgroundTasks, HTTPException, Path, Request, We
 from fastapi.responses import StreamingResponse
 from starlette import status
 import json
-from contextlib import suppress
 
+from app.exceptions import UpstreamUnavailableException
 from app.models.services import VideoServicesManager
+from app.models.speculation import speculative_prefetch
 from app.models.status import VideoDownloadStatus
 
 from app.models.cache import redis_cache
+from app.models.events import progress_dispatcher, LatestEventsBuffer
+from app.models.inflight import inflight_jobs
+from app.models.quota import QuotaKind, load_shedder, quotas
 from app.models.types import DownloadTask
 from app.parsers import YouTubeParser
 from app.schemas.defaults import EMPTY_VIDEO_RESPONSE
@@ -24,18 +29,29 @@ from app.schemas.main import (
     SVideoStatus,
     SYoutubeSearchResponse,
 )
-from app.utils.validators_utils import check_task_id
-from app.utils.video_utils import stream_file
-from app.models.queue import task_queue
+from app.utils.validators_utils import check_task_id, client_ip
+from app.utils.video_utils import DownloadFileResponse, media_type
+from app.models.queue import estimate_job, task_queue
+from app.config import settings
 
 router = APIRouter(prefix="/api", tags=["Service"])
 
 LOG = getLogger()
 
+TERMINAL_STATUSES = (
+    VideoDownloadStatus.COMPLETED,
+    VideoDownloadStatus.ERROR,
+    VideoDownloadStatus.DONE,
+    VideoDownloadStatus.CANCELED,
+)
+SSE_POLL_SECONDS = 1.0
+
 
 @router.post("/get-formats")
-async def get_video_formats(video_request: SVideoRequest) -> SVideoResponse:
+async def get_video_formats(request: Request, video_request: SVideoRequest,
+                            background_tasks: BackgroundTasks) -> SVideoResponse:
     """Получаем все доступные форматы видео"""
+    await quotas.consume(request.cookies.get("user_id"), client_ip(request), {QuotaKind.FORMATS: 1})
     try:
         print(f"Service: Processing URL: {video_request.url}")
 
@@ -43,6 +59,7 @@ async def get_video_formats(video_request: SVideoRequest) -> SVideoResponse:
         cached_formats = await redis_cache.get_video_meta(video_request.url)
         if cached_formats:
             print(f"Service: Found in cache")
+            background_tasks.add_task(speculative_prefetch.maybe_start, video_request.url, cached_formats)
             return cached_formats
 
         service = VideoServicesManager.get_service(video_request.url)
@@ -66,9 +83,10 @@ async def get_video_formats(video_request: SVideoRequest) -> SVideoResponse:
 
         await redis_cache.set_video_meta(video_request.url, available_formats)
         print(f"Service: Successfully cached and returning {len(available_formats.formats)} formats")
+        background_tasks.add_task(speculative_prefetch.maybe_start, video_request.url, available_formats)
         return available_formats
 
-    except HTTPException:
+    except (HTTPException, UpstreamUnavailableException):
         raise
     except Exception as e:
         print(f"Service error: {e}")
@@ -80,12 +98,21 @@ async def get_video_formats(video_request: SVideoRequest) -> SVideoResponse:
         )
 
 
+def offers_container(video_meta: SVideoResponse, video_download: SVideoDownload) -> bool:
+    """Есть ли выбранный аудиоконтейнер среди форматов, которые вернул get_formats."""
+    if video_download.video_format_id or not video_download.container:
+        return True
+    return any(f.container == video_download.container and f.audio_format_id == video_download.audio_format_id
+               for f in video_meta.formats if not f.video_format_id)
+
+
 @router.post("/start-download")
 async def start_download(request: Request, video_download: SVideoDownload,
                          background_tasks: BackgroundTasks) -> SVideoStatus:
     """Запускает процесс скачивания"""
     user_id = request.cookies.get("user_id", "0")
     task_id = str(uuid.uuid4())
+    await load_shedder.check()
 
     if user_id and user_id != "0":
         already_active_task = await redis_cache.get_user_active_task(user_id)
@@ -105,12 +132,30 @@ async def start_download(request: Request, video_download: SVideoDownload,
                     detail="У вас уже есть активная загрузка. Дождитесь завершения текущей загрузки."
                 )
 
+    service = VideoServicesManager.get_service(video_download.url)
     video_meta = await redis_cache.get_video_meta(video_download.url)
     if not video_meta:
-        service = VideoServicesManager.get_service(video_download.url)
         parser_instance = service.parser(video_download.url)
         video_meta = await parser_instance.get_formats()
         await redis_cache.set_video_meta(video_download.url, video_meta)
+    if video_meta and not offers_container(video_meta, video_download):
+        # контейнер с копией дорожки предлагается только для подходящего кодека источника
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Формат {video_download.container} недоступен для этой аудиодорожки."
+        )
+
+    estimated_bytes, _ = estimate_job(video_meta, video_download)
+    charge = await quotas.consume(user_id, client_ip(request), {
+        QuotaKind.DOWNLOADS: 1,
+        QuotaKind.BYTES: estimated_bytes,
+    })
+    if speculative_prefetch.enabled:
+        try:
+            await speculative_prefetch.record_pick(service, video_meta, video_download)
+            await speculative_prefetch.resolve(service, video_download)
+        except Exception as e:
+            print(f"Service: speculative prefetch bookkeeping failed: {e}")
 
     video_status = SVideoStatus(
         task_id=task_id,
@@ -118,11 +163,14 @@ async def start_download(request: Request, video_download: SVideoDownload,
         video=video_meta or EMPTY_VIDEO_RESPONSE,
         created_at=__import__('time').time()
     )
-    await redis_cache.set_download_task(DownloadTask(video_status, download=video_download))
+    download_task = DownloadTask(video_status, download=video_download)
+    await redis_cache.set_download_task(download_task)
     await redis_cache.add_user_task(user_id, task_id)
     if user_id and user_id != "0":
         acquired = await redis_cache.acquire_user_active_task(user_id, task_id)
         if not acquired:
+            # загрузка не принята — квота за неё не расходуется
+            await quotas.refund(charge)
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT,
                 detail="У вас уже есть активная загрузка. Дождитесь завершения текущей загрузки."
@@ -135,8 +183,7 @@ async def start_download(request: Request, video_download: SVideoDownload,
         except Exception:
             pass
 
-    arq = await task_queue.get()
-    await arq.enqueue_job("download_video", task_id, _job_id=task_id)
+    await task_queue.enqueue_download(download_task)
     return video_status
 
 
@@ -155,35 +202,44 @@ async def download_events(request: Request, task_id: Annotated[str, Path()]):
     if not await redis_cache.exist_download_task(task_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
 
-    channel = redis_cache.channel_for_task(task_id)
-    pubsub = redis_cache.redis.pubsub()
-    await pubsub.subscribe(channel)
+    queue = progress_dispatcher.new_queue()
+    await progress_dispatcher.subscribe(task_id, queue)
 
     async def event_generator():
+        loop = asyncio.get_running_loop()
+        last_sent = loop.time()
         try:
             task = await redis_cache.get_download_task(task_id)
             if task:
                 snap = {"task_id": task_id, **task.video_status.model_dump()}
                 yield f"data: {json.dumps(snap)}\n\n"
+                if task.video_status.status in TERMINAL_STATUSES:
+                    return
 
-            async for msg in pubsub.listen():
-                if msg.get("type") != "message":
+            while True:
+                try:
+                    data = await asyncio.wait_for(queue.get(), timeout=SSE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    if loop.time() - last_sent >= settings.SSE_HEARTBEAT_SECONDS:
+                        last_sent = loop.time()
+                        yield ": ping\n\n"
                     continue
-                data = msg.get("data")
+
+                last_sent = loop.time()
                 yield f"data: {data}\n\n"
 
                 try:
                     payload = json.loads(data)
-                    if payload.get("status") in ("completed", "error", "done", "canceled"):
+                    if payload.get("status") in TERMINAL_STATUSES:
                         break
                 except Exception:
                     pass
                 if await request.is_disconnected():
                     break
         finally:
-            with suppress(Exception):
-                await pubsub.unsubscribe(channel)
-                await pubsub.close()
+            progress_dispatcher.unsubscribe(task_id, queue)
 
     return StreamingResponse(
         event_generator(),
@@ -192,6 +248,86 @@ async def download_events(request: Request, task_id: Annotated[str, Path()]):
     )
 
 
+@router.websocket("/ws")
+async def progress_websocket(websocket: WebSocket):
+    """WebSocket-канал прогресса сразу по нескольким задачам.
+
+    Клиент шлёт ``{"action": "subscribe"|"unsubscribe", "task_ids": [...]}``.
+    На подписку приходит ``snapshot`` с полным статусом, далее — ``update`` только с изменившимися полями.
+    """
+    await websocket.accept()
+    buffer = LatestEventsBuffer()
+    sent: dict[str, dict] = {}
+    send_lock = asyncio.Lock()
+
+    async def send(message: dict):
+        async with send_lock:
+            await websocket.send_text(json.dumps(message, ensure_ascii=False, separators=(",", ":")))
+
+    async def send_state(task_id: str, state: dict):
+        previous = sent.get(task_id)
+        if previous is None:
+            message = {"type": "snapshot", **state}
+        else:
+            delta = {k: v for k, v in state.items() if previous.get(k) != v}
+            if not delta:
+                return
+            message = {"type": "update", **delta}
+        message["task_id"] = task_id
+        sent[task_id] = state
+        await send(message)
+
+    async def subscribe(task_id: str):
+        if task_id in sent:
+            return
+        if len(sent) >= settings.WS_MAX_SUBSCRIPTIONS:
+            await send({"type": "error", "task_id": task_id, "detail": "Too many subscriptions"})
+            return
+        try:
+            uuid.UUID(task_id)
+        except ValueError:
+            await send({"type": "error", "task_id": task_id, "detail": "invalid task_id"})
+            return
+        await progress_dispatcher.subscribe(task_id, buffer)
+        task = await redis_cache.get_download_task(task_id)
+        if task is None:
+            progress_dispatcher.unsubscribe(task_id, buffer)
+            await send({"type": "error", "task_id": task_id, "detail": "Task not found"})
+            return
+        await send_state(task_id, {"task_id": task_id, **task.video_status.model_dump()})
+
+    async def forward_events():
+        while True:
+            for task_id, data in (await buffer.get()).items():
+                if task_id in sent:
+                    await send_state(task_id, json.loads(data))
+
+    forwarder = asyncio.create_task(forward_events())
+    try:
+        while True:
+            try:
+                command = json.loads(await websocket.receive_text())
+            except ValueError:
+                await send({"type": "error", "detail": "invalid message"})
+                continue
+            if not isinstance(command, dict):
+                continue
+            task_ids = [str(t) for t in (command.get("task_ids") or [])]
+            if command.get("action") == "subscribe":
+                for task_id in task_ids:
+                    await subscribe(task_id)
+            elif command.get("action") == "unsubscribe":
+                for task_id in task_ids:
+                    progress_dispatcher.unsubscribe(task_id, buffer)
+                    sent.pop(task_id, None)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        forwarder.cancel()
+        for task_id in list(sent):
+            progress_dispatcher.unsubscribe(task_id, buffer)
+
+
 @router.post("/cancel/{task_id}")
 @check_task_id
 async def cancel_download(task_id: Annotated[str, Path()]):
@@ -204,6 +340,10 @@ async def cancel_download(task_id: Annotated[str, Path()]):
     task.video_status.description = "Canceled by user"
     await redis_cache.set_download_task(task)
     await redis_cache.set_task_canceled(task_id)
+    # общее задание останавливаем, только когда от него отказались все присоединённые задачи
+    job_id = await inflight_jobs.release(task_id)
+    if job_id:
+        await redis_cache.set_task_canceled(job_id)
 
     user_id = await redis_cache.get_task_user(task_id)
     if user_id:
@@ -248,13 +388,12 @@ async def get_downloaded_video(task_id: Annotated[str, Path()]):
 
     headers = {
         "Content-Disposition": f"attachment; filename*=UTF-8''{encoded_name}{extension}; filename=\"{ascii_fallback}{extension}\"",
-        "Content-Length": str(task.filepath.stat().st_size),
         "Cache-Control": "no-cache",
-        "Accept-Ranges": "bytes",
     }
-    return StreamingResponse(
-        stream_file(task.filepath, task),
-        media_type="application/octet-stream",
+    # Content-Length, Accept-Ranges, ETag и Last-Modified ставит сам ответ
+    return DownloadFileResponse(
+        task,
+        media_type=media_type(task.filepath),
         headers=headers
     )
 
@@ -1,4 +1,4 @@
-from typing import BinaryIO
+from typing import BinaryIO, Optional
 
 import urllib3
 from minio import Minio
@@ -29,12 +29,30 @@ class S3Client:
             self.client.make_bucket(bucket_name)
 
 
-    def upload_file(self, key: str, body: BinaryIO, size:int, folder: str = None, extension: str = "") -> str:
-        """Загружает файл в Minio и возвращает его URL"""
-
+    @staticmethod
+    def _object_name(key: str, folder: str = None, extension: str = "") -> str:
         object_name = remove_all_spec_chars(key) + extension
         if folder:
             object_name = remove_all_spec_chars(folder) + "/" + object_name
+        return object_name
+
+    def _url(self, object_name: str) -> str:
+        return f"{self.config['endpoint_url']}/{self.bucket_name}/{object_name}"
+
+    def file_url(self, key: str, folder: str = None, extension: str = "") -> Optional[str]:
+        """URL уже загруженного файла или None, если его нет"""
+        object_name = self._object_name(key, folder, extension)
+        try:
+            self.client.stat_object(self.bucket_name, object_name)
+        except S3Error:
+            return None
+        return self._url(object_name)
+
+    def upload_file(self, key: str, body: BinaryIO, size:int, folder: str = None, extension: str = "",
+                    content_type: str = "application/octet-stream", cache_control: Optional[str] = None) -> str:
+        """Загружает файл в Minio и возвращает его URL"""
+
+        object_name = self._object_name(key, folder, extension)
 
         try:
             result = self.client.put_object(
@@ -42,8 +60,10 @@ class S3Client:
                 object_name=object_name,
                 data=body,
                 length=size,
+                content_type=content_type,
+                metadata={"Cache-Control": cache_control} if cache_control else None,
             )
-            return f"{self.config['endpoint_url']}/{self.bucket_name}/{result.object_name}"
+            return self._url(result.object_name)
         except S3Error as err:
             print(f"Ошибка при загрузке файла: {err}")
             return ""
@@ -1,5 +1,5 @@
 from dataclasses import field
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import BaseModel
 
@@ -8,11 +8,16 @@ class SVideoRequest(BaseModel):
     url: str
 
 
+AudioContainerName = Literal["m4a", "opus", "mp3"]
+ClipModeName = Literal["copy", "smart"]
+
+
 class SVideoFormat(BaseModel):
     quality: str
     filesize: Optional[int] = field(default=0)
     video_format_id: str
     audio_format_id: str
+    container: Optional[AudioContainerName] = field(default=None)
 
 
 class SVideoDownload(BaseModel):
@@ -21,6 +26,10 @@ class SVideoDownload(BaseModel):
     audio_format_id: str
     start_seconds: Optional[int] = field(default=None)
     end_seconds: Optional[int] = field(default=None)
+    # только для «только аудио»; без него — MP3, как раньше
+    container: Optional[AudioContainerName] = field(default=None)
+    # smart — покадрово точная обрезка; без него — по ключевым кадрам
+    clip_mode: Optional[ClipModeName] = field(default=None)
 
 
 class SVideoResponse(BaseModel):
@@ -0,0 +1,227 @@
+import asyncio
+import inspect
+import os
+import platform
+import re
+import signal
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, Sequence
+
+from app.config import settings
+from app.exceptions import DownloadUserCanceledException, FFmpegError, FFmpegTimeoutError
+
+
+if platform.system() == 'Windows':
+    FFMPEG = settings.FFMPEG_PATH
+    FFPROBE = os.path.join(os.path.dirname(settings.FFMPEG_PATH), "ffprobe")
+else:
+    FFMPEG = "ffmpeg"
+    FFPROBE = "ffprobe"
+
+PROBE_TIMEOUT_SECONDS = 60
+
+
+class AudioContainer:
+    """Контейнер задачи «только аудио»: m4a (AAC) и opus принимают дорожку источника как есть, mp3 — перекодирование."""
+    M4A = "m4a"
+    OPUS = "opus"
+    MP3 = "mp3"
+
+
+AUDIO_CODEC_ARGS = {
+    ".m4a": ["-c:a", "copy"],
+    ".opus": ["-c:a", "copy"],
+    ".mp3": ["-acodec", "libmp3lame", "-q:a", "2"],  # VBR (0-9, где 0 лучшее)
+}
+# Кодеки, которые контейнер принимает копией; дорожку в другом кодеке приходится перекодировать
+AUDIO_COPY_CODECS = {
+    ".m4a": ("aac", "alac"),
+    ".opus": ("opus",),
+}
+AUDIO_ENCODE_ARGS = {
+    ".m4a": ["-c:a", "aac", "-b:a", "192k"],
+    ".opus": ["-c:a", "libopus", "-b:a", "160k"],
+}
+
+
+def build_ffmpeg_headers_arg(headers: Optional[Dict[str, str]]) -> list[str]:
+    if not headers:
+        return []
+    # ffmpeg expects CRLF-separated header lines in one string after -headers
+    header_lines = []
+    for key, value in headers.items():
+        header_lines.append(f"{key}: {value}")
+    header_blob = "\r\n".join(header_lines)
+    return ["-headers", header_blob]
+
+
+def audio_codec_args(output_path: str, source_codec: Optional[str] = None) -> list[str]:
+    """Аргументы кодека для аудиофайла по его расширению.
+
+    Копия выбирается, если контейнер принимает ``source_codec`` (или кодек неизвестен),
+    иначе — перекодирование (например, AAC в opus через libopus).
+    """
+    suffix = os.path.splitext(output_path)[1].lower()
+    if source_codec and suffix in AUDIO_COPY_CODECS and source_codec not in AUDIO_COPY_CODECS[suffix]:
+        return AUDIO_ENCODE_ARGS[suffix]
+    return AUDIO_CODEC_ARGS[suffix]
+
+
+# (секунд обработано, процент) — можно синхронную функцию или корутину
+ProgressCallback = Callable[[float, float], Optional[Awaitable[None]]]
+# True — задачу отменили; может и сам бросить исключение (например, DownloadCheckpointed)
+CancelCheck = Callable[[], Awaitable[bool]]
+
+STDERR_TAIL_LINES = 20
+# ffmpeg печатает уровень каждой строки (-loglevel level+...): в хвост ошибок попадают только эти
+ERROR_LEVELS = ("panic", "fatal", "error")
+LOG_LEVEL_RE = re.compile(r"\[(panic|fatal|error|warning|info|verbose|debug|trace)\] ")
+# итог каждого закрытого входа (файл, HTTP, сегмент HLS) на уровне verbose
+BYTES_READ_RE = re.compile(r"Statistics: (\d+) bytes read")
+
+
+async def _maybe_await(result) -> None:
+    if inspect.isawaitable(result):
+        await result
+
+
+def _signal_group(process: asyncio.subprocess.Process, sig: int) -> None:
+    try:
+        if os.name == "posix":
+            # ffmpeg запущен в своей группе процессов: сигнал получат и его дочерние процессы
+            os.killpg(process.pid, sig)
+        elif sig == signal.SIGTERM:
+            process.terminate()
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def _stop(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is not None:
+        return
+    _signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), timeout=5)
+    except asyncio.TimeoutError:
+        _signal_group(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+        await process.wait()
+
+
+def parse_out_time(values: dict) -> Optional[float]:
+    """Позиция обработки из блока ``-progress`` в секундах."""
+    for key in ("out_time_us", "out_time_ms"):
+        # out_time_ms у ffmpeg исторически тоже в микросекундах
+        value = values.get(key, "")
+        if value.lstrip("-").isdigit():
+            return max(0.0, int(value) / 1_000_000)
+    return None
+
+
+async def run_ffmpeg(args: Sequence[str],
+                     duration: Optional[float] = None,
+                     on_progress: Optional[ProgressCallback] = None,
+                     check_cancel: Optional[CancelCheck] = None,
+                     timeout: Optional[float] = None) -> int:
+    """Запускает ffmpeg с ``args`` и ждёт завершения, разбирая вывод ``-progress``.
+
+    На каждый блок прогресса вызывает ``check_cancel`` и ``on_progress`` (процент считается
+    от ``duration``, если она известна). Отмена корутины, отмена задачи, таймаут
+    (``FFMPEG_TIMEOUT_SECONDS`` целиком, ``FFMPEG_STALL_SECONDS`` без вывода) завершают
+    всю группу процессов ffmpeg. Ненулевой код выхода — ``FFmpegError`` с хвостом stderr.
+    Возвращает число байт, прочитанных из всех входов (для удалённых — скачанных).
+    """
+    cmd = [FFMPEG, "-hide_banner", "-nostdin", "-loglevel", "level+verbose", "-progress", "pipe:1", "-nostats", *args]
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=os.name == "posix",
+    )
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    bytes_read = 0
+
+    async def read_stderr() -> None:
+        nonlocal bytes_read
+        async for line in process.stderr:
+            text = line.decode(errors="replace").rstrip()
+            match = BYTES_READ_RE.search(text)
+            if match:
+                bytes_read += int(match.group(1))
+                continue
+            level = LOG_LEVEL_RE.search(text)
+            if level is None or level.group(1) in ERROR_LEVELS:
+                stderr_tail.append(text)
+
+    async def read_progress() -> None:
+        values = {}
+        seconds_done = 0.0
+        stall = settings.FFMPEG_STALL_SECONDS or None
+        while True:
+            try:
+                line = await asyncio.wait_for(process.stdout.readline(), timeout=stall)
+            except asyncio.TimeoutError:
+                raise FFmpegTimeoutError(f"ffmpeg produced no progress for {stall}s")
+            if not line:
+                return
+            key, _, value = line.decode(errors="replace").strip().partition("=")
+            if key != "progress":
+                values[key] = value
+                continue
+            seconds_done = parse_out_time(values) or seconds_done
+            values.clear()
+            if check_cancel is not None and await check_cancel():
+                raise DownloadUserCanceledException()
+            if on_progress is not None:
+                if value == "end":
+                    percent = 100.0
+                elif duration:
+                    percent = max(0.0, min(100.0, seconds_done / duration * 100.0))
+                else:
+                    percent = 0.0
+                await _maybe_await(on_progress(seconds_done, percent))
+
+    stderr_reader = asyncio.create_task(read_stderr())
+    timeout = timeout if timeout is not None else settings.FFMPEG_TIMEOUT_SECONDS
+    try:
+        try:
+            await asyncio.wait_for(read_progress(), timeout=timeout or None)
+        except asyncio.TimeoutError:
+            raise FFmpegTimeoutError(f"ffmpeg did not finish in {timeout}s")
+        await process.wait()
+    except BaseException:
+        # отмена, остановка воркера, таймаут или ошибка колбэка: не оставляем ffmpeg сиротой
+        await asyncio.shield(_stop(process))
+        raise
+    finally:
+        await asyncio.gather(stderr_reader, return_exceptions=True)
+
+    if process.returncode != 0:
+        raise FFmpegError(f"ffmpeg exited with code {process.returncode}", process.returncode,
+                          "\n".join(stderr_tail))
+    return bytes_read
+
+
+async def run_ffprobe(args: Sequence[str], timeout: float = PROBE_TIMEOUT_SECONDS) -> str:
+    """Запускает ffprobe и возвращает его stdout; ошибка — ``FFmpegError``."""
+    process = await asyncio.create_subprocess_exec(
+        FFPROBE, "-hide_banner", "-v", "error", *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=os.name == "posix",
+    )
+    try:
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise FFmpegTimeoutError(f"ffprobe did not finish in {timeout}s")
+    except BaseException:
+        await asyncio.shield(_stop(process))
+        raise
+    if process.returncode != 0:
+        raise FFmpegError(f"ffprobe exited with code {process.returncode}", process.returncode,
+                          stderr.decode(errors="replace").strip())
+    return stdout.decode(errors="replace")
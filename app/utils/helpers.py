@@ -1,3 +1,6 @@
+from pathlib import Path
+from typing import Optional
+
 
 def remove_all_spec_chars(key: str) -> str:
     new_key_list = []
@@ -6,4 +9,25 @@ def remove_all_spec_chars(key: str) -> str:
             new_key_list.append(char_)
         elif char_.isspace():
             new_key_list.append("_")
-    return "".join(new_key_list)
\ No newline at end of file
+    return "".join(new_key_list)
+
+
+def resume_offset(path: Path) -> int:
+    """Сколько байт файла уже скачано до контрольной точки (0 — качать с начала)."""
+    return path.stat().st_size if path.exists() else 0
+
+
+def range_headers(headers: dict, offset: int) -> dict:
+    return {**headers, "Range": f"bytes={offset}-"} if offset else headers
+
+
+def range_already_complete(status: int, offset: int, content_range: Optional[str] = None) -> bool:
+    """416 на ``bytes=<offset>-`` при докачке — файл был скачан целиком до контрольной точки.
+
+    Если сервер прислал ``Content-Range: bytes */<size>``, размер должен совпасть со
+    скачанным: иначе локальный файл не от этого ресурса, и 416 — ошибка.
+    """
+    if not offset or status != 416:
+        return False
+    size = (content_range or "").rpartition("/")[2].strip()
+    return not size.isdigit() or int(size) == offset
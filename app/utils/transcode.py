@@ -0,0 +1,78 @@
+import asyncio
+import os
+import socket
+import time
+from typing import Any, Awaitable, Callable
+
+from app.config import settings
+from app.models.cache import redis_cache
+
+
+class TranscodeExecutor:
+    """Ограничивает число одновременных CPU-тяжёлых вызовов ffmpeg в процессе.
+
+    Скачивание по сети идёт без ограничений, а перекодирование, склейка и обрезка
+    ждут свободного слота, чтобы энкодеры не делили между собой все ядра.
+    ``func`` — корутина (шаги ffmpeg из ``video_utils``); потоков она не занимает.
+    """
+
+    def __init__(self, max_workers: int, kind: str = "transcode"):
+        self.max_workers = max_workers
+        # под этим именем статистика видна в админке (``get_workers_stats``)
+        self.kind = kind
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.busy_seconds = 0.0
+        self._started_at = time.monotonic()
+
+    async def run(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        enqueued_at = time.monotonic()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        waited = time.monotonic() - enqueued_at
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.running += 1
+        await self.publish()
+        started_at = time.monotonic()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self.busy_seconds += time.monotonic() - started_at
+            self.running -= 1
+            self.completed += 1
+            self._semaphore.release()
+            await self.publish()
+
+    def stats(self) -> dict:
+        uptime = max(1e-3, time.monotonic() - self._started_at)
+        return {
+            "max_workers": self.max_workers,
+            "running": self.running,
+            "queued": self.queued,
+            "completed": self.completed,
+            "utilization": round(self.running / self.max_workers, 3),
+            "avg_utilization": round(self.busy_seconds / (uptime * self.max_workers), 3),
+            "avg_wait_seconds": round(self.total_wait / self.completed, 3) if self.completed else 0.0,
+            "max_wait_seconds": round(self.max_wait, 3),
+        }
+
+    async def publish(self) -> None:
+        try:
+            await redis_cache.set_worker_stats(self.worker_id, self.kind, self.stats())
+        except Exception as e:
+            print(f"TranscodeExecutor: failed to publish stats: {e}")
+
+
+transcoder = TranscodeExecutor(settings.TRANSCODE_CONCURRENCY or max(1, (os.cpu_count() or 2) - 1))
+# превью перекодируются в процессе API (get-formats, поиск): свой лимит, чтобы не отнимать CPU у запросов
+thumbnail_transcoder = TranscodeExecutor(settings.THUMBNAIL_CONCURRENCY, kind="thumbnail")
@@ -1,14 +1,16 @@
 import uuid
 from functools import wraps
 import inspect
+from typing import Optional
 from uuid import UUID
 from shutil import rmtree
 
 from fastapi import HTTPException, Request
 from starlette import status
 
-from app.exceptions import DownloadUserCanceledException
+from app.exceptions import DownloadCheckpointed, DownloadUserCanceledException, UpstreamUnavailableException
 from app.models.cache import redis_cache
+from app.models.drain import worker_drain
 from app.models.status import VideoDownloadStatus
 from app.models.types import DownloadTask
 from app.schemas.main import SVideoDownload
@@ -37,6 +39,23 @@ def fallback_background_task(func):
             task.video_status.description = user_canceled.__doc__
             await redis_cache.set_download_task(task)
             await redis_cache.clear_task_canceled(task_id)
+        except DownloadCheckpointed as checkpointed:
+            # частичные файлы остаются на диске: задание перезапустится и продолжит с них
+            await worker_drain.checkpointed(task_id)
+            task: DownloadTask = await redis_cache.get_download_task(task_id)
+            task.video_status.description = checkpointed.__doc__
+            task.video_status.speed_bps = None
+            task.video_status.eta_seconds = None
+            await redis_cache.set_download_task(task)
+            raise
+        except UpstreamUnavailableException as unavailable:
+            # источник отвечает ошибками: задание отложится до закрытия автомата, а не упадёт
+            task: DownloadTask = await redis_cache.get_download_task(task_id)
+            task.video_status.description = f"Waiting for {unavailable.host} to recover"
+            task.video_status.speed_bps = None
+            task.video_status.eta_seconds = None
+            await redis_cache.set_download_task(task)
+            raise
         except Exception as e:
             task.video_status.status = VideoDownloadStatus.ERROR
             task.video_status.description = str(e)
@@ -57,6 +76,11 @@ def get_user_id(func):
     return wrapper
 
 
+def client_ip(request: Request) -> Optional[str]:
+    """IP клиента; за обратным прокси его подставляет uvicorn (--proxy-headers)."""
+    return request.client.host if request.client else None
+
+
 def check_task_id(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
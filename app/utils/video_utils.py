@@ -1,62 +1,212 @@
 import asyncio
-import platform
-import subprocess
-import sys
-from typing import Callable, Optional, Dict
+import os
+import tempfile
+import time
+from typing import Optional, Dict
 from logging import getLogger
 from pathlib import Path
+from shutil import rmtree
 
 import aiofiles
 import aiohttp
+from starlette.responses import FileResponse
 from Crypto.Util.py3compat import BytesIO
 
 from app.config import settings
-from app.exceptions import DownloadUserCanceledException
+from app.exceptions import FFmpegError
 from app.models.cache import redis_cache
+from app.models.circuit import circuit_breaker
+from app.models.probe import MediaInfo
 from app.models.status import VideoDownloadStatus
 from app.models.types import DownloadTask
+from app.utils.ffmpeg import (
+    CancelCheck,
+    ProgressCallback,
+    audio_codec_args,
+    build_ffmpeg_headers_arg,
+    run_ffmpeg,
+)
+from app.utils.transcode import thumbnail_transcoder
 
 from app.s3.client import s3_client
 
 LOG = getLogger()
 
 
-if platform.system() == 'Windows':
-    FFMPEG = settings.FFMPEG_PATH
-else:
-    FFMPEG = "ffmpeg"
+# Как часто шаги ffmpeg публикуют прогресс в задачу, секунд
+PROGRESS_INTERVAL = 1.0
 
+# Через сколько секунд удалять файл, отданный через pathsend: сервер читает его уже после нашего send
+PATHSEND_UNLINK_DELAY = 60.0
 
+# Фоновые удаления отданных файлов (ссылки держим, чтобы задачи не собрал GC)
+_pending_unlinks: set[asyncio.Task] = set()
 
-async def stream_file(file_path: Path, task: DownloadTask, chunk_size: int = 1024 * 1024):
-    task_id = task.video_status.task_id
-    try:
-        async with aiofiles.open(file_path, "rb") as file:
-            while chunk := await file.read(chunk_size):
-                yield chunk
-    finally:
-        await asyncio.sleep(1)
-        file_path.unlink()
-        print(f"Video Utils: stream_file - {file_path} is deleted.")
-        task.video_status.status = VideoDownloadStatus.DONE
-        task.video_status.description = VideoDownloadStatus.DONE
-        await redis_cache.set_download_task(task)
+# MIME-типы отдаваемых файлов по расширению
+MEDIA_TYPES = {
+    ".mp4": "video/mp4",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".opus": "audio/ogg",
+}
+
+
+class ThumbnailVariant:
+    CARD = "card"  # карточки поиска и истории
+    PLAYER = "player"  # превью на странице ролика
+
+
+# Если превью не удалось перекодировать, исходник загружается с расширением по Content-Type
+IMAGE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+}
+
+
+def media_type(file_path: Path) -> str:
+    return MEDIA_TYPES.get(file_path.suffix.lower(), "application/octet-stream")
+
+
+def _unlink_later(file_path: Path, delay: float) -> None:
+    """Удаляет файл фоном через ``delay`` секунд; если процесс упадёт раньше, DONE-файл уберёт janitor."""
+    async def unlink() -> None:
+        await asyncio.sleep(delay)
+        file_path.unlink(missing_ok=True)
+        print(f"Video Utils: {file_path} is delivered and deleted.")
+
+    task = asyncio.create_task(unlink())
+    _pending_unlinks.add(task)
+    task.add_done_callback(_pending_unlinks.discard)
+
+
+class DownloadFileResponse(FileResponse):
+    """Отдача готового файла задачи: Range (206, в том числе multipart/byteranges), If-Range по ETag/Last-Modified.
+
+    Если ASGI-сервер поддерживает расширение ``http.response.pathsend``, файл целиком
+    отправляет сам сервер (sendfile), без чтения в Python. После полной отдачи (200)
+    задача становится DONE, а файл удаляется (при pathsend — фоном, с задержкой).
+    Частичные ответы (206) ни файл, ни задачу не трогают: по файлу докачивают и качают
+    в несколько потоков, а какие куски уже отданы, мы не отслеживаем. Такой файл
+    остаётся до истечения TTL задачи (``TASK_TTL_COMPLETED``), после чего его убирает
+    janitor. Оборванная отдача тоже ничего не меняет: загрузку можно продолжить.
+    """
+
+    chunk_size = 1024 * 1024
 
+    def __init__(self, task: DownloadTask, **kwargs):
+        super().__init__(task.filepath, stat_result=task.filepath.stat(), **kwargs)
+        self.task = task
 
-async def save_preview_on_s3(preview_url: str, key: str, folder: str = None) -> str:
-    async with aiohttp.ClientSession() as session:
+    async def __call__(self, scope, receive, send) -> None:
+        response = {"status": None, "complete": False, "pathsend": False}
+
+        async def tracked_send(message) -> None:
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.pathsend":
+                response["complete"] = response["pathsend"] = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                response["complete"] = True
+
+        try:
+            await super().__call__(scope, receive, tracked_send)
+        finally:
+            if response["complete"] and scope.get("method", "GET").upper() == "GET":
+                await self._delivered(response["status"], response["pathsend"])
+
+    async def _delivered(self, status_code: int, pathsend: bool) -> None:
+        if status_code != 200:
+            return
+        self.task.video_status.status = VideoDownloadStatus.DONE
+        self.task.video_status.description = VideoDownloadStatus.DONE
+        await redis_cache.set_download_task(self.task)
+        file_path = Path(self.path)
+        if pathsend:
+            _unlink_later(file_path, PATHSEND_UNLINK_DELAY)
+        else:
+            file_path.unlink(missing_ok=True)
+            print(f"Video Utils: {file_path} is delivered and deleted.")
+
+
+async def transcode_thumbnail(source_path: str, output_dir: str) -> Dict[str, str]:
+    """Декодирует картинку один раз и пишет WebP каждого варианта ``THUMBNAIL_VARIANTS`` одним вызовом ffmpeg.
+
+    Варианты только уменьшаются до своей ширины, пропорции сохраняются.
+    """
+    variants = settings.THUMBNAIL_VARIANTS
+    graph = [f"[0:v]split={len(variants)}" + "".join(f"[{name}_src]" for name in variants)]
+    graph += [f"[{name}_src]scale='min(iw,{width})':-1[{name}]" for name, width in variants.items()]
+    args = ["-i", source_path, "-filter_complex", ";".join(graph)]
+    outputs = {}
+    for name in variants:
+        outputs[name] = os.path.join(output_dir, f"{name}.webp")
+        args += [
+            "-map", f"[{name}]",
+            "-frames:v", "1",
+            "-c:v", "libwebp",
+            "-quality", str(settings.THUMBNAIL_QUALITY),
+            "-y", outputs[name],
+        ]
+    await run_ffmpeg(args)
+    return outputs
+
+
+async def save_preview_on_s3(preview_url: str, key: str, folder: str = None,
+                             variant: str = ThumbnailVariant.PLAYER) -> str:
+    """Загружает превью в S3 вариантами WebP и возвращает URL варианта ``variant``.
+
+    Варианты лежат рядом под именами ``<key>_<variant>.webp``; уже загруженный вариант
+    не скачивается и не перекодируется заново. Если ffmpeg не смог разобрать картинку,
+    загружается исходник как есть.
+    """
+    existing = await asyncio.to_thread(s3_client.file_url, key, folder, f"_{variant}.webp")
+    if existing:
+        return existing
+    async with aiohttp.ClientSession(trace_configs=[circuit_breaker.trace_config()]) as session:
         async with session.get(preview_url) as resp:
             content = await resp.content.read()
-            return s3_client.upload_file(
+            content_type = resp.content_type
+
+    cache_control = f"public, max-age={settings.THUMBNAIL_CACHE_SECONDS}"
+    with tempfile.TemporaryDirectory(prefix="preview_") as tmp_dir:
+        source_path = os.path.join(tmp_dir, "source")
+        async with aiofiles.open(source_path, "wb") as f:
+            await f.write(content)
+        try:
+            outputs = await thumbnail_transcoder.run(transcode_thumbnail, source_path, tmp_dir)
+        except (FFmpegError, OSError) as e:
+            print(f"Video Utils: failed to transcode preview {preview_url}: {e}")
+            return await asyncio.to_thread(
+                s3_client.upload_file,
                 key,
                 BytesIO(content),
                 len(content),
                 folder=folder,
-                extension=".png",
+                extension=IMAGE_EXTENSIONS.get(content_type, ".png"),
+                content_type=content_type if content_type in IMAGE_EXTENSIONS else "application/octet-stream",
+                cache_control=cache_control,
+            )
+
+        urls = {}
+        for name, path in outputs.items():
+            async with aiofiles.open(path, "rb") as f:
+                data = await f.read()
+            urls[name] = await asyncio.to_thread(
+                s3_client.upload_file,
+                key,
+                BytesIO(data),
+                len(data),
+                folder=folder,
+                extension=f"_{name}.webp",
+                content_type="image/webp",
+                cache_control=cache_control,
             )
+    return urls.get(variant) or next(iter(urls.values()), "")
 
 
-def combine_audio_and_video(video_path, audio_path, output_path):
+async def combine_audio_and_video(video_path, audio_path, output_path, **progress):
     """
     Накладывает аудио на видео.
 
@@ -64,9 +214,9 @@ def combine_audio_and_video(video_path, audio_path, output_path):
         video_path (str): Путь к исходному видеофайлу.
         audio_path (str): Путь к аудиофайлу, который нужно наложить.
         output_path (str): Путь для сохранения результирующего видеофайла.
+        progress: duration / on_progress / check_cancel для run_ffmpeg (см. task_progress).
     """
-    subprocess.run([
-        FFMPEG,
+    await run_ffmpeg([
         "-i", video_path,  # видео без звука
         "-i", audio_path,  # источник звука
         "-c:v", "copy",  # копируем видео как есть
@@ -76,32 +226,33 @@ def combine_audio_and_video(video_path, audio_path, output_path):
         "-shortest",  # обрезаем по короткому
         "-y",  # перезапись без подтверждения
         output_path
-    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ], **progress)
 
 
-def convert_to_mp3(input_path: str, output_path: str):
+async def extract_audio(input_path: str, output_path: str, source_codec: Optional[str] = None, **progress):
     """
-    Конвертирует аудио в MP3 формат.
+    Сохраняет звук в аудиофайл: в MP3 с перекодированием, в m4a/opus — копированием дорожки.
 
     Args:
-        input_path (str): Путь к исходному аудио файлу
-        output_path (str): Путь для сохранения MP3
+        input_path (str): Путь к исходному файлу
+        output_path (str): Путь для сохранения; контейнер и кодек выбираются по расширению
+        source_codec (str, optional): Кодек звука источника; если контейнер его не принимает, дорожка перекодируется
+        progress: duration / on_progress / check_cancel для run_ffmpeg (см. task_progress).
     """
-    subprocess.run([
-        FFMPEG,
+    await run_ffmpeg([
         "-i", input_path,
         "-vn",  # отключаем видео
-        "-acodec", "libmp3lame",  # используем MP3 кодек
-        "-q:a", "2",  # качество VBR (0-9, где 0 лучшее)
+        *audio_codec_args(output_path, source_codec),
         "-y",  # перезапись без подтверждения
         output_path
-    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ], **progress)
 
 
-def cut_media(input_path: str,
-              output_path: str,
-              start_seconds: Optional[int] = None,
-              end_seconds: Optional[int] = None):
+async def cut_media(input_path: str,
+                    output_path: str,
+                    start_seconds: Optional[int] = None,
+                    end_seconds: Optional[int] = None,
+                    **progress):
     """
     Безперекодировочная обрезка файла по времени.
 
@@ -109,50 +260,141 @@ def cut_media(input_path: str,
     Если задан только end_seconds — отрезает от начала до end.
     Если заданы оба — отрезает интервал [start, end).
     """
-    cmd = [FFMPEG]
+    cmd = []
     if start_seconds is not None:
         cmd += ["-ss", str(start_seconds)]
     if end_seconds is not None:
         cmd += ["-to", str(end_seconds+1)]
     cmd += ["-i", input_path, "-c", "copy", "-y", output_path]
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-
-def _build_ffmpeg_headers_arg(headers: Optional[Dict[str, str]]) -> list[str]:
-    if not headers:
-        return []
-    # ffmpeg expects CRLF-separated header lines in one string after -headers
-    header_lines = []
-    for key, value in headers.items():
-        header_lines.append(f"{key}: {value}")
-    header_blob = "\r\n".join(header_lines)
-    return ["-headers", header_blob]
-
-
-def download_hls_to_file(audio_hls_url: str,
-                         output_path: str,
-                         duration_seconds: int,
-                         video_hls_url: str = None,
-                         on_progress: Optional[Callable[[float, float], None]] = None,
-                         headers: Optional[Dict[str, str]] = None,
-                         check_cancel = None,
-                         ) -> None:
-    headers_arg = _build_ffmpeg_headers_arg(headers)
+    await run_ffmpeg(cmd, **progress)
+
+
+# профили ffprobe -> -profile:v libx264, чтобы перекодированные границы склеивались с исходной серединой
+X264_PROFILES = {"Constrained Baseline": "baseline", "Baseline": "baseline", "Main": "main", "High": "high"}
+# ключевой кадр ближе этого к границе считается попаданием в неё
+SMART_CUT_EPSILON = 0.01
+
+
+async def smart_cut(video_path: str,
+                    output_path: str,
+                    media: MediaInfo,
+                    start_seconds: Optional[float] = None,
+                    end_seconds: Optional[float] = None,
+                    audio_path: Optional[str] = None,
+                    **progress):
+    """
+    Покадрово точная обрезка почти со скоростью копирования (smart cut).
+
+    Перекодируются только неполные GOP на границах фрагмента, всё между ключевыми
+    кадрами копируется как есть; куски склеиваются concat-демультиплексором, а звук
+    (из audio_path или из самого видео) режется отдельно копированием.
+    media — сведения о video_path с индексом ключевых кадров (см. media_probe).
+    Поддерживается только H.264 — для остальных кодеков FFmpegError.
+
+    Ограничение: у перекодированных кусков свои SPS/PPS, отличные от параметров
+    скопированной середины. В MPEG-TS они идут в потоке перед каждым IDR, но MP4 хранит
+    один набор (avcC первого куска), так что плееры, которые не читают параметры из
+    потока, могут показать середину с артефактами. Профиль и pix_fmt источника
+    сохраняются, чтобы параметры совпадали как можно ближе; при проблемах — ClipMode.COPY.
+    """
+    stream = media.video or {}
+    if stream.get("codec_name") != "h264":
+        raise FFmpegError(f"smart cut does not support {stream.get('codec_name')} video", 0, "")
+    start = float(start_seconds or 0)
+    # границы точные: +1 секунда в cut_media нужна только копированию, которое режет по ключевым кадрам
+    end = float(end_seconds) if end_seconds is not None else media.duration
+    if end is None or end <= start:
+        raise FFmpegError("smart cut needs a known clip end", 0, "")
+
+    keyframes = media.keyframes_between(start, end)
+    if keyframes:
+        head_end, tail_start = keyframes[0], keyframes[-1]
+    else:
+        # весь фрагмент внутри одного GOP
+        head_end = tail_start = end
+
+    encode = ["-an", "-c:v", "libx264", "-preset", settings.CLIP_SMART_PRESET, "-crf", str(settings.CLIP_SMART_CRF)]
+    if stream.get("pix_fmt"):
+        encode += ["-pix_fmt", stream["pix_fmt"]]
+    if stream.get("profile") in X264_PROFILES:
+        encode += ["-profile:v", X264_PROFILES[stream["profile"]]]
+    copy = ["-an", "-c:v", "copy", "-bsf:v", "h264_mp4toannexb"]
+    pieces = [
+        (start, head_end, encode),
+        (head_end, tail_start, copy),
+        (tail_start, end, encode),
+    ]
+
+    check_cancel = {"check_cancel": progress["check_cancel"]} if progress.get("check_cancel") else {}
+    parts_dir = Path(output_path).with_name(Path(output_path).stem + "_parts")
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        parts = []
+        for piece_start, piece_end, codec_args in pieces:
+            if piece_end - piece_start < SMART_CUT_EPSILON:
+                continue
+            part = parts_dir / f"part_{len(parts)}.ts"
+            await run_ffmpeg(["-ss", str(piece_start), "-i", video_path, "-t", str(piece_end - piece_start),
+                              *codec_args, "-f", "mpegts", "-y", part.as_posix()], **check_cancel)
+            parts.append(part)
+
+        concat_list = parts_dir / "parts.txt"
+        concat_list.write_text("".join(f"file '{part.as_posix()}'\n" for part in parts))
+        await run_ffmpeg([
+            "-f", "concat", "-safe", "0", "-i", concat_list.as_posix(),
+            "-ss", str(start), "-t", str(end - start), "-i", audio_path or video_path,
+            "-map", "0:v:0", "-map", "1:a:0?",
+            "-c", "copy",
+            "-movflags", "+faststart",
+            "-y", output_path,
+        ], **progress)
+    finally:
+        rmtree(parts_dir, ignore_errors=True)
+
+
+def task_progress(task: DownloadTask, duration: Optional[float] = None) -> dict:
+    """Аргументы run_ffmpeg, которые показывают прогресс шага в задаче и останавливают его при отмене."""
+    last_published = 0.0
+
+    async def on_progress(seconds_done: float, percent: float):
+        nonlocal last_published
+        now = time.monotonic()
+        if percent < 100 and now - last_published < PROGRESS_INTERVAL:
+            return
+        last_published = now
+        task.video_status.percent = round(percent, 1)
+        await redis_cache.set_download_task(task)
+
+    async def check_cancel() -> bool:
+        return await redis_cache.is_task_canceled(task.id_)
+
+    return {
+        "duration": duration or task.video_status.video.duration,
+        "on_progress": on_progress,
+        "check_cancel": check_cancel,
+    }
+
+
+async def download_hls_to_file(audio_hls_url: str,
+                               output_path: str,
+                               duration_seconds: int,
+                               video_hls_url: str = None,
+                               on_progress: Optional[ProgressCallback] = None,
+                               headers: Optional[Dict[str, str]] = None,
+                               check_cancel: Optional[CancelCheck] = None,
+                               ) -> int:
+    headers_arg = build_ffmpeg_headers_arg(headers)
     if video_hls_url is None:
         cmd = [
-            FFMPEG,
             *headers_arg, "-i", audio_hls_url,
             "-c", "copy",
             "-bsf:a", "aac_adtstoasc",
             "-movflags", "+faststart",
-            "-progress", "pipe:1",
-            "-loglevel", "error",
             "-y",
             output_path,
         ]
     else:
         cmd = [
-            FFMPEG,
             *headers_arg, "-i", video_hls_url,
             *headers_arg, "-i", audio_hls_url,
             "-c:v", "copy",
@@ -162,57 +404,7 @@ def download_hls_to_file(audio_hls_url: str,
             "-map", "1:a:0",
             "-shortest",
             "-movflags", "+faststart",
-            "-progress", "pipe:1",
-            "-loglevel", "error",
             "-y",
             output_path,
         ]
-
-    process = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1,
-    )
-
-    seconds_done = 0.0
-    try:
-        if process.stdout is not None:
-            for line in process.stdout:
-                line = line.strip()
-                if check_cancel and check_cancel():
-                    process.terminate()
-                    raise DownloadUserCanceledException()
-                if line.startswith("out_time_ms="):
-                    try:
-                        out_time_ms = float(line.split("=", 1)[1])
-                        seconds_done = out_time_ms / 1_000_000.0
-                        if duration_seconds and duration_seconds > 0:
-                            percent = max(0.0, min(100.0, (seconds_done / duration_seconds) * 100.0))
-                        else:
-                            percent = 0.0
-                        if on_progress:
-                            on_progress(seconds_done, percent)
-                    except Exception:
-                        # Ignore parse errors, continue
-                        pass
-                elif line == "progress=end":
-                    # Completed
-                    percent = 100.0
-                    if on_progress:
-                        on_progress(seconds_done, percent)
-        # Wait for process to exit
-        process.wait()
-        if process.returncode != 0:
-            # capture stderr for diagnostics
-            err = process.stderr.read() if process.stderr else ""
-            raise RuntimeError(f"ffmpeg failed with code {process.returncode}: {err}")
-    finally:
-        try:
-            if process.stdout:
-                process.stdout.close()
-            if process.stderr:
-                process.stderr.close()
-        except Exception:
-            pass
+    return await run_ffmpeg(cmd, duration=duration_seconds, on_progress=on_progress, check_cancel=check_cancel)
@@ -1,8 +1,64 @@
-from arq.connections import RedisSettings
+import asyncio
+import math
+import signal
+
+from arq import cron, func, Retry
+from arq.worker import Worker, create_worker
 
 from app.config import settings
+from app.exceptions import DownloadCheckpointed, UpstreamUnavailableException
+from app.models.bandwidth import bandwidth
 from app.models.cache import redis_cache
+from app.models.circuit import circuit_breaker
+from app.models.connections import redis_connections
+from app.models.drain import worker_drain
+from app.models.events import progress_dispatcher
+from app.models.inflight import inflight_jobs, job_signature
+from app.models.janitor import cron_schedule, scratch_janitor, storage_janitor
+from app.models.queue import QueueName, arq_queue_name
+from app.models.scheduler import service_slots
+from app.models.scratch import scratch_space
 from app.models.services import VideoServicesManager
+from app.models.speculation import SPECULATIVE_USER, speculative_prefetch
+from app.models.status import VideoDownloadStatus
+
+
+async def mark_attached(task) -> None:
+    task.video_status.description = "Joined an identical download"
+    await redis_cache.set_download_task(task)
+
+
+async def circuit_wait(service, url: str) -> float:
+    """Сколько ждать, пока закроются автоматы хостов, от которых зависит загрузка."""
+    waits = [await circuit_breaker.open_for(host) for host in service.circuit_hosts(url)]
+    return max(waits, default=0.0)
+
+
+async def fail_task(task, description: str) -> None:
+    """Завершает задачу ошибкой: снимает её ссылку на общее задание inflight и блокировку пользователя."""
+    job_id = await inflight_jobs.release(task.id_)
+    if job_id:
+        await redis_cache.set_task_canceled(job_id)
+    await redis_cache.clear_task_deferrals(task.id_)
+    task = await redis_cache.get_download_task(task.id_) or task
+    if task.video_status.status != VideoDownloadStatus.PENDING:
+        return
+    task.video_status.status = VideoDownloadStatus.ERROR
+    task.video_status.description = description
+    # set_download_task для ERROR отпускает active-блокировку пользователя
+    await redis_cache.set_download_task(task)
+
+
+async def defer(task, seconds: float) -> None:
+    """Откладывает задачу через arq ``Retry``; после ``WORKER_MAX_DEFERRALS`` отсрочек завершает её ошибкой.
+
+    Отсрочки считаются отдельно от попыток: arq ``max_tries`` покрывает обе, а упавшие
+    прогоны ограничивает ``WORKER_MAX_TRIES`` (см. начало ``download_video``).
+    """
+    if await redis_cache.incr_task_deferrals(task.id_) > settings.WORKER_MAX_DEFERRALS:
+        await fail_task(task, "Timed out waiting for the download to start")
+        return
+    raise Retry(defer=seconds)
 
 
 async def download_video(ctx, task_id: str):
@@ -10,17 +66,168 @@ async def download_video(ctx, task_id: str):
     if not task:
         return
     service = VideoServicesManager.get_service(task.video_status.video.url)
-    parser = service.parser(task.video_status.video.url)
-    await parser.download(task_id, task.download)
+    is_pending = task.video_status.status == VideoDownloadStatus.PENDING
+
+    signature = None
+    if inflight_jobs.enabled and task.download is not None:
+        signature = job_signature(service, task.download)
+    # задача могла быть отменена, пока её job ждал перезапуска, а отложенное им общее задание нужно другим
+    if not is_pending and not (signature and await inflight_jobs.has_parked(signature)):
+        return
+    # прогоны, не закончившиеся отсрочкой: упавшие, оборванные рестартом или по таймауту
+    if ctx.get("job_try", 1) - await redis_cache.get_task_deferrals(task_id) > settings.WORKER_MAX_TRIES:
+        await fail_task(task, "Download failed after several attempts")
+        return
+    if is_pending and signature and await inflight_jobs.attach(task_id, signature):
+        await mark_attached(task)
+        return
+    if is_pending and signature and await speculative_prefetch.claim(task, signature):
+        return
+
+    upstream_wait = await circuit_wait(service, task.video_status.video.url)
+    if upstream_wait:
+        # не занимаем слот задачей, которая сразу упадёт на недоступном источнике
+        if is_pending:
+            task.video_status.description = "Waiting for the video service to recover"
+            await redis_cache.set_download_task(task)
+        await defer(task, math.ceil(upstream_wait))
+        return
+
+    if not service_slots.try_acquire(service):
+        if ctx.get("job_try", 1) == 1:
+            task.video_status.description = "Waiting in queue"
+            await redis_cache.set_download_task(task)
+        await service_slots.publish()
+        await defer(task, service_slots.defer_seconds(ctx.get("job_try", 1)))
+        return
+
+    try:
+        await service_slots.publish()
+        if not await scratch_space.reserve(task_id, scratch_space.estimate(task)):
+            # ждём, пока освободится место на диске, не занимая слот
+            if is_pending:
+                task.video_status.description = "Waiting for free disk space"
+                await redis_cache.set_download_task(task)
+            await defer(task, settings.SCRATCH_RETRY_SECONDS)
+            return
+        parser = service.parser(task.video_status.video.url)
+        # полосу делим по владельцу задачи, а не по ID, под которым качает парсер
+        user_id = await redis_cache.get_task_user(task_id)
+        if signature is None:
+            with worker_drain.track(task_id), bandwidth.owner(task_id, user_id):
+                await parser.download(task_id, task.download)
+            return
+
+        job_id = await inflight_jobs.resume_parked(signature)
+        if job_id is None:
+            if not is_pending:
+                return
+            job_id = inflight_jobs.new_job_id()
+            if await inflight_jobs.attach(task_id, signature, job_id) != job_id:
+                # пока ждали слот, такое же задание успел начать другой воркер
+                await mark_attached(task)
+                return
+        elif is_pending:
+            await inflight_jobs.attach(task_id, signature)
+        scratch_space.track(task_id, job_id)
+        await inflight_jobs.create_job_task(task, job_id)
+        with worker_drain.track(job_id), bandwidth.owner(job_id, user_id):
+            await inflight_jobs.run(signature, job_id, lambda job: parser.download(job, task.download))
+        if user_id == SPECULATIVE_USER:
+            await speculative_prefetch.finished(task_id)
+    except DownloadCheckpointed:
+        # воркер останавливается: задание вернётся в очередь и продолжится с частичных файлов
+        await defer(task, 1)
+    except UpstreamUnavailableException as e:
+        await defer(task, max(1, math.ceil(e.retry_after)))
+    finally:
+        service_slots.release(service)
+        await service_slots.publish()
+        await scratch_space.release(task_id)
+
+
+async def cleanup_storage(ctx):
+    report = await storage_janitor.run()
+    if scratch_janitor is not None:
+        report.bytes_reclaimed += (await scratch_janitor.run()).bytes_reclaimed
+    return report.bytes_reclaimed
+
+
+async def expire_speculations(ctx):
+    return await speculative_prefetch.expire()
 
 
 class WorkerSettings:
-    redis_settings = RedisSettings(
-        host=settings.REDIS_HOST,
-        port=settings.REDIS_PORT,
-        database=settings.REDIS_DB,
-    )
-    functions = [download_video]
+    redis_settings = redis_connections.arq_settings()
+    # лимиты отсрочек и попыток проверяет сама download_video; arq не должен снять задачу раньше
+    functions = [func(download_video, max_tries=settings.WORKER_MAX_DEFERRALS + settings.WORKER_MAX_TRIES + 1)]
+    max_jobs = settings.WORKER_MAX_JOBS
+    queue_name = arq_queue_name(QueueName.STANDARD)
+    cron_jobs = [
+        cron(
+            cleanup_storage,
+            **cron_schedule(settings.JANITOR_INTERVAL_MINUTES),
+            run_at_startup=True,
+            unique=True,
+        ),
+        cron(expire_speculations, second=0, unique=True),
+    ]
     job_timeout = 60 * 60
 
 
+
+
+def queue_slots(queues: dict[str, int], total_jobs: int) -> dict[str, int]:
+    """Делит max_jobs воркера между очередями по весам; каждой очереди минимум один слот."""
+    total_weight = sum(max(0, w) for w in queues.values()) or 1
+    return {name: max(1, round(total_jobs * max(0, weight) / total_weight)) for name, weight in queues.items()}
+
+
+async def run_queue_workers() -> None:
+    """Запускает по arq-воркеру на каждую очередь из WORKER_QUEUES в одном процессе.
+
+    arq читает только одну очередь на Worker, поэтому веса очередей выражены
+    через max_jobs каждого воркера; cron-задачи выполняет только первый.
+    SIGTERM/SIGINT запускают плавную остановку (см. ``WorkerDrain``), повторный сигнал — немедленную.
+    """
+    workers: list[Worker] = []
+    for i, (name, jobs) in enumerate(queue_slots(settings.WORKER_QUEUES, settings.WORKER_MAX_JOBS).items()):
+        workers.append(create_worker(
+            WorkerSettings,
+            # у каждого Worker свой пул: close() одного не должен закрывать соединения остальных
+            redis_pool=redis_connections.worker_arq(),
+            queue_name=arq_queue_name(name),
+            max_jobs=jobs,
+            cron_jobs=WorkerSettings.cron_jobs if i == 0 else None,
+            handle_signals=False,
+        ))
+        print(f"Worker: queue {name} with {jobs} slots")
+
+    async def drain_and_stop(sig: signal.Signals) -> None:
+        await worker_drain.drain(workers)
+        for w in workers:
+            w.handle_sig(sig)
+
+    def on_signal(sig: signal.Signals) -> None:
+        if worker_drain.draining:
+            # повторный сигнал — остановиться сразу, не дожидаясь контрольных точек
+            for w in workers:
+                w.handle_sig(sig)
+            return
+        asyncio.create_task(drain_and_stop(sig))
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, on_signal, sig)
+    try:
+        await asyncio.gather(*(w.async_run() for w in workers))
+    except asyncio.CancelledError:
+        # штатное завершение по сигналу: handle_sig отменяет main_task воркеров
+        pass
+    finally:
+        await asyncio.gather(*(w.close() for w in workers), return_exceptions=True)
+        await progress_dispatcher.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_queue_workers())
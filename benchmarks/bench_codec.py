@@ -0,0 +1,103 @@
+"""Сравнение кодеков кэша: время encode/decode и память Redis на 10k задач.
+
+Запуск:
+    python -m benchmarks.bench_codec
+    python -m benchmarks.bench_codec --redis redis://localhost:6379/15
+
+Без ``--redis`` оценивается только размер payload; с ним задачи пишутся в указанную
+(тестовую!) БД и суммируется ``MEMORY USAGE`` по ключам, после чего ключи удаляются.
+"""
+import argparse
+import json
+import time
+import uuid
+from pathlib import Path
+
+from app.models.codec import CODECS, PayloadSerializer
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoDownload, SVideoFormat, SVideoResponse, SVideoStatus
+
+
+def make_task() -> DownloadTask:
+    task_id = str(uuid.uuid4())
+    video = SVideoResponse(
+        url="https://www.youtube.com/watch?v=AuT338dlaaU",
+        title="Ну, Tahoe! Или «О том, как Apple дизайн ломает»",
+        author="Rozetked",
+        preview_url="https://minio.example/downloader-vidio/Rozetked/preview.png",
+        duration=1353,
+        formats=[
+            SVideoFormat(quality=f"{h}p", video_format_id=str(100 + i), audio_format_id="140", filesize=h * 1_000_000)
+            for i, h in enumerate((360, 480, 720, 1080, 1440, 2160))
+        ],
+    )
+    status = SVideoStatus(task_id=task_id, status="pending", video=video, percent=42.5,
+                          speed_bps=1_234_567.0, eta_seconds=30, created_at=time.time())
+    download = SVideoDownload(url=video.url, video_format_id="137", audio_format_id="140")
+    return DownloadTask(status, Path(f"/downloads/Rozetked/{task_id}_video.mp4"), download)
+
+
+def bench(name: str, encode, decode, items: list[dict]) -> tuple[list, float, float]:
+    started = time.perf_counter()
+    blobs = [encode(item) for item in items]
+    encode_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for blob in blobs:
+        DownloadTask.from_json(decode(blob))
+    decode_s = time.perf_counter() - started
+
+    size = sum(len(b) for b in blobs)
+    print(f"{name:<16} encode {encode_s * 1000:8.1f} ms  decode {decode_s * 1000:8.1f} ms  "
+          f"payload {size / 1024:9.1f} KiB")
+    return blobs, encode_s, decode_s
+
+
+def redis_memory(url: str, name: str, blobs: list) -> None:
+    from redis import Redis
+
+    client = Redis.from_url(url)
+    prefix = f"bench:{name}:"
+    pipe = client.pipeline(transaction=False)
+    for i, blob in enumerate(blobs):
+        pipe.set(f"{prefix}{i}", blob)
+    pipe.execute()
+
+    pipe = client.pipeline(transaction=False)
+    for i in range(len(blobs)):
+        pipe.memory_usage(f"{prefix}{i}")
+    total = sum(v or 0 for v in pipe.execute())
+    print(f"{name:<16} redis memory {total / 1024:9.1f} KiB")
+
+    for i in range(0, len(blobs), 1000):
+        client.delete(*[f"{prefix}{j}" for j in range(i, min(i + 1000, len(blobs)))])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10_000)
+    parser.add_argument("--redis", default=None, help="redis:// URL тестовой БД для замера памяти")
+    args = parser.parse_args()
+
+    items = [make_task().to_json() for _ in range(args.count)]
+    print(f"{args.count} tasks")
+
+    results = {"legacy-json": bench("legacy-json", lambda o: json.dumps(o), json.loads, items)[0]}
+    for codec in CODECS.values():
+        if not codec.available():
+            print(f"{codec.name:<16} not installed, skipped")
+            continue
+        for threshold in (0, 512):
+            serializer = PayloadSerializer(codec.name, threshold)
+            if threshold and not serializer.compress_threshold:
+                continue
+            name = codec.name + ("+zstd" if threshold else "")
+            results[name] = bench(name, serializer.encode, serializer.decode, items)[0]
+
+    if args.redis:
+        for name, blobs in results.items():
+            redis_memory(args.redis, name, blobs)
+
+
+if __name__ == "__main__":
+    main()
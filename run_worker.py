@@ -1,5 +1,6 @@
-from arq.worker import run_worker
-from app.worker import WorkerSettings
+import asyncio
+
+from app.worker import WorkerSettings, run_queue_workers
 
 
 if __name__ == "__main__":
@@ -8,6 +9,6 @@ if __name__ == "__main__":
     print("Ожидаем задачи...")
 
     try:
-        run_worker(WorkerSettings)
+        asyncio.run(run_queue_workers())
     except KeyboardInterrupt:
         print("\n⏹️ Останавливаем воркер...")
@@ -1,11 +1,27 @@
+import fakeredis
 import pytest
+import pytest_asyncio
 from fastapi.testclient import TestClient
 
 
 from app.main import app
+from app.models.cache import redis_cache
 
 
 @pytest.fixture(scope='module')
 def client():
     with TestClient(app) as client:
-        yield client
\ No newline at end of file
+        yield client
+
+
+@pytest_asyncio.fixture
+async def fake_redis(monkeypatch):
+    """Redis в памяти (fakeredis, Lua через lupa) вместо клиентов redis_cache."""
+    server = fakeredis.FakeServer()
+    redis = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+    raw_redis = fakeredis.aioredis.FakeRedis(server=server)
+    monkeypatch.setattr(redis_cache, "redis", redis)
+    monkeypatch.setattr(redis_cache, "raw_redis", raw_redis)
+    yield redis
+    await redis.aclose()
+    await raw_redis.aclose()
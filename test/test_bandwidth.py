@@ -0,0 +1,61 @@
+import pytest
+
+from app.models.bandwidth import BandwidthScheduler, LocalTokenBucket
+
+
+def _scheduler(global_rate: int, user_cap: int) -> BandwidthScheduler:
+    scheduler = BandwidthScheduler()
+    scheduler.global_rate, scheduler.user_cap = global_rate, user_cap
+    return scheduler
+
+
+def test_local_bucket_goes_into_debt():
+    bucket = LocalTokenBucket(1000, burst_seconds=1.0)
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(500) == pytest.approx(0.5, abs=0.01)
+    assert LocalTokenBucket(0, 1.0).reserve(10 ** 9) == 0
+
+
+@pytest.mark.asyncio
+async def test_lease_burst_then_wait(fake_redis):
+    scheduler = _scheduler(global_rate=1000, user_cap=0)
+    assert await scheduler.lease("u1", 1000) == (0, 1000, 1)
+    wait_ms, _, _ = await scheduler.lease("u1", 500)
+    assert 450 <= wait_ms <= 500
+    # долг общий: следующий запрос ждёт и за предыдущий
+    wait_ms, _, _ = await scheduler.lease("u1", 500)
+    assert 950 <= wait_ms <= 1000
+
+
+@pytest.mark.asyncio
+async def test_lease_splits_global_rate_between_users(fake_redis):
+    scheduler = _scheduler(global_rate=1000, user_cap=0)
+    assert (await scheduler.lease("u1", 1))[1:] == (1000, 1)
+    assert (await scheduler.lease("u2", 1))[1:] == (500, 2)
+    assert (await scheduler.lease("u1", 1))[1:] == (500, 2)
+
+
+@pytest.mark.asyncio
+async def test_lease_user_cap(fake_redis):
+    assert (await _scheduler(global_rate=1000, user_cap=100).lease("u0", 1))[1] == 100
+    scheduler = _scheduler(global_rate=0, user_cap=100)
+    assert (await scheduler.lease("u1", 100))[:2] == (0, 100)
+    wait_ms, _, _ = await scheduler.lease("u1", 50)
+    assert 450 <= wait_ms <= 500
+    # бакет другого пользователя полон
+    assert (await scheduler.lease("u2", 100))[0] == 0
+
+
+@pytest.mark.asyncio
+async def test_lease_unlimited(fake_redis):
+    assert await _scheduler(global_rate=0, user_cap=0).lease("u1", 10 ** 9) == (0, 0, 1)
+
+
+@pytest.mark.asyncio
+async def test_throttle_owner(fake_redis):
+    scheduler = BandwidthScheduler()
+    with scheduler.owner("job", "u1"):
+        async with scheduler.throttle("job") as throttle:
+            assert throttle.user_id == "u1"
+    async with scheduler.throttle("job") as throttle:
+        assert throttle.user_id == BandwidthScheduler.ANONYMOUS
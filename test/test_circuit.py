@@ -0,0 +1,90 @@
+import pytest
+
+from app.config import settings
+from app.exceptions import UpstreamUnavailableException
+from app.models.circuit import CircuitBreaker, host_key, parse_retry_after
+
+URL = "https://rr1---sn-abc.googlevideo.com/videoplayback"
+
+
+async def _fail(breaker: CircuitBreaker, count: int) -> None:
+    for _ in range(count):
+        await breaker.record(URL, ok=False)
+
+
+async def _expire(breaker: CircuitBreaker, redis) -> None:
+    await redis.hset(breaker._keys(host_key(URL))[0], "open_until", 0)
+
+
+@pytest.mark.parametrize("url,key", [
+    (URL, "googlevideo.com"),
+    ("https://www.youtube.com/watch?v=1", "youtube.com"),
+    ("vk.com.", "vk.com"),
+    ("http://127.0.0.1:8080/x", "127.0.0.1"),
+])
+def test_host_key(url, key):
+    assert host_key(url) == key
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") == 0
+    assert parse_retry_after(None) == 0
+
+
+@pytest.mark.asyncio
+async def test_opens_on_error_rate(fake_redis):
+    breaker = CircuitBreaker()
+    await _fail(breaker, settings.CIRCUIT_MIN_REQUESTS - 1)
+    await breaker.before_request(URL)
+    await _fail(breaker, 1)
+    with pytest.raises(UpstreamUnavailableException) as e:
+        await breaker.before_request(URL)
+    assert e.value.host == "googlevideo.com"
+    assert e.value.retry_after == pytest.approx(settings.CIRCUIT_BACKOFF_SECONDS, abs=1)
+    assert await breaker.open_for(URL) == pytest.approx(settings.CIRCUIT_BACKOFF_SECONDS, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_successes_keep_closed(fake_redis):
+    breaker = CircuitBreaker()
+    for _ in range(settings.CIRCUIT_MIN_REQUESTS):
+        await breaker.record(URL, ok=True)
+    await _fail(breaker, settings.CIRCUIT_MIN_REQUESTS // 2 - 1)
+    await breaker.before_request(URL)
+    assert await breaker.open_for(URL) == 0
+
+
+@pytest.mark.asyncio
+async def test_retry_after_opens_immediately(fake_redis):
+    breaker = CircuitBreaker()
+    await breaker.record(URL, ok=False, retry_after=120)
+    assert await breaker.open_for(URL) == pytest.approx(120, abs=1)
+    # Retry-After, пока хост открыт, только продлевает срок
+    await breaker.record(URL, ok=False, retry_after=300)
+    assert await breaker.open_for(URL) == pytest.approx(300, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_half_open_probe_closes(fake_redis):
+    breaker = CircuitBreaker()
+    await _fail(breaker, settings.CIRCUIT_MIN_REQUESTS)
+    await _expire(breaker, fake_redis)
+    await breaker.before_request(URL)
+    # пока идёт пробный запрос, остальные ждут
+    with pytest.raises(UpstreamUnavailableException):
+        await breaker.before_request(URL)
+    await breaker.record(URL, ok=True)
+    await breaker.before_request(URL)
+    await breaker.before_request(URL)
+
+
+@pytest.mark.asyncio
+async def test_half_open_failure_doubles_backoff(fake_redis):
+    breaker = CircuitBreaker()
+    await _fail(breaker, settings.CIRCUIT_MIN_REQUESTS)
+    await _expire(breaker, fake_redis)
+    await breaker.before_request(URL)
+    await _fail(breaker, 1)
+    assert await breaker.open_for(URL) == pytest.approx(2 * settings.CIRCUIT_BACKOFF_SECONDS, abs=1)
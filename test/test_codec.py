@@ -0,0 +1,45 @@
+import pytest
+
+from app.models.codec import Codec, PayloadSerializer, MAGIC, SCHEMA_VERSION, CodecError
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoResponse, SVideoStatus, SVideoDownload
+
+
+def _task() -> DownloadTask:
+    video = SVideoResponse(url="https://vkvideo.ru/video-1_2", title="Видео", author="Автор", formats=[])
+    status = SVideoStatus(task_id="00000000-0000-0000-0000-000000000000", status="pending", video=video)
+    download = SVideoDownload(url=video.url, video_format_id="720", audio_format_id="720", start_seconds=5)
+    return DownloadTask(status, download=download)
+
+
+@pytest.mark.parametrize("codec_name", ["json", "orjson", "msgpack"])
+@pytest.mark.parametrize("threshold", [0, 1])
+def test_round_trip(codec_name: str, threshold: int):
+    serializer = PayloadSerializer(codec_name, threshold)
+    task = _task()
+    data = serializer.encode(task.to_json())
+    assert data[0] == MAGIC and data[1] == SCHEMA_VERSION
+    assert DownloadTask.from_json(serializer.decode(data)) == task
+
+
+def test_reads_legacy_json():
+    task = _task()
+    serializer = PayloadSerializer("msgpack")
+    assert DownloadTask.from_json(serializer.decode(task.to_jsons().encode())) == task
+    assert DownloadTask.from_json(serializer.decode(task.to_jsons())) == task
+
+
+def test_rejects_newer_schema():
+    data = bytearray(PayloadSerializer("json").encode({"a": 1}))
+    data[1] = SCHEMA_VERSION + 1
+    with pytest.raises(CodecError):
+        PayloadSerializer().decode(bytes(data))
+
+
+def test_codec_must_implement_dumps_and_loads():
+    class DumpsOnly(Codec):
+        def dumps(self, obj):
+            return b""
+
+    with pytest.raises(TypeError):
+        DumpsOnly()
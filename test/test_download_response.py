@@ -0,0 +1,104 @@
+import asyncio
+from pathlib import Path
+
+import httpx
+import pytest
+import pytest_asyncio
+
+from app.models.cache import redis_cache
+from app.models.status import VideoDownloadStatus
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoResponse, SVideoStatus
+from app.utils import video_utils
+from app.utils.video_utils import DownloadFileResponse
+
+TASK_ID = "00000000-0000-0000-0000-000000000001"
+DATA = bytes(range(256)) * 40
+
+
+@pytest_asyncio.fixture
+async def task(tmp_path: Path, fake_redis) -> DownloadTask:
+    video = SVideoResponse(url="https://vkvideo.ru/video-1_2", title="Видео", author="Автор", formats=[])
+    task = DownloadTask(SVideoStatus(task_id=TASK_ID, status=VideoDownloadStatus.COMPLETED, video=video))
+    task.filepath = tmp_path / f"{TASK_ID}_video_Clip.mp4"
+    task.filepath.write_bytes(DATA)
+    await redis_cache.set_download_task(task)
+    return task
+
+
+async def _app(scope, receive, send):
+    task = await redis_cache.get_download_task(TASK_ID)
+    await DownloadFileResponse(task)(scope, receive, send)
+
+
+async def _get(method: str = "GET", headers: dict = None) -> httpx.Response:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=_app), base_url="http://test") as client:
+        return await client.request(method, "/", headers=headers)
+
+
+async def _status() -> str:
+    return (await redis_cache.get_download_task(TASK_ID)).video_status.status
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("http_range", ["bytes=0-99", "bytes=-40", "bytes=10000-", "bytes=0-9,10000-10239"])
+async def test_partial_keeps_task_and_file(task, http_range):
+    response = await _get(headers={"Range": http_range})
+    assert response.status_code == 206
+    assert await _status() == VideoDownloadStatus.COMPLETED
+    assert task.filepath.exists()
+
+
+@pytest.mark.asyncio
+async def test_suffix_range_content(task):
+    response = await _get(headers={"Range": "bytes=-40"})
+    assert response.content == DATA[-40:]
+    assert response.headers["content-range"] == f"bytes {len(DATA) - 40}-{len(DATA) - 1}/{len(DATA)}"
+
+
+@pytest.mark.asyncio
+async def test_full_response_completes_task(task):
+    response = await _get()
+    assert response.status_code == 200 and response.content == DATA
+    assert await _status() == VideoDownloadStatus.DONE
+    assert not task.filepath.exists()
+
+
+@pytest.mark.asyncio
+async def test_if_range(task):
+    etag = (await _get("HEAD")).headers["etag"]
+    assert await _status() == VideoDownloadStatus.COMPLETED
+    response = await _get(headers={"Range": "bytes=100-", "If-Range": etag})
+    assert response.status_code == 206 and await _status() == VideoDownloadStatus.COMPLETED
+    # файл изменился с прошлого ответа: отдаётся целиком
+    response = await _get(headers={"Range": "bytes=100-", "If-Range": '"stale"'})
+    assert response.status_code == 200 and len(response.content) == len(DATA)
+    assert await _status() == VideoDownloadStatus.DONE
+
+
+@pytest.mark.asyncio
+async def test_unsatisfiable_range(task):
+    response = await _get(headers={"Range": f"bytes={len(DATA)}-"})
+    assert response.status_code == 416
+    assert await _status() == VideoDownloadStatus.COMPLETED
+
+
+@pytest.mark.asyncio
+async def test_pathsend_deletes_after_delay(task, monkeypatch):
+    monkeypatch.setattr(video_utils, "PATHSEND_UNLINK_DELAY", 0.05)
+    messages = []
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        messages.append(message["type"])
+
+    scope = {"type": "http", "method": "GET", "headers": [], "extensions": {"http.response.pathsend": {}}}
+    await _app(scope, receive, send)
+    assert messages == ["http.response.start", "http.response.pathsend"]
+    assert await _status() == VideoDownloadStatus.DONE
+    # сервер ещё отправляет файл сам — удаление откладывается
+    assert task.filepath.exists()
+    await asyncio.sleep(0.2)
+    assert not task.filepath.exists()
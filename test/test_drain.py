@@ -0,0 +1,84 @@
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app.exceptions import DownloadCheckpointed
+from app.models.cache import redis_cache
+from app.models.drain import WorkerDrain
+from app.models.status import VideoDownloadStatus
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoResponse, SVideoStatus
+from app.utils.helpers import range_already_complete
+
+SHORT, LONG, UNKNOWN = (f"00000000-0000-0000-0000-00000000000{i}" for i in range(1, 4))
+
+
+async def _task(task_id: str, eta: int = None) -> None:
+    video = SVideoResponse(url="https://vkvideo.ru/video-1_2", title="Видео", author="Автор", formats=[])
+    status = SVideoStatus(task_id=task_id, status=VideoDownloadStatus.PENDING, video=video, eta_seconds=eta)
+    await redis_cache.set_download_task(DownloadTask(status))
+
+
+def _worker(*tasks) -> SimpleNamespace:
+    return SimpleNamespace(allow_pick_jobs=True, tasks={i: task for i, task in enumerate(tasks)})
+
+
+@pytest.mark.asyncio
+async def test_drain_checkpoints_long_downloads(fake_redis):
+    drain = WorkerDrain(drain_seconds=20, checkpoint_grace_seconds=0)
+    await _task(SHORT, eta=1)
+    await _task(LONG, eta=600)
+    worker = _worker()
+    with drain.track(SHORT), drain.track(LONG), drain.track(UNKNOWN):
+        drain.check(SHORT)
+        await drain.drain([worker])
+        assert not worker.allow_pick_jobs
+        drain.check(SHORT)
+        for task_id in (LONG, UNKNOWN):
+            with pytest.raises(DownloadCheckpointed):
+                drain.check(task_id)
+    # запрос контрольной точки снимается вместе с загрузкой
+    assert not drain.should_checkpoint(LONG)
+
+
+@pytest.mark.asyncio
+async def test_drain_checkpoints_all_after_deadline(fake_redis, monkeypatch):
+    monkeypatch.setattr(WorkerDrain, "POLL_INTERVAL", 0.01)
+    drain = WorkerDrain(drain_seconds=0.05, checkpoint_grace_seconds=0.05)
+    await _task(SHORT, eta=0)
+    running = asyncio.get_running_loop().create_future()
+    with drain.track(SHORT):
+        await drain.drain([_worker(running)])
+        with pytest.raises(DownloadCheckpointed):
+            drain.check(SHORT)
+    running.cancel()
+
+
+@pytest.mark.asyncio
+async def test_resume_only_after_checkpoint(fake_redis, tmp_path: Path):
+    drain = WorkerDrain(drain_seconds=20, checkpoint_grace_seconds=10)
+    part = tmp_path / f"{LONG}_video.mp4"
+    part.write_bytes(b"x" * 100)
+    # файл остался от упавшей попытки — качаем заново
+    assert not await drain.resumable(LONG)
+    assert await drain.resume_offset(LONG, part) == 0
+
+    await drain.checkpointed(LONG)
+    assert await drain.resume_offset(LONG, part) == 100
+    # отметка одноразовая
+    assert not await drain.resumable(LONG)
+
+
+@pytest.mark.parametrize("status,offset,content_range,complete", [
+    (416, 1000, "bytes */1000", True),
+    (416, 1000, None, True),
+    (416, 500, "bytes */1000", False),
+    (416, 1500, "bytes */1000", False),
+    (416, 0, "bytes */1000", False),
+    (206, 500, "bytes 500-999/1000", False),
+    (200, 500, None, False),
+])
+def test_range_already_complete(status, offset, content_range, complete):
+    assert range_already_complete(status, offset, content_range) is complete
@@ -0,0 +1,42 @@
+import asyncio
+
+import fakeredis
+import pytest
+from fakeredis.aioredis import FakeAsyncRedisConnection
+from redis.asyncio.client import PubSub
+from redis.exceptions import ConnectionError
+
+from app.models.connections import CountingConnectionPool, redis_connections
+from app.models.events import ProgressDispatcher
+
+
+class BrokenPubSub(PubSub):
+    """Подписка, у которой связь с Redis оборвалась после psubscribe."""
+
+    async def get_message(self, *args, **kwargs):
+        raise ConnectionError("connection lost")
+
+    async def punsubscribe(self, *args):
+        raise ConnectionError("connection lost")
+
+
+@pytest.mark.asyncio
+async def test_reconnects_return_connections(monkeypatch):
+    pool = CountingConnectionPool(max_connections=2, timeout=1, decode_responses=True)
+    pool.connection_class = FakeAsyncRedisConnection
+    pool.connection_kwargs["server"] = fakeredis.FakeServer()
+    subscriptions = []
+
+    def pubsub():
+        subscriptions.append(BrokenPubSub(pool))
+        return subscriptions[-1]
+
+    monkeypatch.setattr(redis_connections, "pubsub", pubsub)
+    dispatcher = ProgressDispatcher(queue_size=4)
+    dispatcher._ensure_started()
+    # несколько циклов переподключения: утечка исчерпала бы пул из двух соединений
+    await asyncio.sleep(2)
+    await dispatcher.stop()
+    assert len(subscriptions) >= 3
+    assert pool.in_use == 0
+    await pool.disconnect()
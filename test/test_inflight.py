@@ -0,0 +1,77 @@
+import pytest
+
+from app.models.inflight import InflightJobs, job_signature
+from app.models.services import VkVideoService
+from app.schemas.main import SVideoDownload
+
+SIGNATURE = "video-1_2|720|720|None|None|None|None"
+
+
+@pytest.mark.asyncio
+async def test_attach_creates_and_joins(fake_redis):
+    inflight = InflightJobs()
+    assert await inflight.attach("t1", SIGNATURE) is None
+    assert await inflight.attach("t1", SIGNATURE, "job1") == "job1"
+    # вторая задача присоединяется к уже идущему заданию, новый ID игнорируется
+    assert await inflight.attach("t2", SIGNATURE, "job2") == "job1"
+    job_key, refs_key = inflight._keys(SIGNATURE)
+    assert await fake_redis.smembers(refs_key) == {"t1", "t2"}
+    assert await fake_redis.ttl(job_key) > 0
+
+
+@pytest.mark.asyncio
+async def test_release_cancels_with_last_ref(fake_redis):
+    inflight = InflightJobs()
+    await inflight.attach("t1", SIGNATURE, "job1")
+    await inflight.attach("t2", SIGNATURE, "job1")
+    assert await inflight.release("t1") is None
+    assert await inflight.release("t1") is None
+    assert await inflight.release("t2") == "job1"
+    assert not await fake_redis.exists(*inflight._keys(SIGNATURE))
+
+
+@pytest.mark.asyncio
+async def test_finish_hands_out_refs(fake_redis):
+    inflight = InflightJobs()
+    await inflight.attach("t1", SIGNATURE, "job1")
+    await inflight.attach("t2", SIGNATURE, "job1")
+    assert sorted(await inflight._finish(SIGNATURE, "job1")) == ["t1", "t2"]
+    # после завершения новая задача начинает своё задание
+    assert await inflight.attach("t3", SIGNATURE, "job2") == "job2"
+
+
+@pytest.mark.asyncio
+async def test_finish_keeps_newer_job(fake_redis):
+    inflight = InflightJobs()
+    await inflight.attach("t1", SIGNATURE, "job2")
+    await inflight._finish(SIGNATURE, "job1")
+    assert await fake_redis.get(inflight._keys(SIGNATURE)[0]) == "job2"
+
+
+@pytest.mark.asyncio
+async def test_park_and_resume(fake_redis):
+    inflight = InflightJobs()
+    await inflight.attach("t1", SIGNATURE, "job1")
+    await inflight._park(SIGNATURE, "job1")
+    assert await inflight.has_parked(SIGNATURE)
+    assert await inflight.attach("t2", SIGNATURE) is None
+    assert await inflight.resume_parked(SIGNATURE) == "job1"
+    assert not await inflight.has_parked(SIGNATURE)
+    assert await inflight.attach("t2", SIGNATURE) == "job1"
+
+
+@pytest.mark.asyncio
+async def test_resume_drops_unreferenced_job(fake_redis):
+    inflight = InflightJobs()
+    await inflight.attach("t1", SIGNATURE, "job1")
+    await inflight._park(SIGNATURE, "job1")
+    await inflight.release("t1")
+    assert await inflight.resume_parked(SIGNATURE) is None
+
+
+def test_job_signature_ignores_url_form():
+    download = SVideoDownload(url="https://vkvideo.ru/video-1_2", video_format_id="720", audio_format_id="720")
+    same = download.model_copy(update={"url": "https://vk.com/video-1_2"})
+    clip = download.model_copy(update={"start_seconds": 5})
+    assert job_signature(VkVideoService, download) == job_signature(VkVideoService, same)
+    assert job_signature(VkVideoService, download) != job_signature(VkVideoService, clip)
@@ -0,0 +1,89 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from app.config import settings
+from app.models.cache import redis_cache
+from app.models.janitor import StorageEntry, StorageJanitor, cron_schedule, scan_download_folder
+from app.models.status import VideoDownloadStatus
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoResponse, SVideoStatus
+
+TASK_ID = "00000000-0000-0000-0000-000000000001"
+OLD = settings.JANITOR_ORPHAN_GRACE_SECONDS + 1
+
+
+def _task(status: str, task_id: str = TASK_ID, filepath: Path = None) -> DownloadTask:
+    video = SVideoResponse(url="https://vkvideo.ru/video-1_2", title="Видео", author="Автор", formats=[])
+    task = DownloadTask(SVideoStatus(task_id=task_id, status=status, video=video))
+    task.filepath = filepath
+    return task
+
+
+def _entry(name: str, age: float) -> StorageEntry:
+    return StorageEntry(Path("/downloads/author") / name, TASK_ID, 1, time.time() - age)
+
+
+@pytest.mark.parametrize("status,age,orphan", [
+    (None, OLD, True),
+    (None, 1, False),
+    (VideoDownloadStatus.DONE, OLD, True),
+    (VideoDownloadStatus.ERROR, OLD, True),
+    (VideoDownloadStatus.CANCELED, OLD, True),
+    (VideoDownloadStatus.PENDING, OLD, False),
+    (VideoDownloadStatus.PENDING, settings.JANITOR_STALE_PENDING_SECONDS + 1, True),
+])
+def test_orphan_by_status(status, age, orphan):
+    janitor = StorageJanitor(Path("/downloads"))
+    task = _task(status) if status else None
+    assert janitor._is_orphan(_entry(f"{TASK_ID}_video.mp4", age), task, time.time()) is orphan
+
+
+def test_completed_keeps_only_result():
+    janitor = StorageJanitor(Path("/downloads"))
+    result = _entry(f"{TASK_ID}_video_Clip.mp4", OLD)
+    task = _task(VideoDownloadStatus.COMPLETED, filepath=result.path)
+    assert not janitor._is_orphan(result, task, time.time())
+    assert janitor._is_orphan(_entry(f"{TASK_ID}_video.mp4", OLD), task, time.time())
+
+
+def test_scan_download_folder(tmp_path: Path):
+    parts = tmp_path / "author" / f"{TASK_ID}_parts"
+    parts.mkdir(parents=True)
+    (parts / "0.ts").write_bytes(b"x" * 10)
+    (parts / "1.ts").write_bytes(b"x" * 5)
+    (tmp_path / "author" / "unrelated.txt").write_bytes(b"x")
+    entries = {entry.path.name: entry for entry in scan_download_folder(tmp_path)}
+    assert entries[parts.name].task_id == TASK_ID and entries[parts.name].size == 15
+    assert entries["unrelated.txt"].task_id is None
+
+
+@pytest.mark.parametrize("interval,schedule", [
+    (15, {"minute": {0, 15, 30, 45}}),
+    (60, {"minute": {0}}),
+    (360, {"hour": {0, 6, 12, 18}, "minute": {0}}),
+])
+def test_cron_schedule(interval, schedule):
+    assert cron_schedule(interval) == schedule
+
+
+@pytest.mark.asyncio
+async def test_run_removes_orphans(tmp_path: Path, fake_redis):
+    author = tmp_path / "author"
+    author.mkdir()
+    done_id, completed_id, gone_id = (f"00000000-0000-0000-0000-00000000001{i}" for i in range(3))
+    result = author / f"{completed_id}_video_Clip.mp4"
+    files = [author / f"{done_id}_video.mp4", result, author / f"{completed_id}_audio.m4a",
+             author / f"{gone_id}_video.mp4"]
+    for file in files:
+        file.write_bytes(b"x" * 100)
+        os.utime(file, (time.time() - OLD, time.time() - OLD))
+    await redis_cache.set_download_task(_task(VideoDownloadStatus.DONE, done_id))
+    await redis_cache.set_download_task(_task(VideoDownloadStatus.COMPLETED, completed_id, result))
+
+    report = await StorageJanitor(tmp_path).run()
+
+    assert [file.exists() for file in files] == [False, True, False, False]
+    assert report.files_removed == 3 and report.bytes_reclaimed == 300
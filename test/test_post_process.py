@@ -0,0 +1,157 @@
+from pathlib import Path
+
+import pytest
+
+from app.config import settings
+from app.models.bandwidth import bandwidth
+from app.models.post_process import ClipMode, PostPrecess
+from app.models.probe import MediaInfo, MediaProbe
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoDownload, SVideoResponse, SVideoStatus
+
+URL = "https://vkvideo.ru/video-1_2"
+VIDEO, AUDIO = Path("/d/a/t_video.mp4"), Path("/d/a/t_audio.m4a")
+
+
+def _post_process(**download) -> PostPrecess:
+    video = SVideoResponse(url=URL, title="Видео", author="Автор", formats=[], duration=600)
+    task = DownloadTask(SVideoStatus(task_id="00000000-0000-0000-0000-000000000000", status="pending", video=video))
+    return PostPrecess(task, SVideoDownload(url=URL, video_format_id="720", audio_format_id="a", **download))
+
+
+def test_merge():
+    args = _post_process().plan([VIDEO, AUDIO], Path("/d/a/t_out.mp4"), audio_only=False)
+    assert args == ["-i", str(VIDEO), "-i", str(AUDIO), "-map", "0:v:0", "-map", "1:a:0", "-c", "copy",
+                    "-shortest", "-movflags", "+faststart", "-y", "/d/a/t_out.mp4"]
+
+
+def test_merge_with_clip():
+    args = _post_process(start_seconds=10, end_seconds=20).plan([VIDEO, AUDIO], Path("/d/a/t_out.mp4"), False)
+    # обрезка ставится перед каждым входом, конец с запасом в секунду
+    assert args[:12] == ["-ss", "10", "-to", "21", "-i", str(VIDEO), "-ss", "10", "-to", "21", "-i", str(AUDIO)]
+
+
+def test_clip_remote_input():
+    args = _post_process(start_seconds=5).plan(["https://cdn/v.mp4"], Path("/d/a/t_clip.webm"), False,
+                                               input_args=["-headers", "Referer: x\r\n"])
+    assert args == ["-headers", "Referer: x\r\n", "-ss", "5", "-i", "https://cdn/v.mp4", "-c", "copy",
+                    "-y", "/d/a/t_clip.webm"]
+
+
+@pytest.mark.parametrize("output,codec,expected", [
+    ("t.mp3", None, ["-vn", "-acodec", "libmp3lame", "-q:a", "2", "-y", "t.mp3"]),
+    ("t.m4a", "aac", ["-vn", "-c:a", "copy", "-movflags", "+faststart", "-y", "t.m4a"]),
+    ("t.m4a", None, ["-vn", "-c:a", "copy", "-movflags", "+faststart", "-y", "t.m4a"]),
+    ("t.m4a", "opus", ["-vn", "-c:a", "aac", "-b:a", "192k", "-movflags", "+faststart", "-y", "t.m4a"]),
+    ("t.opus", "opus", ["-vn", "-c:a", "copy", "-y", "t.opus"]),
+    ("t.opus", "aac", ["-vn", "-c:a", "libopus", "-b:a", "160k", "-y", "t.opus"]),
+])
+def test_audio(output, codec, expected):
+    args = _post_process().plan([VIDEO], Path(output), audio_only=True, audio_codec=codec)
+    assert args == ["-i", str(VIDEO), *expected]
+
+
+@pytest.mark.parametrize("output,audio_only,encodes", [
+    ("t.mp3", True, True),
+    ("t.m4a", True, False),
+    ("t.mp4", False, False),
+])
+def test_encodes(output, audio_only, encodes):
+    assert PostPrecess.encodes(Path(output), audio_only) is encodes
+
+
+@pytest.mark.asyncio
+async def test_remote_fetch_disabled_by_bandwidth_limits(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(settings, "CLIP_PARTIAL_FETCH", True)
+    post_process = _post_process(start_seconds=10, end_seconds=20)
+    assert post_process.should_fetch_clip()
+    monkeypatch.setattr(bandwidth, "distributed", True)
+    # ffmpeg читал бы источник в обход бакетов — парсер должен качать сам
+    assert not post_process.should_fetch_clip()
+    assert not await post_process.fetch_audio("https://cdn/a.m4a", tmp_path / "t.m4a")
+    assert not (tmp_path / "t.m4a").exists()
+
+
+@pytest.fixture
+def remote(monkeypatch, fake_redis) -> dict:
+    """Удалённый источник: ffprobe отвечает заданным MediaInfo, ffmpeg-проходы только записываются."""
+    state = {"media": MediaInfo(duration=600.0, streams=[{"codec_type": "video", "codec_name": "h264"}]),
+             "keyframe": 8.0, "probes": 0, "fetches": [], "cuts": []}
+    monkeypatch.setattr(settings, "CLIP_PARTIAL_FETCH", True)
+
+    async def run(media_probe, url, key, headers=None):
+        state["probes"] += 1
+        return state["media"]
+
+    async def keyframe_before(media_probe, url, media, position, headers=None):
+        return state["keyframe"]
+
+    async def fetch_remote(post_process, inputs, output, audio_only, headers, description, source=None,
+                           clip_start=None):
+        state["fetches"].append((inputs, output, clip_start))
+        output.write_bytes(b"x")
+        return True
+
+    async def smart_cut(post_process, inputs, output, duration, offset=0.0):
+        state["cuts"].append((inputs, output, offset))
+        return True
+
+    monkeypatch.setattr(MediaProbe, "probe_url", run)
+    monkeypatch.setattr(MediaProbe, "keyframe_before", keyframe_before)
+    monkeypatch.setattr(PostPrecess, "_fetch_remote", fetch_remote)
+    monkeypatch.setattr(PostPrecess, "_smart_cut", smart_cut)
+    return state
+
+
+@pytest.mark.asyncio
+async def test_fetch_clip_takes_unknown_duration_from_probe(remote, tmp_path: Path):
+    post_process = _post_process(start_seconds=10, end_seconds=20)
+    post_process.task.video_status.video.duration = None
+    # без длительности решение принимается уже по ffprobe источника
+    assert post_process.should_fetch_clip()
+    assert await post_process.fetch_clip("https://cdn/v.mp4", output=tmp_path / "t.mp4")
+    assert remote["probes"] == 1
+
+    remote["media"] = MediaInfo(duration=15.0)
+    assert not await post_process.fetch_clip("https://cdn/v.mp4", output=tmp_path / "t.mp4")
+    assert len(remote["fetches"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_fetch_clip_known_duration_skips_probe(remote, tmp_path: Path):
+    assert await _post_process(start_seconds=10, end_seconds=20).fetch_clip("https://cdn/v.mp4",
+                                                                            output=tmp_path / "t.mp4")
+    assert remote["probes"] == 0
+    assert remote["fetches"][0][2] is None
+
+
+@pytest.mark.asyncio
+async def test_smart_clip_fetches_window_from_keyframe(remote, tmp_path: Path):
+    post_process = _post_process(start_seconds=10, end_seconds=20, clip_mode=ClipMode.SMART)
+    output = tmp_path / "t.mp4"
+    assert post_process.should_fetch_clip()
+    assert await post_process.fetch_clip("https://cdn/v.mp4", "https://cdn/a.m4a", output=output)
+
+    window = tmp_path / "t_window.mp4"
+    assert remote["fetches"] == [(["https://cdn/v.mp4", "https://cdn/a.m4a"], window, 8.0)]
+    # края режутся по скачанному окну: его начало — 8-я секунда ролика
+    assert remote["cuts"] == [([window], output, 8.0)]
+    assert not window.exists()
+    assert post_process.task.filepath == output
+
+
+@pytest.mark.asyncio
+async def test_smart_clip_without_keyframe_downloads_whole_video(remote, tmp_path: Path):
+    remote["keyframe"] = None
+    post_process = _post_process(start_seconds=10, end_seconds=20, clip_mode=ClipMode.SMART)
+    assert not await post_process.fetch_clip("https://cdn/v.mp4", output=tmp_path / "t.mp4")
+    assert remote["fetches"] == []
+
+
+@pytest.mark.asyncio
+async def test_smart_clip_of_other_codec_cuts_at_keyframes(remote, tmp_path: Path):
+    remote["media"] = MediaInfo(duration=600.0, streams=[{"codec_type": "video", "codec_name": "vp9"}])
+    post_process = _post_process(start_seconds=10, end_seconds=20, clip_mode=ClipMode.SMART)
+    assert await post_process.fetch_clip("https://cdn/v.mp4", output=tmp_path / "t.mp4")
+    assert remote["fetches"] == [(["https://cdn/v.mp4"], tmp_path / "t.mp4", None)]
+    assert remote["cuts"] == []
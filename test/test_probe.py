@@ -0,0 +1,103 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from app.config import settings
+from app.models.probe import MediaInfo, MediaProbe, probe_key
+
+URL = "https://vkvideo.ru/video-1_2"
+PROBE_OUTPUT = json.dumps({
+    "streams": [{"index": 0, "codec_type": "video", "codec_name": "h264", "width": "1280", "height": "720"},
+                {"index": 1, "codec_type": "audio", "codec_name": "aac", "channels": "2"}],
+    "format": {"duration": "600.0", "size": "1000", "bit_rate": "800000", "start_time": "1.5"},
+})
+
+
+@pytest.fixture
+def ffprobe(monkeypatch, fake_redis) -> list:
+    """Подменяет ffprobe: записывает аргументы вызовов, отвечает по запрошенным полям."""
+    calls = []
+
+    async def run_ffprobe(args):
+        calls.append(list(args))
+        if "packet=pts_time,flags" in args:
+            return "5.5,K__\n6.0,___\n7.5,K__\n8.0,___\n"
+        return PROBE_OUTPUT
+
+    monkeypatch.setattr("app.models.probe.run_ffprobe", run_ffprobe)
+    return calls
+
+
+def test_probe_key_uses_canonical_id():
+    # подписанная ссылка меняется, а ключ кэша — нет
+    assert probe_key(URL, "720") == probe_key(URL + "?list=abc", "720")
+    assert probe_key(URL, "720") != probe_key(URL, "480")
+
+
+@pytest.mark.asyncio
+async def test_probe_url_cache_hit_and_miss(ffprobe):
+    probe = MediaProbe()
+    key = probe_key(URL, "720")
+    first = await probe.probe_url("https://cdn/v.mp4?sig=1", key, headers={"Referer": "https://vkvideo.ru/"})
+    # другая подпись той же дорожки берётся из кэша
+    second = await probe.probe_url("https://cdn/v.mp4?sig=2", key)
+
+    assert len(ffprobe) == 1
+    assert ffprobe[0][:2] == ["-headers", "Referer: https://vkvideo.ru/"]
+    assert first == second
+    assert (first.duration, first.start_time, first.video["width"]) == (600.0, 1.5, 1280)
+    assert await probe.stats() == {"hit_rate": 0.5, "hits": 1, "misses": 1}
+
+    await probe.probe_url("https://cdn/v.mp4", probe_key(URL, "480"))
+    assert len(ffprobe) == 2
+
+
+@pytest.mark.asyncio
+async def test_probe_file_keyed_by_size(ffprobe, tmp_path: Path):
+    probe = MediaProbe()
+    key = probe_key(URL, "720")
+    full, part = tmp_path / "full.mp4", tmp_path / "part.mp4"
+    full.write_bytes(b"x" * 100)
+    part.write_bytes(b"x" * 10)
+
+    await probe.probe(full.as_posix(), key)
+    await probe.probe(part.as_posix(), key)
+    # частичный артефакт не перезаписал запись полного файла
+    await probe.probe(full.as_posix(), key)
+    assert len(ffprobe) == 2
+    assert (await probe.stats())["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_probe_file_builds_keyframes_on_request(ffprobe, tmp_path: Path):
+    probe = MediaProbe()
+    path = tmp_path / "full.mp4"
+    path.write_bytes(b"x" * 100)
+    key = probe_key(URL, "720")
+
+    assert (await probe.probe(path.as_posix(), key)).keyframes is None
+    media = await probe.probe(path.as_posix(), key, keyframes=True)
+    # запись без индекса ключевых кадров не годится — ffprobe запускается снова
+    assert media.keyframes == pytest.approx([4.0, 6.0])
+    assert (await probe.probe(path.as_posix(), key, keyframes=True)).keyframes == media.keyframes
+    assert len(ffprobe) == 3
+
+
+@pytest.mark.asyncio
+async def test_keyframe_before_scans_window(ffprobe, monkeypatch):
+    monkeypatch.setattr(settings, "CLIP_KEYFRAME_LOOKBACK_SECONDS", 3.0)
+    media = MediaInfo(duration=600.0, start_time=1.5)
+
+    keyframe = await MediaProbe().keyframe_before("https://cdn/v.mp4", media, 6.0)
+
+    assert keyframe == pytest.approx(6.0)
+    args = ffprobe[0]
+    # окно в абсолютном времени потока: [start_time + 3, start_time + 6]
+    assert args[args.index("-read_intervals") + 1].startswith("4.5%7.50")
+
+
+@pytest.mark.asyncio
+async def test_keyframe_before_outside_window(ffprobe):
+    # в окне нет ключевого кадра не позже начала фрагмента
+    assert await MediaProbe().keyframe_before("https://cdn/v.mp4", MediaInfo(), 1.0) is None
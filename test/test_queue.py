@@ -0,0 +1,74 @@
+import pytest
+from arq.constants import default_queue_name
+
+from app.config import settings
+from app.models.queue import QueueName, arq_queue_name, choose_queue, estimate_job
+from app.schemas.main import SVideoDownload, SVideoFormat, SVideoResponse
+
+MB = 1024 * 1024
+URL = "https://vkvideo.ru/video-1_2"
+
+
+def _video(filesize: int, duration: int) -> SVideoResponse:
+    formats = [
+        SVideoFormat(quality="360", filesize=filesize // 4, video_format_id="360", audio_format_id="a"),
+        SVideoFormat(quality="720", filesize=filesize, video_format_id="720", audio_format_id="a"),
+    ]
+    return SVideoResponse(url=URL, title="Видео", author="Автор", formats=formats, duration=duration)
+
+
+def _download(start: int = None, end: int = None, video_format_id: str = "720") -> SVideoDownload:
+    return SVideoDownload(url=URL, video_format_id=video_format_id, audio_format_id="a",
+                          start_seconds=start, end_seconds=end)
+
+
+def test_estimate_picks_requested_format():
+    video = _video(100 * MB, 600)
+    assert estimate_job(video, _download()) == (100 * MB, 600)
+    assert estimate_job(video, _download(video_format_id="360")) == (25 * MB, 600)
+    assert estimate_job(video, _download(video_format_id="1080")) == (0, 600)
+
+
+@pytest.mark.parametrize("start,end,expected", [
+    (0, 60, (10 * MB, 60)),
+    (540, None, (10 * MB, 60)),
+    (None, 300, (50 * MB, 300)),
+    (500, 9000, (100 * MB, 8500)),
+])
+def test_estimate_clip(start, end, expected):
+    assert estimate_job(_video(100 * MB, 600), _download(start, end)) == expected
+
+
+def test_estimate_without_metadata():
+    assert estimate_job(None, _download()) == (0, 0)
+    assert estimate_job(None, _download(10, 70)) == (0, 60)
+
+
+@pytest.mark.parametrize("filesize,duration,start,end,queue", [
+    (10 * MB, 60, None, None, QueueName.EXPRESS),
+    (settings.QUEUE_EXPRESS_MAX_BYTES + 1, 60, None, None, QueueName.STANDARD),
+    (10 * MB, settings.QUEUE_EXPRESS_MAX_SECONDS + 1, None, None, QueueName.STANDARD),
+    (settings.QUEUE_BULK_MIN_BYTES, 60, None, None, QueueName.BULK),
+    (10 * MB, settings.QUEUE_BULK_MIN_SECONDS, None, None, QueueName.BULK),
+    (0, settings.QUEUE_BULK_MIN_SECONDS, None, None, QueueName.BULK),
+    # фрагмент длинного ролика идёт в очередь по своему размеру
+    (2 * settings.QUEUE_BULK_MIN_BYTES, 2 * 60 * 60, 0, 600, QueueName.STANDARD),
+    (2 * settings.QUEUE_BULK_MIN_BYTES, 2 * 60 * 60, 0, 5, QueueName.EXPRESS),
+])
+def test_choose_queue(filesize, duration, start, end, queue):
+    assert choose_queue(_video(filesize, duration), _download(start, end)) == queue
+
+
+@pytest.mark.parametrize("video,download", [
+    (None, _download()),
+    (_video(0, 60), _download()),
+    (_video(10 * MB, 0), _download()),
+    (_video(10 * MB, 60), _download(video_format_id="1080")),
+])
+def test_unknown_size_goes_to_standard(video, download):
+    assert choose_queue(video, download) == QueueName.STANDARD
+
+
+def test_arq_queue_name():
+    assert arq_queue_name(QueueName.STANDARD) == default_queue_name
+    assert arq_queue_name(QueueName.BULK) == f"{default_queue_name}:bulk"
@@ -0,0 +1,80 @@
+import pytest
+
+from app.config import settings
+from app.exceptions import QuotaExceededException, QuotaTooLargeException
+from app.models.quota import QuotaKind, Quotas
+
+DOWNLOADS = {QuotaKind.DOWNLOADS: 1}
+
+
+@pytest.fixture
+def quotas(monkeypatch, fake_redis) -> Quotas:
+    monkeypatch.setattr(settings, "QUOTA_USER_DOWNLOADS", 2)
+    monkeypatch.setattr(settings, "QUOTA_IP_DOWNLOADS", 3)
+    monkeypatch.setattr(settings, "QUOTA_USER_BYTES", 1000)
+    monkeypatch.setattr(settings, "QUOTA_IP_BYTES", 0)
+    return Quotas()
+
+
+async def _counter(redis, kind: str, scope: str, subject: str) -> float:
+    value = await redis.hget(f"{settings.REDIS_PREFIX}quota:{kind}:{scope}:{subject}", "cur")
+    return float(value or 0)
+
+
+@pytest.mark.asyncio
+async def test_limit_is_atomic(quotas, fake_redis):
+    assert await quotas.consume("u1", "1.1.1.1", DOWNLOADS)
+    assert await quotas.consume("u1", "1.1.1.1", DOWNLOADS)
+    with pytest.raises(QuotaExceededException) as e:
+        await quotas.consume("u1", "1.1.1.1", DOWNLOADS)
+    assert e.value.quota == "user downloads"
+    assert 0 < e.value.retry_after <= 2 * settings.QUOTA_WINDOW_SECONDS
+    # отказ по пользователю не списал квоту IP
+    assert await _counter(fake_redis, QuotaKind.DOWNLOADS, "ip", "1.1.1.1") == 2
+    assert await quotas.consume("u2", "1.1.1.1", DOWNLOADS)
+    with pytest.raises(QuotaExceededException) as e:
+        await quotas.consume("u3", "1.1.1.1", DOWNLOADS)
+    assert e.value.quota == "ip downloads"
+
+
+@pytest.mark.asyncio
+async def test_anonymous_and_disabled_counters(quotas, fake_redis):
+    charge = await quotas.consume("0", "1.1.1.1", {QuotaKind.DOWNLOADS: 1, QuotaKind.BYTES: 500})
+    assert len(charge.keys) == 1 and charge.amounts == [1]
+    assert await quotas.consume("0", None, DOWNLOADS) is None
+
+
+@pytest.mark.asyncio
+async def test_too_large(quotas):
+    with pytest.raises(QuotaTooLargeException) as e:
+        await quotas.consume("u1", None, {QuotaKind.BYTES: 1001})
+    assert (e.value.amount, e.value.limit) == (1001, 1000)
+
+
+@pytest.mark.asyncio
+async def test_refund(quotas, fake_redis):
+    charge = await quotas.consume("u1", "1.1.1.1", {QuotaKind.DOWNLOADS: 1, QuotaKind.BYTES: 600})
+    with pytest.raises(QuotaExceededException):
+        await quotas.consume("u1", "1.1.1.1", {QuotaKind.BYTES: 600})
+    await quotas.refund(charge)
+    assert await _counter(fake_redis, QuotaKind.BYTES, "user", "u1") == 0
+    assert await _counter(fake_redis, QuotaKind.DOWNLOADS, "ip", "1.1.1.1") == 0
+    assert await quotas.consume("u1", "1.1.1.1", {QuotaKind.BYTES: 600})
+    await quotas.refund(None)
+
+
+@pytest.mark.asyncio
+async def test_refund_after_window_change(quotas, fake_redis):
+    charge = await quotas.consume("u1", None, {QuotaKind.BYTES: 600})
+    key = charge.keys[0]
+    # окно сменилось: списанное переехало в prev
+    await fake_redis.hset(key, mapping={"win": charge.window + 1, "cur": 0, "prev": 600})
+    await quotas.refund(charge)
+    assert float(await fake_redis.hget(key, "prev")) == 0
+
+
+@pytest.mark.asyncio
+async def test_old_windows_are_forgotten(quotas, fake_redis):
+    charge = await quotas.consume("u1", None, {QuotaKind.BYTES: 1000})
+    await fake_redis.hset(charge.keys[0], "win", charge.window - 2)
+    assert await quotas.consume("u1", None, {QuotaKind.BYTES: 1000})
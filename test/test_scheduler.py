@@ -0,0 +1,58 @@
+from dataclasses import dataclass
+
+from app.models.scheduler import ServiceSlots
+
+
+@dataclass
+class Service:
+    name: str
+    max_concurrency: int = 10
+    weight: int = 1
+
+    def get_max_concurrency(self) -> int:
+        return self.max_concurrency
+
+    def get_weight(self) -> int:
+        return self.weight
+
+
+def _acquire(slots: ServiceSlots, service: Service, count: int) -> list[bool]:
+    return [slots.try_acquire(service) for _ in range(count)]
+
+
+def test_max_concurrency():
+    slots = ServiceSlots(8)
+    youtube = Service("youtube", max_concurrency=3)
+    assert _acquire(slots, youtube, 4) == [True, True, True, False]
+    assert slots.deferred["youtube"] == 1
+    slots.release(youtube)
+    assert slots.try_acquire(youtube)
+
+
+def test_fair_share_by_weight():
+    slots = ServiceSlots(8)
+    youtube, vk = Service("youtube", weight=3), Service("vk", weight=1)
+    assert slots.try_acquire(youtube) and slots.try_acquire(vk)
+    assert slots.fair_share("youtube", 0) == 6
+    assert slots.fair_share("vk", 0) == 2
+    slots.release(vk)
+    assert slots.fair_share("youtube", 0) == 8
+
+
+def test_over_share_only_while_others_idle():
+    slots = ServiceSlots(4)
+    youtube, vk = Service("youtube"), Service("vk", max_concurrency=1)
+    # vk простаивает — youtube занимает все слоты сверх своей доли
+    assert _acquire(slots, youtube, 4) == [True] * 4
+    assert _acquire(slots, vk, 2) == [True, False]
+    # vk ждёт: youtube выше доли (2) больше не получает
+    assert not slots.try_acquire(youtube)
+    slots._waiting_at["vk"] -= ServiceSlots.WAITING_WINDOW
+    assert slots.try_acquire(youtube)
+
+
+def test_share_is_at_least_one():
+    slots = ServiceSlots(2)
+    services = [Service(name) for name in ("youtube", "vk", "rutube")]
+    assert all(slots.try_acquire(service) for service in services)
+    assert slots.fair_share("rutube", 0) == 1
@@ -0,0 +1,80 @@
+from collections import namedtuple
+from pathlib import Path
+
+import pytest
+
+from app.config import settings
+from app.models.scratch import ScratchSpace
+
+T1, T2, JOB = (f"00000000-0000-0000-0000-00000000000{i}" for i in range(1, 4))
+DiskUsage = namedtuple("DiskUsage", "total used free")
+
+
+@pytest.fixture
+def disk(monkeypatch, fake_redis) -> dict:
+    usage = {"free": 1000, "total": 10000}
+    monkeypatch.setattr("app.models.scratch.shutil.disk_usage",
+                        lambda path: DiskUsage(usage["total"], usage["total"] - usage["free"], usage["free"]))
+    monkeypatch.setattr(settings, "SCRATCH_MIN_FREE_BYTES", 100)
+    monkeypatch.setattr(settings, "SCRATCH_SCAN_TTL_SECONDS", 0)
+    return usage
+
+
+@pytest.mark.asyncio
+async def test_reserve_counts_outstanding(tmp_path: Path, disk):
+    scratch = ScratchSpace(tmp_path, None)
+    assert await scratch.reserve(T1, 600)
+    assert await scratch.reserve(T1, 600)
+    # 1000 свободно − 600 обещано T1 − 100 запаса
+    assert not await scratch.reserve(T2, 400)
+
+    # T1 записал 500 байт: обещанного осталось 100, но и свободного стало меньше
+    (tmp_path / "author").mkdir()
+    (tmp_path / "author" / f"{T1}_video.mp4").write_bytes(b"x" * 500)
+    disk["free"] = 500
+    assert not await scratch.reserve(T2, 400)
+    assert scratch.stats()["outstanding_bytes"] == 100
+
+    (tmp_path / "author" / f"{T1}_video.mp4").unlink()
+    disk["free"] = 1000
+    await scratch.release(T1)
+    assert scratch.stats()["recent"][-1]["peak"] == 500
+    assert await scratch.reserve(T2, 400)
+    assert (scratch.admitted, scratch.deferred) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_reserve_larger_than_volume(tmp_path: Path, disk):
+    scratch = ScratchSpace(tmp_path, None)
+    # больше, чем вообще есть на томе: ждать бессмысленно, задача пробует сразу
+    assert await scratch.reserve(T1, 10000)
+    assert not await scratch.reserve(T2, 9000)
+
+
+@pytest.mark.asyncio
+async def test_usage_of_tracked_owner(tmp_path: Path, disk):
+    scratch = ScratchSpace(tmp_path, None)
+    assert await scratch.reserve(T1, 600)
+    scratch.track(T1, JOB)
+    (tmp_path / "author").mkdir()
+    (tmp_path / "author" / f"{JOB}_video.mp4").write_bytes(b"x" * 600)
+    disk["free"] = 400
+    # общее задание inflight дописало весь резерв T1 — больше он места не ждёт
+    assert await scratch.reserve(T2, 300)
+    assert scratch.stats()["jobs"][T1]["used"] == 600
+
+
+@pytest.mark.asyncio
+async def test_stage_on_tmpfs(tmp_path: Path, disk, monkeypatch):
+    monkeypatch.setattr(settings, "SCRATCH_TMPFS_MAX_BYTES", 100)
+    monkeypatch.setattr(settings, "SCRATCH_TMPFS_MAX_FILE_BYTES", 80)
+    root, tmpfs = tmp_path / "downloads", tmp_path / "tmpfs"
+    scratch = ScratchSpace(root, tmpfs)
+    assert await scratch.reserve(T1, 600)
+    audio = root / "author" / f"{T1}_audio.m4a"
+    assert scratch.stage(T1, audio, 60) == tmpfs / "author" / audio.name
+    assert scratch.stage(T1, root / "author" / f"{T1}_video.mp4", 90) == root / "author" / f"{T1}_video.mp4"
+    assert scratch.stage(T1, root / "author" / f"{T1}_part.m4a", 50) == root / "author" / f"{T1}_part.m4a"
+    assert scratch.stage(T2, root / "author" / f"{T2}_audio.m4a", 10) == root / "author" / f"{T2}_audio.m4a"
+    await scratch.release(T1)
+    assert scratch.stats()["tmpfs_bytes"] == 0
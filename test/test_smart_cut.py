@@ -0,0 +1,62 @@
+import json
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from app.models.probe import MediaProbe
+from app.utils.video_utils import smart_cut
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None,
+                                reason="ffmpeg is not installed")
+
+FPS = 25
+
+
+def _ffprobe(*args: str) -> dict:
+    output = subprocess.run(["ffprobe", "-v", "error", "-of", "json", *args],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+@pytest.fixture
+def h264_source(tmp_path: Path) -> Path:
+    """10 секунд H.264 + AAC, ключевой кадр каждые 2 секунды."""
+    path = tmp_path / "source.mp4"
+    subprocess.run([
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc=size=320x240:rate={FPS}:duration=10",
+        "-f", "lavfi", "-i", "sine=duration=10",
+        "-c:v", "libx264", "-g", str(2 * FPS), "-keyint_min", str(2 * FPS), "-sc_threshold", "0",
+        "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", "-y", path.as_posix(),
+    ], check=True)
+    return path
+
+
+@pytest.mark.asyncio
+async def test_keyframes_full_precision(h264_source: Path):
+    probe = MediaProbe()
+    media = await probe._run(h264_source.as_posix())
+    keyframes = await probe._keyframes(h264_source.as_posix(), media.start_time)
+    assert keyframes == pytest.approx([0.0, 2.0, 4.0, 6.0, 8.0], abs=1 / FPS / 2)
+
+
+@pytest.mark.asyncio
+async def test_smart_cut_exact_bounds(h264_source: Path, tmp_path: Path):
+    probe = MediaProbe()
+    media = await probe._run(h264_source.as_posix())
+    media.keyframes = await probe._keyframes(h264_source.as_posix(), media.start_time)
+    output = tmp_path / "clip.mp4"
+
+    # начало внутри GOP: перекодируется край 3–4, середина 4–6 копируется
+    start, end = 3, 6
+    await smart_cut(h264_source.as_posix(), output.as_posix(), media, start_seconds=start, end_seconds=end)
+
+    stream = _ffprobe("-count_frames", "-select_streams", "v:0",
+                      "-show_entries", "stream=nb_read_frames,duration", output.as_posix())["streams"][0]
+    assert int(stream["nb_read_frames"]) == pytest.approx((end - start) * FPS, abs=1)
+    assert float(stream["duration"]) == pytest.approx(end - start, abs=1 / FPS)
+    first = _ffprobe("-select_streams", "v:0", "-read_intervals", "%+#1",
+                     "-show_entries", "frame=pts_time", output.as_posix())["frames"][0]
+    assert float(first["pts_time"]) == pytest.approx(0.0, abs=1 / FPS)
@@ -0,0 +1,134 @@
+from pathlib import Path
+
+import pytest
+
+from app.config import settings
+from app.models.cache import redis_cache
+from app.models.inflight import inflight_jobs, job_signature
+from app.models.queue import task_queue
+from app.models.services import VideoServicesManager
+from app.models.speculation import PickKind, SpeculativePrefetch
+from app.models.status import VideoDownloadStatus
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoDownload, SVideoFormat, SVideoResponse, SVideoStatus
+
+URL = "https://vkvideo.ru/video-1_2"
+MB = 1024 * 1024
+SERVICE = VideoServicesManager.get_service(URL)
+VIDEO = SVideoResponse(url=URL, title="Видео", author="Автор", duration=60, formats=[
+    SVideoFormat(quality="360", filesize=10 * MB, video_format_id="360", audio_format_id="a"),
+    SVideoFormat(quality="720", filesize=40 * MB, video_format_id="720", audio_format_id="a"),
+    SVideoFormat(quality="audio", filesize=2 * MB, video_format_id="", audio_format_id="a", container="m4a"),
+])
+BEST = SVideoDownload(url=URL, video_format_id="720", audio_format_id="a")
+
+
+@pytest.fixture
+def spec(fake_redis, monkeypatch) -> SpeculativePrefetch:
+    monkeypatch.setattr(inflight_jobs, "_scripts", {})
+    monkeypatch.setattr(settings, "SPECULATIVE_MIN_SAMPLES", 4)
+    enqueued = []
+
+    async def enqueue_download(task, queue=None):
+        enqueued.append((task.id_, queue))
+
+    monkeypatch.setattr(task_queue, "enqueue_download", enqueue_download)
+    spec = SpeculativePrefetch()
+    spec.enabled = True
+    spec.enqueued = enqueued
+    return spec
+
+
+async def _picks(spec: SpeculativePrefetch, **counts) -> None:
+    for kind, count in counts.items():
+        await redis_cache.redis.hset(spec._key(f"picks:{SERVICE.name}"), kind, count)
+
+
+async def _start(spec: SpeculativePrefetch) -> str:
+    await _picks(spec, best=4)
+    await spec.maybe_start(URL, VIDEO)
+    return spec.enqueued[0][0]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("picks,expected", [
+    ({PickKind.BEST: 3}, None),
+    ({PickKind.BEST: 3, PickKind.OTHER: 1}, BEST),
+    ({PickKind.AUDIO: 3, PickKind.BEST: 1}, SVideoDownload(url=URL, video_format_id="", audio_format_id="a",
+                                                            container="m4a")),
+    ({PickKind.AUDIO: 2, PickKind.BEST: 1, PickKind.OTHER: 2}, None),
+])
+async def test_predict(spec, picks, expected):
+    await _picks(spec, **picks)
+    assert await spec.predict(SERVICE, VIDEO) == expected
+
+
+@pytest.mark.asyncio
+async def test_hit_leaves_budget_but_keeps_file(spec):
+    spec_id = await _start(spec)
+    assert spec.enqueued == [(spec_id, "bulk")]
+    assert (await spec.stats())["active"] == 1
+    await spec.resolve(SERVICE, BEST)
+    stats = await spec.stats()
+    assert (stats["hits"], stats["active"], stats["hit_rate"]) == (1, 0, 1.0)
+    assert await redis_cache.get_download_task(spec_id) is not None
+    assert await redis_cache.redis.zscore(spec._key("expiry"), spec_id) is not None
+
+
+@pytest.mark.asyncio
+async def test_miss_cancels_and_counts_wasted_bytes(spec):
+    spec_id = await _start(spec)
+    task = await redis_cache.get_download_task(spec_id)
+    task.video_status.percent = 50
+    await redis_cache.set_download_task(task)
+    await spec.resolve(SERVICE, BEST.model_copy(update={"video_format_id": "360"}))
+    stats = await spec.stats()
+    assert (stats["misses"], stats["active"], stats["wasted_bytes"]) == (1, 0, 20 * MB)
+    assert await redis_cache.get_download_task(spec_id) is None
+    assert not await redis_cache.redis.exists(spec._key(f"sig:{job_signature(SERVICE, BEST)}"))
+    assert not await redis_cache.redis.zcard(spec._key("expiry"))
+
+
+@pytest.mark.asyncio
+async def test_claim_completed_speculation(spec, tmp_path: Path):
+    spec_id = await _start(spec)
+    speculation = await redis_cache.get_download_task(spec_id)
+    speculation.filepath = tmp_path / f"{spec_id}_video.mp4"
+    speculation.filepath.write_bytes(b"x" * 10)
+    speculation.video_status.status = VideoDownloadStatus.COMPLETED
+    await redis_cache.set_download_task(speculation)
+
+    task_id = "00000000-0000-0000-0000-000000000001"
+    task = DownloadTask(SVideoStatus(task_id=task_id, status=VideoDownloadStatus.PENDING, video=VIDEO), download=BEST)
+    assert await spec.claim(task, job_signature(SERVICE, BEST))
+    assert task.filepath == tmp_path / f"{task_id}_video.mp4" and task.filepath.read_bytes() == b"x" * 10
+    assert (await redis_cache.get_download_task(task_id)).video_status.status == VideoDownloadStatus.COMPLETED
+    assert (await spec.stats())["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_expire_cancels_unclaimed(spec, tmp_path: Path):
+    spec_id = await _start(spec)
+    speculation = await redis_cache.get_download_task(spec_id)
+    speculation.filepath = tmp_path / f"{spec_id}_video.mp4"
+    speculation.filepath.write_bytes(b"x")
+    speculation.video_status.status = VideoDownloadStatus.COMPLETED
+    await redis_cache.set_download_task(speculation)
+    await spec.finished(spec_id)
+
+    assert await spec.expire() == 0
+    await redis_cache.redis.zadd(spec._key("expiry"), {spec_id: 0})
+    assert await spec.expire() == 1
+    stats = await spec.stats()
+    assert (stats["misses"], stats["wasted_bytes"]) == (1, 40 * MB)
+    assert not speculation.filepath.exists()
+    assert await redis_cache.get_download_task(spec_id) is None
+
+
+@pytest.mark.asyncio
+async def test_budget_limits(spec, monkeypatch):
+    monkeypatch.setattr(settings, "SPECULATIVE_MAX_BYTES", 10 * MB)
+    await _picks(spec, best=4)
+    await spec.maybe_start(URL, VIDEO)
+    assert spec.enqueued == []
+    assert (await spec.stats())["skipped_budget"] == 1
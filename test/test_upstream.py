@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from app.config import settings
+from app.exceptions import UpstreamUnavailableException
+from app.models.upstream import UpstreamConnections, upstream_host
+
+EDGE_1 = "https://rr1---sn-abc.googlevideo.com/videoplayback?id=1"
+EDGE_2 = "https://rr2---sn-def.googlevideo.com/videoplayback?id=1"
+
+
+@pytest.fixture
+def upstream(fake_redis, monkeypatch) -> UpstreamConnections:
+    monkeypatch.setattr(settings, "UPSTREAM_CONNECTIONS_PER_HOST", 4)
+    monkeypatch.setattr(settings, "UPSTREAM_LEASE_WAIT_SECONDS", 0)
+    return UpstreamConnections()
+
+
+async def _leased(redis, upstream: UpstreamConnections, host: str) -> int:
+    return await redis.zcard(upstream._key(host))
+
+
+def test_upstream_host(monkeypatch):
+    assert upstream_host(EDGE_1) == "rr1---sn-abc.googlevideo.com"
+    assert upstream_host("googlevideo.com") == "googlevideo.com"
+    monkeypatch.setattr(settings, "UPSTREAM_HOST_GROUPS", {"googlevideo.com": "youtube-cdn"})
+    assert upstream_host(EDGE_1) == upstream_host(EDGE_2) == "youtube-cdn"
+    assert upstream_host("https://vkvideo.ru/video-1_2") == "vkvideo.ru"
+
+
+@pytest.mark.asyncio
+async def test_edges_have_separate_budgets(upstream, fake_redis):
+    async with upstream.lease(EDGE_1, want=4) as first, upstream.lease(EDGE_2, want=4) as second:
+        assert first.count == second.count == 4
+    assert await _leased(fake_redis, upstream, upstream_host(EDGE_1)) == 0
+
+
+@pytest.mark.asyncio
+async def test_lease_shrinks_to_free_connections(upstream, fake_redis):
+    async with upstream.lease(EDGE_1, want=3) as first:
+        async with upstream.lease(EDGE_1, want=3) as second:
+            assert (first.count, second.count) == (3, 1)
+            assert await _leased(fake_redis, upstream, upstream_host(EDGE_1)) == 4
+            # меньше min_count не выдаётся: ждать нельзя — задание откладывается
+            with pytest.raises(UpstreamUnavailableException):
+                async with upstream.lease(EDGE_1, want=2, min_count=2):
+                    pass
+        async with upstream.lease(EDGE_1, want=2) as third:
+            assert third.count == 1
+
+
+@pytest.mark.asyncio
+async def test_expired_leases_are_reclaimed(upstream, fake_redis):
+    host = upstream_host(EDGE_1)
+    ids = await upstream.acquire(host, 4, 1)
+    # держатель упал и не продлевал аренды
+    await fake_redis.zadd(upstream._key(host), {lease: 0 for lease in ids})
+    assert len(await upstream.acquire(host, 4, 4)) == 4
+
+
+@pytest.mark.asyncio
+async def test_renew_extends_only_live_leases(upstream, fake_redis):
+    host = upstream_host(EDGE_1)
+    ids = await upstream.acquire(host, 2, 1)
+    key = upstream._key(host)
+    before = await fake_redis.zscore(key, ids[0])
+    await fake_redis.zrem(key, ids[1])
+    await asyncio.sleep(0.01)
+    await upstream.renew(host, ids)
+    assert await fake_redis.zscore(key, ids[0]) > before
+    # снятая аренда не воскресает
+    assert await fake_redis.zscore(key, ids[1]) is None
+
+
+@pytest.mark.asyncio
+async def test_lease_renews_in_background(upstream, fake_redis):
+    upstream.ttl = 0.06
+    async with upstream.lease(EDGE_1) as lease:
+        key = upstream._key(upstream_host(EDGE_1))
+        first = await fake_redis.zscore(key, lease.ids[0])
+        await asyncio.sleep(0.1)
+        assert await fake_redis.zscore(key, lease.ids[0]) > first
@@ -0,0 +1,75 @@
+import pytest
+import pytest_asyncio
+from arq import Retry
+
+from app import worker
+from app.config import settings
+from app.models.cache import redis_cache
+from app.models.inflight import inflight_jobs, job_signature
+from app.models.services import VideoServicesManager
+from app.models.status import VideoDownloadStatus
+from app.models.types import DownloadTask
+from app.schemas.main import SVideoDownload, SVideoResponse, SVideoStatus
+
+TASK_ID = "00000000-0000-0000-0000-000000000001"
+URL = "https://vkvideo.ru/video-1_2"
+
+
+@pytest_asyncio.fixture
+async def task(fake_redis, monkeypatch) -> DownloadTask:
+    monkeypatch.setattr(inflight_jobs, "_scripts", {})
+    video = SVideoResponse(url=URL, title="Видео", author="Автор", formats=[])
+    download = SVideoDownload(url=URL, video_format_id="720", audio_format_id="720")
+    task = DownloadTask(SVideoStatus(task_id=TASK_ID, status=VideoDownloadStatus.PENDING, video=video),
+                        download=download)
+    await redis_cache.set_task_user(TASK_ID, "u1")
+    await redis_cache.acquire_user_active_task("u1", TASK_ID)
+    await redis_cache.set_download_task(task)
+    return task
+
+
+async def _assert_failed(task: DownloadTask) -> None:
+    assert (await redis_cache.get_download_task(task.id_)).video_status.status == VideoDownloadStatus.ERROR
+    assert await redis_cache.get_user_active_task("u1") is None
+    assert await inflight_jobs.release(task.id_) is None
+
+
+@pytest.mark.asyncio
+async def test_defer_fails_task_after_limit(task, monkeypatch):
+    monkeypatch.setattr(settings, "WORKER_MAX_DEFERRALS", 2)
+    signature = job_signature(VideoServicesManager.get_service(URL), task.download)
+    assert await inflight_jobs.attach(task.id_, signature, "job1") == "job1"
+    for _ in range(2):
+        with pytest.raises(Retry):
+            await worker.defer(task, 1)
+    await worker.defer(task, 1)
+    await _assert_failed(task)
+    # последняя ссылка снята — общее задание отменено
+    assert await redis_cache.is_task_canceled("job1")
+
+
+@pytest.mark.asyncio
+async def test_crashed_runs_fail_task(task):
+    await worker.download_video({"job_try": settings.WORKER_MAX_TRIES + 1}, task.id_)
+    await _assert_failed(task)
+
+
+@pytest.mark.asyncio
+async def test_deferrals_do_not_count_as_tries(task, monkeypatch):
+    async def circuit_wait(service, url):
+        return 5.0
+
+    monkeypatch.setattr(worker, "circuit_wait", circuit_wait)
+    for _ in range(settings.WORKER_MAX_TRIES):
+        await redis_cache.incr_task_deferrals(task.id_)
+    with pytest.raises(Retry):
+        await worker.download_video({"job_try": settings.WORKER_MAX_TRIES + 1}, task.id_)
+    assert (await redis_cache.get_download_task(task.id_)).video_status.status == VideoDownloadStatus.PENDING
+
+
+@pytest.mark.asyncio
+async def test_failure_keeps_canceled_status(task):
+    task.video_status.status = VideoDownloadStatus.CANCELED
+    await redis_cache.set_download_task(task)
+    await worker.fail_task(task, "failed")
+    assert (await redis_cache.get_download_task(task.id_)).video_status.status == VideoDownloadStatus.CANCELED